@@ -1,26 +1,105 @@
 import pathlib
+import sys
+import threading
+from typing import Optional
 import click
-from autoupdater import core
+from autoupdater import (
+    config,
+    core,
+    isolation,
+    lockfile,
+    metrics,
+    peers,
+    requirements,
+    wheelstore,
+)
 import logging
 
 
+def _cpu_list(
+    ctx: click.Context, param: click.Parameter, value: Optional[str]
+) -> Optional[tuple[int, ...]]:
+    if value is None:
+        return None
+    try:
+        return tuple(int(cpu) for cpu in value.split(","))
+    except ValueError:
+        raise click.BadParameter("must be a list of CPU numbers like 2,3")
+
+
+def _limits(
+    cgroup: str,
+    nice: Optional[int],
+    io_class: Optional[str],
+    cpus: Optional[tuple[int, ...]],
+    cpu_limit: Optional[float],
+    memory_limit: Optional[int],
+) -> isolation.Limits:
+    limits = isolation.Limits(
+        nice=nice,
+        io_class=None if io_class == "normal" else io_class,
+        cpus=cpus,
+        cpu_quota=cpu_limit,
+        memory_max=None if memory_limit is None else memory_limit * 1024 * 1024,
+        cgroup=cgroup,
+    )
+    # Before the first process is started, cgroups can't be set up later
+    limits.prepare()
+    return limits
+
+
+def _check_quorum(quorum: int, mirrors: tuple[str, ...]) -> None:
+    if quorum > len(mirrors) + 1:
+        raise click.BadParameter(
+            f"can't be more than the {len(mirrors) + 1} sources of the requirements",
+            param_hint="--mirror-quorum",
+        )
+
+
 @click.command
 @click.argument(
     "requirements_file",
     type=str,
+    required=False,
 )
-@click.argument("module", type=str)
+@click.argument("module", type=str, required=False)
 @click.argument(
     "args",
     nargs=-1,
     type=str,
 )
+@click.option(
+    "--mirror",
+    "mirrors",
+    multiple=True,
+    help=(
+        "Another URL or path of REQUIREMENTS_FILE. The one that answered fastest before is asked first, the next one when it fails or is slow, and the first answer is used. Can be given several times."
+    ),
+)
+@click.option(
+    "--mirror-quorum",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Only use requirements that this many of REQUIREMENTS_FILE and its mirrors agree on.",
+)
+@click.option(
+    "--mirror-timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    default=requirements.DEFAULT_MIRROR_TIMEOUT,
+    help="Give up on a mirror that didn't answer within this many seconds.",
+)
 @click.option(
     "--interval",
     type=int,
     default=60 * 5,
     help="The (minimum) time between checks for updates",
 )
+@click.option(
+    "--jitter",
+    type=click.FloatRange(min=0, max=1),
+    default=0.1,
+    help="Randomly move every check for updates by up to this fraction of --interval.",
+)
 @click.option(
     "--sigterm-timeout",
     type=int,
@@ -29,22 +108,321 @@ import logging
         "If an update is available the running process will be sent a SIGTERM. Wait this many seconds before sending a SIGKILL."
     ),
 )
+@click.option(
+    "--staged/--in-place",
+    default=False,
+    help=(
+        "Build updates into a separate venv while the program keeps running and only restart it once the new venv is ready."
+    ),
+)
+@click.option(
+    "--warm-up/--no-warm-up",
+    default=False,
+    help=(
+        "With --staged, import MODULE in a new venv before switching to it and keep the old venv if that fails."
+    ),
+)
+@click.option(
+    "--keep-generations",
+    type=click.IntRange(min=2),
+    default=3,
+    help="With --staged, keep this many of the most recent venvs around.",
+)
+@click.option(
+    "--healthy-after",
+    type=click.FloatRange(min=0),
+    default=60,
+    help=(
+        "A program is healthy once it ran this many seconds. Exits with a non-zero code before that delay the next restart more and more. With --staged, the venv is then known to be good and is switched back to if a later update keeps exiting sooner."
+    ),
+)
+@click.option(
+    "--max-restart-delay",
+    type=click.FloatRange(min=0),
+    default=5 * 60,
+    help="A program that keeps exiting right away is restarted with growing delays, up to this many seconds.",
+)
+@click.option(
+    "--restart-budget",
+    type=click.IntRange(min=1),
+    default=30,
+    help="Restart a program at most this many times in ten minutes.",
+)
+@click.option(
+    "--lock",
+    "lock_mode",
+    type=click.Choice(["auto", "require", "off"]),
+    default="auto",
+    help=(
+        "Requirements files that pin every requirement with --hash are installed without resolving dependencies, from a cache of files by hash. 'require' refuses to install anything else."
+    ),
+)
+@click.option(
+    "--peer-index",
+    type=str,
+    default=None,
+    help=(
+        "The URL of a simple index served by `python -m autoupdater serve-cache` on a nearby device, like http://host:8765/simple/. Distributions are downloaded from there if it has them and from the upstream index otherwise."
+    ),
+)
+@click.option(
+    "--wheel-store-size",
+    type=click.IntRange(min=0),
+    default=wheelstore.DEFAULT_BUDGET // (1024 * 1024),
+    help=(
+        "Keep the wheels built from source distributions in wheels/, up to this many MB, so they are not built again. 0 to not keep them."
+    ),
+)
+@click.option(
+    "--hashed-cache-size",
+    type=click.IntRange(min=0),
+    default=lockfile.DEFAULT_BUDGET // (1024 * 1024),
+    help=(
+        "Keep the files of lockfiles in hashed/ up to this many MB, the least recently used are removed after an update."
+    ),
+)
+@click.option(
+    "--maintenance-nice",
+    type=click.IntRange(min=0, max=19),
+    default=None,
+    help="Run pip and the other work on the venv with this much lower CPU priority, like 10.",
+)
+@click.option(
+    "--maintenance-io",
+    type=click.Choice(["idle", "best-effort", "normal"]),
+    default="normal",
+    help=(
+        "The I/O scheduling class for the work on the venv, 'best-effort' at the lowest priority, 'idle' only when nothing else uses the disk, 'normal' to leave it alone."
+    ),
+)
+@click.option(
+    "--maintenance-cpus",
+    callback=_cpu_list,
+    default=None,
+    help="Only run the work on the venv on these CPUs, like 3 or 2,3.",
+)
+@click.option(
+    "--maintenance-cpu-limit",
+    type=click.FloatRange(min=0.01),
+    default=None,
+    help="Let the work on the venv use at most this many CPUs (needs a delegated cgroup v2).",
+)
+@click.option(
+    "--maintenance-memory-limit",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Let the work on the venv use at most this many MB of memory (needs a delegated cgroup v2).",
+)
+@click.option(
+    "--program-nice",
+    type=click.IntRange(min=-20, max=19),
+    default=None,
+    help="Run the program with this niceness added.",
+)
+@click.option(
+    "--program-cpus",
+    callback=_cpu_list,
+    default=None,
+    help="Only run the program on these CPUs, like 0,1.",
+)
+@click.option(
+    "--program-cpu-limit",
+    type=click.FloatRange(min=0.01),
+    default=None,
+    help="Let the program use at most this many CPUs (needs a delegated cgroup v2).",
+)
+@click.option(
+    "--program-memory-limit",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Let the program use at most this many MB of memory (needs a delegated cgroup v2).",
+)
+@click.option(
+    "--listen",
+    multiple=True,
+    help=(
+        "Listen on this address for the program and pass the socket on like systemd does (LISTEN_FDS), so restarts and updates don't refuse connections. Like 8080, 127.0.0.1:8080, unix:/run/app.sock or http=8080 to name it. Can be given several times."
+    ),
+)
+@click.option(
+    "--ready-timeout",
+    type=click.FloatRange(min=0),
+    default=30,
+    help=(
+        "With --staged and --listen, the program of an update is started while the old one keeps serving. The old one is stopped once the new one sent READY=1 to NOTIFY_SOCKET, or after this many seconds."
+    ),
+)
+@click.option(
+    "--download-concurrency",
+    type=click.IntRange(min=1),
+    default=4,
+    help="How many distributions to download at the same time when preparing an update.",
+)
+@click.option(
+    "--downloads-per-host",
+    type=click.IntRange(min=1),
+    default=2,
+    help="How many of those downloads may go to the same server at the same time.",
+)
+@click.option(
+    "--config",
+    "config_file",
+    type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help=(
+        "A JSON file listing several services to supervise from this process instead of REQUIREMENTS_FILE and MODULE."
+    ),
+)
+@click.option(
+    "--metrics-port",
+    type=click.IntRange(min=0, max=65535),
+    default=None,
+    help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics.",
+)
 def main(
-    requirements_file: str,
-    module: str,
+    requirements_file: Optional[str],
+    module: Optional[str],
     args: tuple[str, ...],
+    mirrors: tuple[str, ...],
+    mirror_quorum: int,
+    mirror_timeout: float,
     interval: int,
+    jitter: float,
     sigterm_timeout: int,
+    staged: bool,
+    warm_up: bool,
+    keep_generations: int,
+    healthy_after: float,
+    max_restart_delay: float,
+    restart_budget: int,
+    lock_mode: str,
+    peer_index: Optional[str],
+    wheel_store_size: int,
+    hashed_cache_size: int,
+    maintenance_nice: Optional[int],
+    maintenance_io: str,
+    maintenance_cpus: Optional[tuple[int, ...]],
+    maintenance_cpu_limit: Optional[float],
+    maintenance_memory_limit: Optional[int],
+    program_nice: Optional[int],
+    program_cpus: Optional[tuple[int, ...]],
+    program_cpu_limit: Optional[float],
+    program_memory_limit: Optional[int],
+    listen: tuple[str, ...],
+    ready_timeout: float,
+    download_concurrency: int,
+    downloads_per_host: int,
+    config_file: Optional[pathlib.Path],
+    metrics_port: Optional[int],
 ) -> None:
     logging.basicConfig(level=logging.INFO)
-    core.run(
-        requirements_file=requirements_file,
-        module=module,
-        args=list(args),
-        base_directory=pathlib.Path("."),
+    if warm_up and not staged:
+        raise click.UsageError("--warm-up needs --staged")
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+    maintenance_limits = _limits(
+        "maintenance",
+        maintenance_nice,
+        maintenance_io,
+        maintenance_cpus,
+        maintenance_cpu_limit,
+        maintenance_memory_limit,
+    )
+    program_limits = _limits(
+        "program",
+        program_nice,
+        None,
+        program_cpus,
+        program_cpu_limit,
+        program_memory_limit,
+    )
+    options = core.Options(
         duration_between_updates=interval,
         termination_timeout=sigterm_timeout,
+        staged=staged,
+        download_concurrency=download_concurrency,
+        downloads_per_host=downloads_per_host,
+        check_jitter=jitter,
+        warm_up=warm_up,
+        keep_generations=keep_generations,
+        healthy_after=healthy_after,
+        max_restart_delay=max_restart_delay,
+        restart_budget=restart_budget,
+        lock_mode=lock_mode,
+        peer_index=peer_index,
+        wheel_store_budget=wheel_store_size * 1024 * 1024,
+        hashed_cache_budget=hashed_cache_size * 1024 * 1024,
+        maintenance_limits=maintenance_limits,
+        program_limits=program_limits,
+        ready_timeout=ready_timeout,
+        mirror_quorum=mirror_quorum,
+        mirror_timeout=mirror_timeout,
     )
+    if config_file is not None:
+        if requirements_file is not None:
+            raise click.UsageError(
+                "Use either --config or REQUIREMENTS_FILE and MODULE"
+            )
+        if listen or mirrors:
+            raise click.UsageError("With --config, set listen and mirrors per service")
+        try:
+            services = config.load_services(config_file)
+        except config.ConfigError as e:
+            raise click.BadParameter(str(e), param_hint="--config")
+        for service in services:
+            _check_quorum(mirror_quorum, service.mirrors)
+        if not core.run_many(
+            services=services,
+            cache_directory=pathlib.Path(".") / "cache",
+            options=options,
+        ):
+            sys.exit(1)
+        return
+    if requirements_file is None or module is None:
+        raise click.UsageError("Missing REQUIREMENTS_FILE and MODULE (or --config)")
+    _check_quorum(mirror_quorum, mirrors)
+    core.run(
+        config.ServiceConfig(
+            requirements_file=requirements_file,
+            module=module,
+            args=list(args),
+            base_directory=pathlib.Path("."),
+            listen=listen,
+            mirrors=mirrors,
+        ),
+        options,
+    )
+
+
+@click.command(name="serve-cache")
+@click.option(
+    "--directory",
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+    default=pathlib.Path("."),
+    help="The directory autoupdater runs in, its downloads are served.",
+)
+@click.option("--host", type=str, default="0.0.0.0")
+@click.option(
+    "--port", type=click.IntRange(min=0, max=65535), default=peers.DEFAULT_PORT
+)
+@click.option(
+    "--upstream",
+    type=str,
+    default=peers.DEFAULT_UPSTREAM,
+    help=(
+        "Projects are also looked up on this index and its files downloaded the first time a peer asks for them. Empty to only serve what is already here."
+    ),
+)
+def serve_cache(directory: pathlib.Path, host: str, port: int, upstream: str) -> None:
+    logging.basicConfig(level=logging.INFO)
+    server = peers.serve(peers.PeerCache(directory, upstream or None), port, host)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
 
 
-main()
+if sys.argv[1:2] == ["serve-cache"]:
+    serve_cache(sys.argv[2:], prog_name="python -m autoupdater serve-cache")
+else:
+    main()
@@ -0,0 +1,69 @@
+import dataclasses
+import json
+import pathlib
+
+from autoupdater import requirements
+
+
+class ConfigError(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class ServiceConfig:
+    requirements_file: str
+    module: str
+    args: list[str]
+    base_directory: pathlib.Path
+    # Addresses the supervisor listens on for the program, see handoff.listen
+    listen: tuple[str, ...] = ()
+    # Other URLs or paths of the requirements file
+    mirrors: tuple[str, ...] = ()
+
+
+def load_services(config_file: pathlib.Path) -> list[ServiceConfig]:
+    """Read the services to supervise from a JSON file
+
+    The file looks like `{"services": [{"requirements_file": ..., "module": ...,
+    "args": [...], "base_directory": ..., "listen": [...], "mirrors": [...]},
+    ...]}`. `args`, `listen` and `mirrors` are optional and relative base
+    directories and requirements files are relative to the config file.
+    """
+    try:
+        with open(config_file, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"Could not read {config_file}: {e}") from e
+
+    services = []
+    for i, service in enumerate(data.get("services", [])):
+        try:
+            services.append(
+                ServiceConfig(
+                    requirements_file=_relative_to(
+                        config_file, service["requirements_file"]
+                    ),
+                    module=service["module"],
+                    args=[str(arg) for arg in service.get("args", [])],
+                    base_directory=config_file.parent / service["base_directory"],
+                    listen=tuple(str(address) for address in service.get("listen", [])),
+                    mirrors=tuple(
+                        _relative_to(config_file, mirror)
+                        for mirror in service.get("mirrors", [])
+                    ),
+                )
+            )
+        except KeyError as e:
+            raise ConfigError(f"Service {i} in {config_file} is missing {e}") from e
+    if not services:
+        raise ConfigError(f"No services defined in {config_file}")
+    base_directories = [s.base_directory.resolve() for s in services]
+    if len(set(base_directories)) != len(base_directories):
+        raise ConfigError(f"Services in {config_file} must not share a base_directory")
+    return services
+
+
+def _relative_to(config_file: pathlib.Path, requirements_file: str) -> str:
+    if requirements.is_url(requirements_file):
+        return requirements_file
+    return str(config_file.parent / requirements_file)
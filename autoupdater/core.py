@@ -2,16 +2,37 @@ import contextlib
 from os import path
 import os
 import pathlib
-from typing import Callable, Iterator, Optional, TypeVar
+from typing import Any, Callable, Iterator, Optional, Sequence, TypeVar
 import venv as venv_module
+import select
+import shutil
+import signal
 import subprocess
+import threading
 import logging
 import tempfile
 
 import time
 import dataclasses
 
-from autoupdater import requirements
+from autoupdater import (
+    config,
+    events,
+    handoff,
+    inventory,
+    isolation,
+    journal,
+    lockfile,
+    markers,
+    peers,
+    requirements,
+    schedule,
+    snapshot,
+    wheelhouse,
+    wheelstore,
+)
+from autoupdater import metrics as metrics_module
+from autoupdater import watcher as watcher_module
 
 
 log = logging.getLogger(__name__)
@@ -22,6 +43,23 @@ class BaseException(Exception):
 
 
 _MIN_TIME_BETWEEN_ATTEMPTS = 10
+_MAX_RETRY_DELAY = 5 * 60
+_GENERATIONS_DIRECTORY = "venvs"
+_CURRENT_GENERATION_LINK = "current"
+_GOOD_GENERATION_LINK = "good"
+_ACTIVATED_MARKER = "__activated__"
+_BAD_MARKER = "__bad__"
+# This many exits in a row, each before the program was up for `healthy_after`
+_CRASH_LOOP_EXITS = 3
+_ROLLBACK_RECORD = "__rollback__"
+# Describe one generation and must not be carried over to a clone of it
+_GENERATION_MARKERS = (
+    "__confirmed_state__",
+    _ACTIVATED_MARKER,
+    _BAD_MARKER,
+    _ROLLBACK_RECORD,
+)
+_WARM_UP_TIMEOUT = 5 * 60
 
 
 @dataclasses.dataclass(
@@ -30,9 +68,14 @@ _MIN_TIME_BETWEEN_ATTEMPTS = 10
 class VenvSpec:
     requirements_file: str
     base_directory: pathlib.Path
+    name: str = "venv"
+    # Other URLs or paths of the same requirements file, raced against it
+    mirrors: tuple[str, ...] = ()
+    # How many of them must agree on the requirements before they are used
+    mirror_quorum: int = 1
 
     def venv_dir(self) -> pathlib.Path:
-        return self.base_directory / "venv"
+        return self.base_directory / self.name
 
     def pip_path(self) -> pathlib.Path:
         return self.venv_dir() / "bin" / "pip"
@@ -52,18 +95,51 @@ class VenvState:
 class Venv:
     spec: VenvSpec
     state: VenvState
+    fetcher: requirements.Fetcher = dataclasses.field(
+        default_factory=requirements.default_fetcher
+    )
+    metrics: metrics_module.Metrics = dataclasses.field(
+        default_factory=metrics_module.Metrics
+    )
+    # Must import before the venv is approved, if set
+    warm_up_module: Optional[str] = None
+    keep_generations: int = 3
+    # "auto" installs lockfiles without resolving, "require" refuses anything else
+    lock_mode: str = "auto"
+    # A PEP 503 index on a nearby device to try before the upstream index
+    peer_index: Optional[str] = None
+    wheel_store: Optional[wheelstore.WheelStore] = None
+    # The files of lockfiles by hash, hashed/ in the base directory if None
+    hashed_cache: Optional[pathlib.Path] = None
+    # Bytes the least recently used of those are removed beyond
+    hashed_cache_budget: int = lockfile.DEFAULT_BUDGET
+    # For pip and everything else that only maintains the venv
+    maintenance_limits: isolation.Limits = isolation.NO_LIMITS
+
+    def hashed_cache_dir(self) -> pathlib.Path:
+        if self.hashed_cache is not None:
+            return self.hashed_cache
+        return lockfile.cache_dir(self.spec.base_directory)
 
     def approve_venv(self) -> None:
         with open(self.spec.venv_dir() / "__confirmed_state__", "wb") as f:
             f.write(self.state.installed_digest)
 
+    def revoke_approval(self) -> None:
+        try:
+            os.remove(self.spec.venv_dir() / "__confirmed_state__")
+        except FileNotFoundError:
+            pass
+
     def is_venv_approved_for_digest(self, digest: bytes) -> bool:
+        return self.approved_digest() == digest
+
+    def approved_digest(self) -> Optional[bytes]:
         try:
             with open(self.spec.venv_dir() / "__confirmed_state__", "rb") as f:
-                confirmed_digest = f.read()
+                return f.read()
         except FileNotFoundError:
-            return False
-        return confirmed_digest == digest
+            return None
 
 
 @dataclasses.dataclass()
@@ -71,68 +147,573 @@ class Program:
     process: subprocess.Popen
     venv: Venv
     when_last_update_check: float
+    # The NOTIFY_SOCKET of a program that was passed listening sockets
+    readiness: Optional[handoff.Readiness] = None
+    # Keeps serving after its launch ended, until the next program is ready
+    handed_over: bool = False
 
     def is_running(self) -> bool:
         return self.process.poll() is None
 
+    def close(self) -> None:
+        if self.readiness is not None:
+            self.readiness.close()
+
     def stop(self, time_before_kill: float) -> None:
-        log.info("Terminating program...")
-        self.process.terminate()
+        self.close()
+        with self.venv.metrics.span("stop"):
+            log.info("Terminating program...")
+            self.process.terminate()
+            try:
+                self.process.communicate(timeout=time_before_kill)
+            except subprocess.TimeoutExpired:
+                log.info("Program did not respond to SIGTERM, using SIGKILL...")
+                self.process.kill()
+                self.process.communicate()
+                self.venv.metrics.increment("kills")
+                log.info("Program killed!")
+            else:
+                log.info("Program terminated successfully!")
+        self.venv.metrics.set_gauge("program_up", 0)
+
+
+@dataclasses.dataclass()
+class SocketHandoff:
+    """Listening sockets the supervisor holds for the program
+
+    In staged mode the program of the new venv is started while the old one
+    still serves, the old one is only stopped once the new one sent READY=1 or
+    `ready_timeout` seconds passed.
+    """
+
+    sockets: handoff.ListeningSockets
+    ready_timeout: float = 30
+    previous: Optional[Program] = None
+
+    def stop_previous(self, time_before_kill: float) -> None:
+        if self.previous is not None:
+            self.previous.stop(time_before_kill)
+            self.previous = None
+
+
+class UpdateChecker:
+    """Check for and prepare updates on a background thread
+
+    Fetching the requirements and preparing an update can take minutes when the
+    network is slow. The supervisor keeps restarting the program in the meantime
+    and only waits for `finished` to be notified, `take` then tells whether the
+    check found an update.
+    """
+
+    def __init__(self, venv: Venv, staged: bool) -> None:
+        self.venv = venv
+        self.staged = staged
+        self.finished = events.Notifier()
+        self._lock = threading.Lock()
+        self._busy = False
+        self._digest: Optional[bytes] = None
+
+    def is_busy(self) -> bool:
+        return self._busy
+
+    def check(self) -> None:
+        """Start a check unless one is still running"""
+        with self._lock:
+            if self._busy:
+                return
+            self._busy = True
+        threading.Thread(
+            target=self._check, args=(self.venv,), name="update-check", daemon=True
+        ).start()
+
+    def take(self) -> Optional[bytes]:
+        """The digest of the prepared update, if there is one"""
+        with self._lock:
+            digest, self._digest = self._digest, None
+            self.finished.clear()
+        return digest
+
+    def _check(self, venv: Venv) -> None:
+        new_digest = None
         try:
-            self.process.communicate(timeout=time_before_kill)
-        except subprocess.TimeoutExpired:
-            log.info("Program did not respond to SIGTERM, using SIGKILL...")
-            self.process.kill()
-            self.process.communicate()
-            log.info("Program killed!")
-        else:
-            log.info("Program terminated successfully!")
+            new_digest = maybe_new_requirements_digest(venv)
+            if new_digest is not None:
+                log.info("Update detected!")
+                prepare_update(venv, new_digest, self.staged)
+        except Exception:
+            log.exception("Could not prepare the update, keeping the program running")
+            new_digest = None
+        with self._lock:
+            self._digest = new_digest
+            self._busy = False
+            self.finished.notify()
 
 
 R = TypeVar("R")
 
 
 def retry_forever(fn: Callable[[], R], delay: int = _MIN_TIME_BETWEEN_ATTEMPTS) -> R:
+    # Waits grow with every failure so a fleet with the same problem backs off
+    backoff = schedule.Backoff(base=delay, cap=_MAX_RETRY_DELAY)
+    attempt = 0
     while True:
         try:
             return fn()
         except Exception:
-            log.exception(f"Unexpected error. Retrying in {delay} seconds")
-            time.sleep(delay)
+            wait = delay + backoff.delay(attempt)
+            attempt += 1
+            log.exception(f"Unexpected error. Retrying in {wait:.0f} seconds")
+            time.sleep(wait)
+
+
+@dataclasses.dataclass(frozen=True)
+class Options:
+    """How the supervisor runs and updates programs, the same for every service"""
+
+    duration_between_updates: float = 5 * 60
+    termination_timeout: float = 30
+    staged: bool = False
+    download_concurrency: int = 4
+    downloads_per_host: int = 2
+    check_jitter: float = 0
+    warm_up: bool = False
+    keep_generations: int = 3
+    healthy_after: float = 60
+    max_restart_delay: float = 5 * 60
+    restart_budget: int = 30
+    lock_mode: str = "auto"
+    peer_index: Optional[str] = None
+    wheel_store_budget: int = wheelstore.DEFAULT_BUDGET
+    hashed_cache_budget: int = lockfile.DEFAULT_BUDGET
+    maintenance_limits: isolation.Limits = isolation.NO_LIMITS
+    program_limits: isolation.Limits = isolation.NO_LIMITS
+    ready_timeout: float = 30
+    mirror_quorum: int = 1
+    mirror_timeout: float = requirements.DEFAULT_MIRROR_TIMEOUT
 
 
 def run(
+    service: config.ServiceConfig,
+    options: Options = Options(),
+    fetcher: Optional[requirements.Fetcher] = None,
+    shutdown: Optional[events.ShutdownFlag] = None,
+    wheel_store: Optional[wheelstore.WheelStore] = None,
+    hashed_cache: Optional[pathlib.Path] = None,
+) -> None:
+    """Run the program of `service` in an up to date venv, restart it on exits
+
+    A program that keeps exiting before it ran for `healthy_after` seconds is
+    restarted with exponential backoff up to `max_restart_delay`, and never more
+    than `restart_budget` times in ten minutes. In staged mode a generation
+    counts as good once the program ran for `healthy_after` seconds in it, on
+    a crash loop the supervisor switches back to the last good generation.
+    After a restart of the supervisor the program starts right away in the venv
+    recorded in the journal, if that is still approved. The supervisor listens
+    on the addresses in `service.listen` and passes the sockets on to the
+    program, see `SocketHandoff`. The requirements file is raced against its
+    `service.mirrors`, see `requirements.Fetcher.race`. The `fetcher`,
+    `wheel_store` and `hashed_cache` are the service's own unless given.
+    """
+    base_directory = service.base_directory
+    metrics = metrics_module.register(
+        metrics_module.Metrics(
+            labels={"module": service.module},
+            status_file=base_directory / "status.json",
+        )
+    )
+    # Opened first, so that a port in use stops the supervisor right away
+    socket_handoff = (
+        SocketHandoff(handoff.listen(service.listen), options.ready_timeout)
+        if service.listen
+        else None
+    )
+    if wheel_store is None and options.wheel_store_budget > 0:
+        wheel_store = wheelstore.WheelStore(
+            wheelstore.store_dir(base_directory), options.wheel_store_budget
+        )
+    if fetcher is None:
+        fetcher = requirements.Fetcher(
+            cache_directory=base_directory / "cache",
+            download_concurrency=options.download_concurrency,
+            downloads_per_host=options.downloads_per_host,
+            metrics=metrics,
+            mirror_timeout=options.mirror_timeout,
+        )
+    watcher = (
+        None
+        if requirements.is_url(service.requirements_file)
+        else watcher_module.watch_file(service.requirements_file)
+    )
+    template = venv_template(
+        service.requirements_file,
+        base_directory,
+        fetcher=fetcher,
+        metrics=metrics,
+        mirrors=service.mirrors,
+        mirror_quorum=options.mirror_quorum,
+        warm_up_module=service.module if options.warm_up else None,
+        keep_generations=options.keep_generations,
+        lock_mode=options.lock_mode,
+        peer_index=options.peer_index,
+        wheel_store=wheel_store,
+        hashed_cache=hashed_cache,
+        hashed_cache_budget=options.hashed_cache_budget,
+        maintenance_limits=options.maintenance_limits,
+    )
+    resumed = resume_venv(template, options.staged)
+    venv = resumed or retry_forever(
+        lambda: init_venv_from_template(template, options.staged)
+    )
+    record_state(venv)
+
+    checker = UpdateChecker(venv, options.staged)
+    if resumed is not None:
+        # The program starts right away, updates are reconciled in the background
+        checker.check()
+    restarts = schedule.RestartPolicy(
+        max_delay=options.max_restart_delay,
+        stable_after=options.healthy_after,
+        budget=options.restart_budget,
+    )
+    first_launch = True
+    roll_back_tried = False
+    try:
+        while shutdown is None or not shutdown.is_set():
+            if not first_launch:
+                metrics.increment("restarts")
+            first_launch = False
+            try:
+                new_digest = run_program_until_dead_or_updated(
+                    venv,
+                    service.module,
+                    service.args,
+                    options.duration_between_updates,
+                    options.termination_timeout,
+                    staged=options.staged,
+                    watcher=watcher,
+                    shutdown=shutdown,
+                    check_jitter=options.check_jitter,
+                    checker=checker,
+                    healthy_after=options.healthy_after,
+                    restarts=restarts,
+                    program_limits=options.program_limits,
+                    socket_handoff=socket_handoff,
+                )
+                if new_digest is None:
+                    # Restarting never waits for the network, only a prepared update
+                    new_digest = checker.take() or _wait_before_restart(
+                        venv, restarts, checker, shutdown
+                    )
+            except events.Shutdown:
+                log.info("Shutting down")
+                return
+            except Exception:
+                log.exception("Unexpected error! Program will be restart shortly...")
+                restarts.record_exit(None, 0)
+                time.sleep(restarts.next_restart(time.time()))
+                new_digest = checker.take()
+            if restarts.failures < _CRASH_LOOP_EXITS:
+                roll_back_tried = False
+            elif new_digest is None and options.staged and not roll_back_tried:
+                # Once per crash loop, what to go back to doesn't change in between
+                roll_back_tried = True
+                good = roll_back(venv)
+                if good is not None:
+                    venv = checker.venv = good
+                    restarts.reset()
+                    record_state(venv)
+            if new_digest is not None and (
+                updated := _apply_or_keep(venv, new_digest, options.staged)
+            ):
+                venv = checker.venv = updated
+                restarts.reset()
+                record_state(venv)
+            metrics.flush()
+    finally:
+        metrics.flush()
+        if watcher is not None:
+            watcher.close()
+        if socket_handoff is not None:
+            socket_handoff.stop_previous(options.termination_timeout)
+            socket_handoff.sockets.close()
+
+
+def _apply_or_keep(venv: Venv, digest: bytes, staged: bool) -> Optional[Venv]:
+    """The venv updated to `digest`, or None to keep running `venv`
+
+    An update that fails but leaves `venv` as it was is tried again with the
+    next check, the program runs from `venv` in the meantime. Only if `venv`
+    could not be restored does this keep retrying, there is nothing to run.
+    """
+    try:
+        return apply_update(venv, digest, staged)
+    except Exception:
+        if not venv.is_venv_approved_for_digest(venv.state.installed_digest):
+            log.exception("Update failed and left the venv broken, retrying")
+            return retry_forever(lambda: apply_update(venv, digest, staged))
+        log.exception("Update failed, keeping the current venv until the next check")
+    venv.metrics.increment("failed_updates")
+    record_state(venv, failed_digest=digest)
+    return None
+
+
+def _wait_before_restart(
+    venv: Venv,
+    restarts: schedule.RestartPolicy,
+    checker: UpdateChecker,
+    shutdown: Optional[events.ShutdownFlag],
+) -> Optional[bytes]:
+    """Back off before the next restart, an update that fixes a crash ends the wait"""
+    delay = restarts.next_restart(time.time())
+    venv.metrics.set_gauge("restart_delay_seconds", delay)
+    venv.metrics.set_gauge("consecutive_failures", restarts.failures)
+    if delay <= 0:
+        return None
+    log.warning(
+        "Program exited (%s) %s times in a row, restarting in %.1fs",
+        restarts.last_exit,
+        restarts.failures,
+        delay,
+    )
+    checker.check()
+    deadline = time.time() + delay
+    with events.Waiter(shutdown=shutdown) as waiter:
+        waiter.watch_checks(checker.finished)
+        while (remaining := deadline - time.time()) > 0:
+            wakeup = waiter.wait(remaining)
+            if wakeup.shutdown:
+                raise events.Shutdown()
+            if wakeup.check_finished and (new_digest := checker.take()) is not None:
+                log.info("Update available, restarting right away")
+                return new_digest
+    return None
+
+
+def run_many(
     *,
+    services: list[config.ServiceConfig],
+    cache_directory: pathlib.Path,
+    options: Options = Options(),
+) -> bool:
+    """Supervise several programs from one process
+
+    Every service gets its own thread, they share the fetcher so identical
+    requirements files are only fetched once, and the wheel store and files of
+    lockfiles in `cache_directory` so a distribution used by several services
+    is only downloaded or built once. Shutdown signals are handled here and
+    passed on to all services.
+
+    If a service stops by itself, e.g. because it can't listen on its
+    addresses, the others are shut down too and False is returned, so that
+    whatever supervises this process notices and can restart it.
+    """
+    fetcher = requirements.Fetcher(
+        cache_directory=cache_directory,
+        download_concurrency=options.download_concurrency,
+        downloads_per_host=options.downloads_per_host,
+        metrics=metrics_module.register(metrics_module.Metrics()),
+        mirror_timeout=options.mirror_timeout,
+    )
+    wheel_store = (
+        wheelstore.WheelStore(
+            wheelstore.store_dir(cache_directory), options.wheel_store_budget
+        )
+        if options.wheel_store_budget > 0
+        else None
+    )
+    shutdown = events.ShutdownFlag()
+    stopped = events.Notifier()
+    threads = [
+        threading.Thread(
+            target=_run_service,
+            name=service.module,
+            args=(stopped, service, options, fetcher, shutdown),
+            kwargs=dict(
+                wheel_store=wheel_store,
+                hashed_cache=lockfile.cache_dir(cache_directory),
+            ),
+            daemon=True,
+        )
+        for service in services
+    ]
+
+    def request_shutdown(signum: int, frame: Any) -> None:
+        log.info("Received %s", signal.Signals(signum).name)
+        shutdown.set()
+
+    previous_handlers = {
+        signum: signal.signal(signum, request_shutdown)
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    try:
+        for thread in threads:
+            thread.start()
+        select.select([shutdown, stopped], [], [])
+        all_running = shutdown.is_set()
+        if not all_running:
+            log.error("A service stopped, shutting down the others")
+            shutdown.set()
+        # Threads stuck retrying something are daemons, don't wait for them forever
+        deadline = (
+            time.time() + options.termination_timeout + _MIN_TIME_BETWEEN_ATTEMPTS
+        )
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+    return all_running
+
+
+def _run_service(stopped: events.Notifier, *args: Any, **kwargs: Any) -> None:
+    try:
+        run(*args, **kwargs)
+    except Exception:
+        log.exception("Service %s failed", threading.current_thread().name)
+    finally:
+        stopped.notify()
+
+
+def init_venv(
     requirements_file: str,
-    module: str,
-    args: list[str],
     base_directory: pathlib.Path,
-    duration_between_updates: float,
-    termination_timeout: float = 30,
-) -> None:
-    venv = retry_forever(lambda: init_venv(requirements_file, base_directory))
+    fetcher: Optional[requirements.Fetcher] = None,
+    staged: bool = False,
+    metrics: Optional[metrics_module.Metrics] = None,
+    **settings: Any,
+):
+    """`settings` are fields of `Venv`, like `lock_mode`, see `venv_template`"""
+    template = venv_template(
+        requirements_file, base_directory, fetcher=fetcher, metrics=metrics, **settings
+    )
+    return init_venv_from_template(template, staged)
 
-    while True:
-        try:
-            new_digest = run_program_until_dead_or_updated(
-                venv, module, args, duration_between_updates, termination_timeout
-            )
-        except Exception:
-            log.exception("Unexpected error! Program will be restart shortly...")
-            new_digest = retry_forever(lambda: maybe_new_requirements_digest(venv))
-            retry_forever(lambda: ensure_digest_installed(venv, new_digest))
-        else:
-            if new_digest is not None:
-                retry_forever(lambda: ensure_digest_installed(venv, new_digest))
+
+def venv_template(
+    requirements_file: str,
+    base_directory: pathlib.Path,
+    fetcher: Optional[requirements.Fetcher] = None,
+    metrics: Optional[metrics_module.Metrics] = None,
+    mirrors: Sequence[str] = (),
+    mirror_quorum: int = 1,
+    **settings: Any,
+) -> Venv:
+    """Not created on disk, it only carries the settings over to the real venv
+
+    `settings` are the remaining fields of `Venv`, like `lock_mode`.
+    """
+    return Venv(
+        spec=VenvSpec(
+            requirements_file=requirements_file,
+            base_directory=base_directory,
+            mirrors=tuple(mirrors),
+            mirror_quorum=mirror_quorum,
+        ),
+        state=VenvState(),
+        fetcher=fetcher or requirements.default_fetcher(),
+        metrics=metrics or metrics_module.Metrics(),
+        **settings,
+    )
 
 
-def init_venv(requirements_file: str, base_directory: pathlib.Path):
-    venv_spec = VenvSpec(
-        requirements_file=requirements_file, base_directory=base_directory
+def init_venv_from_template(template: Venv, staged: bool) -> Venv:
+    with template.metrics.span("init_venv"):
+        if staged:
+            return _init_staged_venv(template)
+        venv = _sibling_venv(template, template.spec.name)
+        new_digest = maybe_new_requirements_digest(venv)
+        ensure_digest_installed(venv, new_digest)
+        return venv
+
+
+def resume_venv(template: Venv, staged: bool) -> Optional[Venv]:
+    """The venv that was in use before the supervisor stopped, if it is approved
+
+    Only local files are read, so the program can start right away even
+    without a network. Whether the venv is up to date is checked afterwards.
+    """
+    base_directory = template.spec.base_directory
+    entry = journal.load(base_directory)
+    if entry is None:
+        return None
+    spec = dataclasses.replace(template.spec, name=entry.venv_name)
+    if not path.isfile(spec.pip_path()):
+        log.info("The venv %s from the journal is gone", entry.venv_name)
+        return None
+    venv = _sibling_venv(template, entry.venv_name)
+    if venv.approved_digest() != entry.installed_digest:
+        log.info("The venv %s changed since the journal was written", entry.venv_name)
+        return None
+    if staged:
+        if is_generation_bad(base_directory, entry.installed_digest):
+            return None
+        if current_generation(base_directory) != entry.venv_name:
+            _point_current_at(base_directory, entry.venv_name)
+    elif entry.venv_name != template.spec.name:
+        return None
+    venv.state = VenvState(
+        installed_digest=entry.installed_digest,
+        last_updated_timestamp=entry.last_updated_timestamp,
+        when_last_update_attempt=entry.when_last_update_attempt,
+    )
+    if entry.inventory is not None:
+        inventory.restore(venv.spec.venv_dir(), entry.inventory)
+    log.info("Resuming with %s", venv.spec.venv_dir())
+    return venv
+
+
+def record_state(venv: Venv, failed_digest: Optional[bytes] = None) -> None:
+    """Write down the venv in use so that the next start can resume with it"""
+    inventory.freeze(venv.spec.venv_dir())
+    journal.save(
+        venv.spec.base_directory,
+        journal.Entry(
+            venv_name=venv.spec.name,
+            installed_digest=venv.state.installed_digest,
+            last_updated_timestamp=venv.state.last_updated_timestamp,
+            when_last_update_attempt=venv.state.when_last_update_attempt,
+            inventory=inventory.snapshot(venv.spec.venv_dir()),
+            failed_digest=failed_digest,
+        ),
     )
-    venv = ensure_venv(venv_spec)
-    new_digest = maybe_new_requirements_digest(venv)
-    ensure_digest_installed(venv, new_digest)
+
+
+def _init_staged_venv(template: Venv) -> Venv:
+    base_directory = template.spec.base_directory
+    digest = requirements.digest_from_requirements_file(
+        template.spec.requirements_file,
+        template.fetcher,
+        template.spec.mirrors,
+        template.spec.mirror_quorum,
+    )
+    if digest is not None and not is_generation_bad(base_directory, digest):
+        return activate_generation(template, digest)
+    current = current_generation(base_directory)
+    if current is None:
+        raise BaseException(
+            f"Could not read the requirements from {template.spec.requirements_file}"
+        )
+    log.info("Requirements unavailable, using current generation %s", current)
+    return _existing_generation(template, current)
+
+
+def _sibling_venv(venv: Venv, name: str) -> Venv:
+    """Ensure the venv called `name` next to `venv`, sharing its settings"""
+    sibling = ensure_venv(dataclasses.replace(venv.spec, name=name))
+    return dataclasses.replace(venv, spec=sibling.spec, state=sibling.state)
+
+
+def _existing_generation(venv: Venv, name: str) -> Venv:
+    generation = _sibling_venv(venv, name)
+    generation.state.installed_digest = generation.approved_digest() or b""
+    generation.state.last_updated_timestamp = time.time()
+    return generation
+
+
+def apply_update(venv: Venv, digest: bytes, staged: bool) -> Venv:
+    if staged:
+        return activate_generation(venv, digest)
+    ensure_digest_installed(venv, digest)
     return venv
 
 
@@ -142,17 +723,124 @@ def run_program_until_dead_or_updated(
     args: list[str],
     duration_between_updates: float,
     termination_timeout: float,
+    staged: bool = False,
+    watcher: Optional[watcher_module.FileWatcher] = None,
+    clock: Optional[events.Clock] = None,
+    shutdown: Optional[events.ShutdownFlag] = None,
+    check_jitter: float = 0,
+    checker: Optional[UpdateChecker] = None,
+    healthy_after: Optional[float] = None,
+    restarts: Optional[schedule.RestartPolicy] = None,
+    program_limits: isolation.Limits = isolation.NO_LIMITS,
+    socket_handoff: Optional[SocketHandoff] = None,
 ) -> Optional[bytes]:
-    with launch(venv, module, args) as program:
+    """Run the program until it exits or an update is ready
+
+    Updates are checked for every `duration_between_updates` seconds, moved
+    randomly by up to the fraction `check_jitter` so that many supervisors
+    started at the same time don't all ask the server at the same moment.
+    The checks run on the `checker`'s thread, this loop never blocks on them.
+    A staged generation is marked as good once the program ran in it for
+    `healthy_after` seconds. Exits of the program are recorded in `restarts`.
+    The program is started with `program_limits` and gets the sockets of
+    `socket_handoff`. In staged mode it keeps running when an update is ready,
+    the next call stops it once the program of the new venv is ready.
+    """
+    clock = clock or events.Clock()
+    checker = checker or UpdateChecker(venv, staged)
+    # A watcher only shortens the wait, the regular checks stay as a safety net
+    file_changed = False
+    interval = schedule.jittered(duration_between_updates, check_jitter)
+    sockets = None if socket_handoff is None else socket_handoff.sockets
+    with launch(venv, module, args, program_limits, sockets) as program, events.Waiter(
+        clock, shutdown
+    ) as waiter:
+        waiter.watch_process(program.process)
+        waiter.watch_checks(checker.finished)
+        if watcher is not None:
+            waiter.watch_file(watcher)
+        if socket_handoff is not None and socket_handoff.previous is not None:
+            _take_over(program, socket_handoff, waiter, clock, termination_timeout)
+        started = clock.time()
+        healthy_at = None
+        if staged and healthy_after is not None and not is_generation_good(venv):
+            healthy_at = started + healthy_after
         while program.is_running():
-            if time.time() - program.when_last_update_check > duration_between_updates:
-                program.when_last_update_check = time.time()
-                if (new_digest := maybe_new_requirements_digest(venv)) is not None:
-                    log.info("Update detected!")
+            if healthy_at is not None and clock.time() >= healthy_at:
+                healthy_at = None
+                mark_generation_good(venv)
+            next_update_check = program.when_last_update_check + interval
+            if not checker.is_busy() and (
+                file_changed or clock.time() >= next_update_check
+            ):
+                file_changed = False
+                program.when_last_update_check = clock.time()
+                interval = schedule.jittered(duration_between_updates, check_jitter)
+                checker.check()
+                continue
+            deadlines = [] if checker.is_busy() else [next_update_check]
+            if healthy_at is not None:
+                deadlines.append(healthy_at)
+            wakeup = waiter.wait(min(deadlines) - clock.time() if deadlines else None)
+            if wakeup.shutdown:
+                program.stop(termination_timeout)
+                raise events.Shutdown()
+            if wakeup.check_finished:
+                venv.metrics.flush()
+            if wakeup.check_finished and (new_digest := checker.take()) is not None:
+                if staged and socket_handoff is not None:
+                    log.info("Keeping the program running until the update is ready")
+                    program.handed_over = True
+                    socket_handoff.previous = program
+                else:
                     program.stop(termination_timeout)
-                    return new_digest
-            time.sleep(1)
+                return new_digest
+            file_changed = file_changed or wakeup.file_changed
         log.info("Process completed, restarting")
+        venv.metrics.set_gauge("program_up", 0)
+        venv.metrics.increment("exits")
+        if program.process.returncode != 0:
+            venv.metrics.increment("crashes")
+        if restarts is not None:
+            kind = restarts.record_exit(
+                program.process.returncode, clock.time() - started
+            )
+            venv.metrics.set_info("last_exit", kind)
+
+
+def _take_over(
+    program: Program,
+    socket_handoff: SocketHandoff,
+    waiter: events.Waiter,
+    clock: events.Clock,
+    termination_timeout: float,
+) -> None:
+    """Stop the previous program once `program` is ready to serve
+
+    If `program` exits first the previous one keeps serving, it is only
+    replaced by a program that got ready or ran for the whole `ready_timeout`.
+    """
+    assert program.readiness is not None
+    waiter.watch_readiness(program.readiness)
+    deadline = clock.time() + socket_handoff.ready_timeout
+    with program.venv.metrics.span("handoff"):
+        while program.is_running() and not program.readiness.is_ready:
+            remaining = deadline - clock.time()
+            if remaining <= 0:
+                log.warning(
+                    "Program did not send READY=1 within %ss, replacing the old one anyway",
+                    socket_handoff.ready_timeout,
+                )
+                break
+            if waiter.wait(remaining).shutdown:
+                break
+        if not program.is_running():
+            log.warning("Program exited before it was ready, the old one keeps serving")
+            return
+        log.info("Program is ready, stopping the old one")
+        socket_handoff.stop_previous(termination_timeout)
+    program.venv.metrics.increment("handoffs")
+    program.venv.metrics.set_gauge("program_up", 1)
 
 
 @contextlib.contextmanager
@@ -160,23 +848,51 @@ def launch(
     venv: Venv,
     module: str,
     args: list[str],
+    limits: isolation.Limits = isolation.NO_LIMITS,
+    sockets: Optional[handoff.ListeningSockets] = None,
 ) -> Iterator[Program]:
-    command = [
-        venv.spec.python_path().absolute(),
-        "-u",
-        "-m",
-        module,
-    ] + args
+    python = venv.spec.python_path().absolute()
+    command = [python, "-u", "-m", module] + args
+    readiness = None
+    environment = None
+    if sockets is not None:
+        command = sockets.wrap(python, command)
+        readiness = handoff.Readiness()
+        environment = {
+            **os.environ,
+            **sockets.environment(),
+            **readiness.environment(),
+        }
+    command = limits.wrap(command)
     log.info("Starting process '%s'", " ".join(str(arg) for arg in command))
-    process = subprocess.Popen(command)
+    with venv.metrics.span("launch"):
+        try:
+            process = subprocess.Popen(
+                command,
+                env=environment,
+                pass_fds=() if sockets is None else sockets.fds(),
+            )
+        except Exception:
+            if readiness is not None:
+                readiness.close()
+            raise
+    venv.metrics.increment("launches")
+    venv.metrics.set_gauge("program_up", 1)
+    venv.metrics.set_gauge("program_started_timestamp", time.time())
+    venv.metrics.set_info("installed_digest", venv.state.installed_digest.hex())
     program = Program(
         process=process,
         venv=venv,
         when_last_update_check=venv.state.last_updated_timestamp,
+        readiness=readiness,
     )
-    yield program
-    if program.is_running:
-        program.process.kill()
+    try:
+        yield program
+    finally:
+        if not program.handed_over:
+            program.close()
+            if program.is_running():
+                program.process.kill()
 
 
 def ensure_venv(venv_spec: VenvSpec) -> Venv:
@@ -211,18 +927,164 @@ def _recreate_venv(venv_spec: VenvSpec) -> Venv:
     return _create_venv(venv_spec)
 
 
+def generation_name(digest: bytes) -> str:
+    return f"{_GENERATIONS_DIRECTORY}/{digest.hex()[:16]}"
+
+
+def current_generation(base_directory: pathlib.Path) -> Optional[str]:
+    try:
+        return os.readlink(base_directory / _CURRENT_GENERATION_LINK)
+    except OSError:
+        return None
+
+
+def good_generation(base_directory: pathlib.Path) -> Optional[str]:
+    """The last generation the program ran in for long enough"""
+    try:
+        return os.readlink(base_directory / _GOOD_GENERATION_LINK)
+    except OSError:
+        return None
+
+
+def is_generation_good(venv: Venv) -> bool:
+    return good_generation(venv.spec.base_directory) == venv.spec.name
+
+
+def mark_generation_good(venv: Venv) -> None:
+    log.info("Generation %s is good", venv.spec.name)
+    _point_link(venv.spec.base_directory, _GOOD_GENERATION_LINK, venv.spec.name)
+    venv.metrics.set_info("good_generation", venv.spec.name)
+
+
+def is_generation_bad(base_directory: pathlib.Path, digest: bytes) -> bool:
+    return path.exists(base_directory / generation_name(digest) / _BAD_MARKER)
+
+
+def roll_back(venv: Venv) -> Optional[Venv]:
+    """Switch back to the last good generation, without installing anything
+
+    The generation of `venv` is marked as bad so the same requirements are not
+    switched to again. Returns None if there is nothing to switch back to.
+    """
+    base_directory = venv.spec.base_directory
+    good = good_generation(base_directory)
+    if good is None or good == venv.spec.name or not path.isdir(base_directory / good):
+        log.warning(
+            "%s keeps exiting, but there is no generation to go back to", venv.spec.name
+        )
+        return None
+    log.warning("%s keeps exiting, rolling back to %s", venv.spec.name, good)
+    with open(venv.spec.venv_dir() / _BAD_MARKER, "w"):
+        pass
+    _point_link(base_directory, _CURRENT_GENERATION_LINK, good)
+    venv.metrics.increment("rollbacks")
+    return _existing_generation(venv, good)
+
+
+def stage_generation(venv: Venv, digest: bytes) -> Venv:
+    """Build `digest` into its own venv next to `venv` without touching it
+
+    A new generation starts out as a clone of the current one, so only what
+    changed in the requirements has to be installed.
+    """
+    name = generation_name(digest)
+    base_directory = venv.spec.base_directory
+    source = current_generation(base_directory) or good_generation(base_directory)
+    if (
+        source is not None
+        and source != name
+        and not path.lexists(base_directory / name)
+        and path.isfile(base_directory / source / "__confirmed_state__")
+    ):
+        log.info("Cloning generation %s into %s", source, name)
+        with venv.metrics.span("clone"):
+            snapshot.clone_venv(
+                base_directory / source,
+                base_directory / name,
+                exclude=_GENERATION_MARKERS,
+            )
+    generation = _sibling_venv(venv, name)
+    ensure_digest_installed(generation, digest)
+    return generation
+
+
+def activate_generation(venv: Venv, digest: bytes) -> Venv:
+    generation = stage_generation(venv, digest)
+    base_directory = venv.spec.base_directory
+    previous = current_generation(base_directory)
+    if previous != generation.spec.name:
+        log.info("Switching to generation %s", generation.spec.name)
+        _point_current_at(base_directory, generation.spec.name)
+        venv.metrics.increment("generation_switches")
+    # Its mtime orders the generations for pruning
+    with open(generation.spec.venv_dir() / _ACTIVATED_MARKER, "w"):
+        pass
+    keep = set(_recent_generations(base_directory, venv.keep_generations))
+    keep.update({generation.spec.name, previous, good_generation(base_directory)})
+    _prune_generations(base_directory, keep=keep)
+    return generation
+
+
+def _recent_generations(base_directory: pathlib.Path, count: int) -> list[str]:
+    """The `count` most recently activated generations, newest first"""
+    activated = []
+    for entry in os.scandir(base_directory / _GENERATIONS_DIRECTORY):
+        try:
+            when = os.stat(path.join(entry.path, _ACTIVATED_MARKER)).st_mtime_ns
+        except OSError:
+            continue
+        activated.append((when, f"{_GENERATIONS_DIRECTORY}/{entry.name}"))
+    return [name for _, name in sorted(activated, reverse=True)[:count]]
+
+
+def _point_current_at(base_directory: pathlib.Path, name: str) -> None:
+    _point_link(base_directory, _CURRENT_GENERATION_LINK, name)
+
+
+def _point_link(base_directory: pathlib.Path, link_name: str, name: str) -> None:
+    link = base_directory / link_name
+    tmp_link = base_directory / f"{link_name}.tmp"
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+    os.symlink(name, tmp_link)
+    os.replace(tmp_link, link)
+
+
+def _prune_generations(base_directory: pathlib.Path, keep: set[Optional[str]]) -> None:
+    generations_dir = base_directory / _GENERATIONS_DIRECTORY
+    for entry in os.scandir(generations_dir):
+        if f"{_GENERATIONS_DIRECTORY}/{entry.name}" not in keep:
+            log.info("Removing old generation %s", entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
 def maybe_new_requirements_digest(venv: Venv) -> Optional[bytes]:
-    remote_digest = requirements.digest_from_requirements_file(
-        venv.spec.requirements_file
-    )
-    if remote_digest != venv.state.installed_digest:
-        return remote_digest
-    return None
+    # Runs every interval, only the phases that change something log at INFO
+    with venv.metrics.span("check", logging.DEBUG):
+        remote_digest = requirements.digest_from_requirements_file(
+            venv.spec.requirements_file,
+            venv.fetcher,
+            venv.spec.mirrors,
+            venv.spec.mirror_quorum,
+        )
+    if remote_digest == venv.state.installed_digest:
+        return None
+    if remote_digest is not None and is_generation_bad(
+        venv.spec.base_directory, remote_digest
+    ):
+        log.info("Not updating to requirements the program kept crashing with")
+        return None
+    return remote_digest
 
 
-def ensure_digest_installed(venv: Venv, target_digest: bytes) -> None:
+def ensure_digest_installed(venv: Venv, target_digest: Optional[bytes]) -> None:
+    """Install the requirements with `target_digest`, None if they couldn't be read"""
     if target_digest == venv.state.installed_digest:
         return
+    if target_digest is None:
+        raise BaseException(
+            f"Could not read the requirements from {venv.spec.requirements_file}"
+        )
 
     if venv.is_venv_approved_for_digest(target_digest):
         venv.state.installed_digest = target_digest
@@ -233,64 +1095,420 @@ def ensure_digest_installed(venv: Venv, target_digest: bytes) -> None:
     if time_since_last_attempt < _MIN_TIME_BETWEEN_ATTEMPTS:
         time.sleep(_MIN_TIME_BETWEEN_ATTEMPTS - time_since_last_attempt)
     venv.state.when_last_update_attempt = time.time()
+    prefetched = wheelhouse.wheelhouse_dir(venv.spec.base_directory, target_digest)
 
-    log.info("Calculating requirements...")
+    with venv.metrics.span("ensure_digest_installed"):
+        log.info("Calculating requirements...")
 
-    with open(venv.spec.requirements_file, "r") as f:
-        requirements_content = f.read()
+        requirements_content = read_requirements_content(venv, target_digest)
+        with venv.metrics.span("plan"):
+            update_plan = requirements_plan(venv, requirements_content)
 
-    pip_freeze = subprocess.run(
-        [venv.spec.pip_path().absolute(), "freeze"],
-        check=True,
-        capture_output=True,
-        text=True,
-    )
+        log.info(
+            "Remove:\n%s\n\nInstall:\n%s\n\nUpgrade:\n%s",
+            "\n".join(update_plan.remove),
+            "\n".join(update_plan.install),
+            "\n".join(update_plan.upgrade),
+        )
+
+        locked_targets = _locked_targets(venv, requirements_content)
+        with tempfile.TemporaryDirectory() as links_directory:
+            install_options = []
+            rollback_options = None
+            if locked_targets is not None:
+                try:
+                    install_options = _locked_install_options(
+                        venv, update_plan, locked_targets, pathlib.Path(links_directory)
+                    )
+                except lockfile.IncompleteLock:
+                    if venv.lock_mode == "require":
+                        raise
+                    log.warning("Incomplete lockfile, installing it the usual way")
+                    locked_targets = None
+            if locked_targets is not None:
+                log.info("Installing exactly what the lockfile pins")
+                # What was installed before has no hashes to check
+                rollback_options = []
+            elif wheelhouse.is_complete(prefetched) and (
+                requirements.digest_from_content(requirements_content.encode("utf-8"))
+                == target_digest
+            ):
+                log.info("Installing offline from %s", prefetched)
+                install_options = wheelhouse.install_options(prefetched)
+            try:
+                apply_plan(venv, update_plan, install_options, rollback_options)
+            except subprocess.CalledProcessError:
+                # Don't get stuck on a bad wheelhouse, the next attempt goes online
+                wheelhouse.discard(prefetched)
+                raise
+        if not update_plan.is_empty():
+            compile_bytecode(venv)
+        if venv.warm_up_module is not None:
+            warm_up(venv, venv.warm_up_module)
+
+        # Technically we might have just installed something else than this digest
+        # In that case the update will be triggered again, but will be mostly noop
+        venv.state.installed_digest = target_digest
+        venv.state.last_updated_timestamp = time.time()
+        venv.approve_venv()
+        wheelhouse.discard(prefetched)
+        lockfile.evict(venv.hashed_cache_dir(), venv.hashed_cache_budget)
+    venv.metrics.increment("updates")
+
+
+def read_requirements_content(venv: Venv, target_digest: Optional[bytes] = None) -> str:
+    """The requirements file, the copy checked for `target_digest` if it has it
+
+    The check that found `target_digest` already fetched the file, so it is
+    only fetched again if it has changed since.
+    """
+    requirements_data = None
+    if target_digest is not None:
+        requirements_data = requirements.cached_requirements_file(
+            venv.spec.requirements_file,
+            target_digest,
+            venv.fetcher,
+            venv.spec.mirrors,
+        )
+    if requirements_data is None:
+        requirements_data = requirements.read_requirements_file(
+            venv.spec.requirements_file,
+            venv.fetcher,
+            venv.spec.mirrors,
+            venv.spec.mirror_quorum,
+        )
+    if requirements_data is None:
+        raise BaseException(
+            f"Could not read the requirements from {venv.spec.requirements_file}"
+        )
+    return requirements_data.decode("utf-8")
 
-    requirements_to_remove, requirements_to_install = requirements.diff(
-        pip_freeze.stdout, requirements_content
-    )
 
-    log.info(
-        "Remove:\n%s\n\nInstall:\n%s",
-        "\n".join(requirements_to_remove),
-        "\n".join(requirements_to_install),
+def requirements_plan(venv: Venv, requirements_content: str) -> requirements.Plan:
+    update_plan = requirements.plan(
+        installed_requirements(venv), requirements_content, marker_environment(venv)
     )
+    if venv.peer_index is not None and peers.is_reachable(
+        venv.fetcher.session, venv.peer_index
+    ):
+        update_plan.options = peers.index_options(update_plan.options, venv.peer_index)
+    return update_plan
 
-    if requirements_to_remove:
-        # for some items the syntax is a bit different in requirements files so better to do it this way
+
+def apply_plan(
+    venv: Venv,
+    update_plan: requirements.Plan,
+    install_options: list[str],
+    rollback_options: Optional[list[str]] = None,
+) -> None:
+    """Apply an update plan with one pip run for the installs and upgrades, and
+    one more for the removals once that worked
+
+    What was installed before is recorded next to the venv first. If pip fails
+    the venv is put back the way it was as far as possible, by default
+    installing with the same `install_options`.
+    """
+    if update_plan.is_empty():
+        return
+    rollback_file = venv.spec.venv_dir() / _ROLLBACK_RECORD
+    if path.isfile(rollback_file):
+        log.warning("A previous update of %s was interrupted", venv.spec.venv_dir())
+    else:
+        with open(rollback_file, "w") as f:
+            f.write(installed_requirements(venv))
+    approved = venv.approved_digest()
+    # Nothing is approved while the venv is in between two states
+    venv.revoke_approval()
+    try:
+        _run_plan(venv, update_plan, install_options)
+    except subprocess.CalledProcessError:
+        log.exception("Update failed, rolling back...")
+        try:
+            with open(rollback_file, "r") as f:
+                previous_requirements = f.read()
+            _run_plan(
+                venv,
+                requirements.plan(installed_requirements(venv), previous_requirements),
+                install_options if rollback_options is None else rollback_options,
+            )
+        except Exception:
+            log.exception("Rollback failed, the next update will repair the venv")
+        else:
+            os.remove(rollback_file)
+            # Back to what was approved, the program can keep using it
+            if approved is not None and approved == venv.state.installed_digest:
+                venv.approve_venv()
+        raise
+    os.remove(rollback_file)
+
+
+def _run_plan(
+    venv: Venv, update_plan: requirements.Plan, install_options: list[str]
+) -> None:
+    to_install = update_plan.install + update_plan.upgrade
+    if to_install:
+        log.info("Installing new requirements...")
+        # Version changes are upgraded in place by pip, no separate uninstall needed
         with tempfile.TemporaryDirectory() as tmp_dir:
             requirements_file = path.join(tmp_dir, "requirements.txt")
             with open(requirements_file, "w") as f:
-                f.write("\n".join(requirements_to_remove))
+                f.write("\n".join(update_plan.options + to_install))
+            store = venv.wheel_store
+            pip_cache = (
+                None
+                if store is None
+                else store.pip_cache(venv.spec.pip_path(), venv.maintenance_limits)
+            )
+            # Only wheels pip builds now are new, the rest of its cache is not ours
+            known_wheels = (
+                set() if pip_cache is None else wheelstore.built_wheels(pip_cache)
+            )
+            try:
+                with venv.metrics.span("install"):
+                    subprocess.run(
+                        venv.maintenance_limits.wrap(
+                            [
+                                venv.spec.pip_path().absolute(),
+                                "install",
+                                # compile_bytecode does it afterwards, in parallel
+                                "--no-compile",
+                                *install_options,
+                                *([] if store is None else store.install_options()),
+                                "-r",
+                                requirements_file,
+                            ]
+                        ),
+                        check=True,
+                    )
+            finally:
+                if store is not None:
+                    _keep_built_wheels(venv, store, pip_cache, known_wheels)
+
+    # Only once the install worked, so a failed one leaves the venv as it was
+    names = [
+        requirement.name
+        for line in update_plan.remove
+        if (requirement := requirements.parse_line(line)) is not None
+        and requirement.name is not None
+    ]
+    if names:
+        # No longer pinned, but what was just installed may still depend on it
+        needed = _still_needed(venv, names)
+        if needed:
+            log.info("Keeping %s, still needed", ", ".join(sorted(needed)))
+        names = [name for name in names if name not in needed]
+    if names:
+        log.info("Removing old requirements...")
+        with venv.metrics.span("uninstall"):
             subprocess.run(
-                [
-                    venv.spec.pip_path().absolute(),
-                    "uninstall",
-                    "-r",
-                    requirements_file,
-                    "-y",
-                ],
+                venv.maintenance_limits.wrap(
+                    [venv.spec.pip_path().absolute(), "uninstall", "-y", *names]
+                ),
                 check=True,
             )
 
-    log.info("Installing new requirements...")
-    if requirements_to_install:
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            requirements_file = path.join(tmp_dir, "requirements.txt")
-            with open(requirements_file, "w") as f:
-                f.write("\n".join(requirements_to_install))
-            subprocess.run(
+
+def _still_needed(venv: Venv, names: list[str]) -> set[str]:
+    """Which of `names` the distributions that stay installed depend on"""
+    requires = {
+        requirements.canonical_name(name): lines
+        for name, lines in inventory.requires_dist(venv.spec.venv_dir()).items()
+    }
+    environment = marker_environment(venv)
+    waiting = [name for name in requires if name not in names]
+    reached = set(waiting)
+    while waiting:
+        for line in requires.get(waiting.pop(), []):
+            dependency = requirements.parse_line(line)
+            if (
+                dependency is None
+                or dependency.name is None
+                or dependency.name in reached
+            ):
+                continue
+            if dependency.marker is not None and environment is not None:
+                try:
+                    if not markers.evaluate(dependency.marker, environment):
+                        continue
+                except markers.InvalidMarker:
+                    continue
+            reached.add(dependency.name)
+            waiting.append(dependency.name)
+    return reached.intersection(names)
+
+
+def _keep_built_wheels(
+    venv: Venv,
+    store: wheelstore.WheelStore,
+    pip_cache: Optional[pathlib.Path],
+    known_wheels: set[pathlib.Path],
+) -> None:
+    if pip_cache is not None:
+        store.keep_built(pip_cache, known_wheels)
+    store.mark_used(
+        requirement
+        for line in installed_requirements(venv).splitlines()
+        if (requirement := requirements.parse_line(line)) is not None
+    )
+    store.evict()
+
+
+def _locked_targets(
+    venv: Venv, requirements_content: str
+) -> Optional[list[requirements.Requirement]]:
+    """The requirements if they are a complete lockfile and lock mode allows it"""
+    if venv.lock_mode == "off":
+        return None
+    targets, _ = requirements.parse_requirements(
+        requirements_content, marker_environment(venv)
+    )
+    if lockfile.is_locked(targets):
+        return targets
+    if venv.lock_mode == "require":
+        raise BaseException(
+            f"{venv.spec.requirements_file} does not pin every requirement with hashes"
+        )
+    return None
+
+
+def _locked_install_options(
+    venv: Venv,
+    update_plan: requirements.Plan,
+    targets: list[requirements.Requirement],
+    links_directory: pathlib.Path,
+) -> list[str]:
+    with venv.metrics.span("lock"):
+        files = lockfile.fetch(
+            venv.spec.pip_path(),
+            _requirements_to_install(update_plan),
+            update_plan.options,
+            venv.hashed_cache_dir(),
+            limits=venv.maintenance_limits,
+        )
+        lockfile.check_complete(files, targets, marker_environment(venv))
+    lockfile.link_files(files, links_directory)
+    return lockfile.install_options(links_directory, files)
+
+
+def _requirements_to_install(
+    update_plan: requirements.Plan,
+) -> list[requirements.Requirement]:
+    return [
+        requirement
+        for line in update_plan.install + update_plan.upgrade
+        if (requirement := requirements.parse_line(line)) is not None
+    ]
+
+
+def compile_bytecode(venv: Venv) -> None:
+    """Write the .pyc files of everything installed with one process per CPU
+
+    Otherwise the first start after an update would write them, one at a time.
+    """
+    directories = inventory.site_packages_dirs(venv.spec.venv_dir())
+    if not directories:
+        return
+    log.info("Compiling bytecode...")
+    with venv.metrics.span("compile"):
+        result = subprocess.run(
+            venv.maintenance_limits.wrap(
                 [
-                    venv.spec.pip_path().absolute(),
-                    "install",
-                    "-r",
-                    requirements_file,
-                ],
+                    venv.spec.python_path().absolute(),
+                    "-m",
+                    "compileall",
+                    "-q",
+                    "-j",
+                    "0",
+                    *directories,
+                ]
+            ),
+        )
+    if result.returncode != 0:
+        # Packages can ship files that aren't meant to compile, like templates
+        log.warning("Some files in %s could not be compiled", venv.spec.venv_dir())
+
+
+def warm_up(venv: Venv, module: str) -> None:
+    """Import `module` in the venv once so a broken update is never switched to"""
+    log.info("Importing %s in %s...", module, venv.spec.venv_dir())
+    with venv.metrics.span("warm_up"):
+        try:
+            subprocess.run(
+                venv.maintenance_limits.wrap(
+                    [
+                        venv.spec.python_path().absolute(),
+                        "-c",
+                        f"import importlib; importlib.import_module({module!r})",
+                    ]
+                ),
                 check=True,
+                timeout=_WARM_UP_TIMEOUT,
+            )
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            raise BaseException(
+                f"{module} does not import in {venv.spec.venv_dir()}"
+            ) from e
+
+
+def marker_environment(venv: Venv) -> Optional[dict[str, str]]:
+    try:
+        return requirements.interpreter_environment(venv.spec.python_path())
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        log.exception("Could not inspect the venv's interpreter, ignoring markers")
+        return None
+
+
+def installed_requirements(venv: Venv) -> str:
+    installed = inventory.freeze(venv.spec.venv_dir())
+    if installed is not None:
+        return installed
+    log.info("Could not scan %s, falling back to pip freeze", venv.spec.venv_dir())
+    pip_freeze = subprocess.run(
+        venv.maintenance_limits.wrap([venv.spec.pip_path().absolute(), "freeze"]),
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return pip_freeze.stdout
+
+
+def prefetch_update(venv: Venv, target_digest: bytes) -> None:
+    """Download everything needed for `target_digest` so the install can run offline"""
+    requirements_content = read_requirements_content(venv, target_digest)
+    if requirements.digest_from_content(requirements_content.encode("utf-8")) != (
+        target_digest
+    ):
+        raise BaseException("The requirements changed while preparing the update")
+    update_plan = requirements_plan(venv, requirements_content)
+    requirements_to_install = update_plan.install + update_plan.upgrade
+    log.info("Prefetching %s requirements...", len(requirements_to_install))
+    if _locked_targets(venv, requirements_content) is not None:
+        with venv.metrics.span("prefetch"):
+            lockfile.fetch(
+                venv.spec.pip_path(),
+                _requirements_to_install(update_plan),
+                update_plan.options,
+                venv.hashed_cache_dir(),
+                limits=venv.maintenance_limits,
             )
+        return
+    with venv.metrics.span("prefetch"):
+        wheelhouse.prefetch(
+            venv.spec.pip_path(),
+            (
+                update_plan.options + requirements_to_install
+                if requirements_to_install
+                else []
+            ),
+            wheelhouse.wheelhouse_dir(venv.spec.base_directory, target_digest),
+            venv.fetcher,
+            limits=venv.maintenance_limits,
+        )
+
 
-    # Technically we might have just installed something else than this digest
-    # In that case the update will be triggered again, but will be mostly noop
-    venv.state.installed_digest = target_digest
-    venv.state.last_updated_timestamp = time.time()
-    venv.approve_venv()
+def prepare_update(venv: Venv, target_digest: bytes, staged: bool) -> None:
+    """Do as much of the update as possible while the program is still running"""
+    if staged:
+        stage_generation(venv, target_digest)
+    else:
+        prefetch_update(venv, target_digest)
@@ -0,0 +1,240 @@
+import dataclasses
+import logging
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import time
+from types import TracebackType
+from typing import Any, Optional, Type
+
+from autoupdater import handoff
+from autoupdater import watcher as watcher_module
+
+
+log = logging.getLogger(__name__)
+
+
+class Shutdown(Exception):
+    """The supervisor was asked to shut down by a signal"""
+
+
+_SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+_CHILD_EXITED = "child-exited"
+_FILE_CHANGED = "file-changed"
+_SIGNAL = "signal"
+_SHUTDOWN = "shutdown"
+_CHECK_FINISHED = "check-finished"
+_READY = "ready"
+_FALLBACK_POLL_INTERVAL = 1
+
+
+class Clock:
+    """Source of time for the supervisor, can be replaced in tests"""
+
+    def time(self) -> float:
+        return time.time()
+
+    def select(
+        self, selector: selectors.BaseSelector, timeout: Optional[float]
+    ) -> list[tuple[selectors.SelectorKey, int]]:
+        return selector.select(timeout)
+
+
+class ShutdownFlag:
+    """Thread safe flag that can be waited on by a `Waiter`"""
+
+    def __init__(self) -> None:
+        self._read_socket, self._write_socket = socket.socketpair()
+        self._read_socket.setblocking(False)
+        self._is_set = False
+
+    def set(self) -> None:
+        if not self._is_set:
+            self._is_set = True
+            self._write_socket.send(b"x")
+
+    def is_set(self) -> bool:
+        return self._is_set
+
+    def fileno(self) -> int:
+        return self._read_socket.fileno()
+
+
+class Notifier:
+    """Thread safe wakeup for a `Waiter` that stays readable until cleared"""
+
+    def __init__(self) -> None:
+        self._read_socket, self._write_socket = socket.socketpair()
+        self._read_socket.setblocking(False)
+        self._write_socket.setblocking(False)
+
+    def notify(self) -> None:
+        try:
+            self._write_socket.send(b"x")
+        except BlockingIOError:
+            # The buffer is full of earlier notifications, one is enough
+            pass
+
+    def clear(self) -> None:
+        try:
+            while self._read_socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def fileno(self) -> int:
+        return self._read_socket.fileno()
+
+
+@dataclasses.dataclass()
+class Wakeup:
+    child_exited: bool = False
+    file_changed: bool = False
+    shutdown: bool = False
+    check_finished: bool = False
+    ready: bool = False
+
+
+class Waiter:
+    """Block until the child exits, a watched file changes, an update check
+    finishes, the child says it's ready, a shutdown signal arrives or a timeout
+    passes, whatever comes first.
+
+    Child exits are noticed through a pidfd where available and SIGCHLD
+    otherwise. Signals are only handled when used from the main thread.
+    """
+
+    def __init__(
+        self, clock: Optional[Clock] = None, shutdown: Optional[ShutdownFlag] = None
+    ) -> None:
+        self.clock = clock or Clock()
+        self._selector = selectors.DefaultSelector()
+        self._shutdown = shutdown
+        if shutdown is not None:
+            self._selector.register(shutdown, selectors.EVENT_READ, _SHUTDOWN)
+        self._watcher: Optional[watcher_module.FileWatcher] = None
+        self._readiness: Optional[handoff.Readiness] = None
+        self._pidfd: Optional[int] = None
+        self._signal_socket: Optional[socket.socket] = None
+        self._signal_write_socket: Optional[socket.socket] = None
+        self._previous_wakeup_fd = -1
+        self._previous_handlers: dict[int, Any] = {}
+        self._shutdown_requested = False
+
+    def __enter__(self) -> "Waiter":
+        self._install_signal_handlers()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    def watch_process(self, process: subprocess.Popen) -> None:
+        try:
+            self._pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            # Without pidfds the SIGCHLD handler wakes us up instead
+            self._install_handler(signal.SIGCHLD, lambda signum, frame: None)
+            return
+        self._selector.register(self._pidfd, selectors.EVENT_READ, _CHILD_EXITED)
+
+    def watch_file(self, file_watcher: watcher_module.FileWatcher) -> None:
+        self._watcher = file_watcher
+        fd = file_watcher.fileno()
+        if fd is not None:
+            self._selector.register(fd, selectors.EVENT_READ, _FILE_CHANGED)
+
+    def watch_checks(self, notifier: Notifier) -> None:
+        self._selector.register(notifier, selectors.EVENT_READ, _CHECK_FINISHED)
+
+    def watch_readiness(self, readiness: handoff.Readiness) -> None:
+        self._readiness = readiness
+        self._selector.register(readiness, selectors.EVENT_READ, _READY)
+
+    def wait(self, timeout: Optional[float]) -> Wakeup:
+        """Wait for at most `timeout` seconds, or until something happens if None"""
+        polling = self._watcher is not None and self._watcher.fileno() is None
+        if polling:
+            timeout = _at_most(timeout, self._watcher.poll_interval)
+        if self._pidfd is None and self._signal_socket is None:
+            timeout = _at_most(timeout, _FALLBACK_POLL_INTERVAL)
+        wakeup = Wakeup()
+        if timeout is not None:
+            timeout = max(timeout, 0)
+        for key, _ in self.clock.select(self._selector, timeout):
+            if key.data == _CHILD_EXITED:
+                wakeup.child_exited = True
+            elif key.data == _FILE_CHANGED:
+                wakeup.file_changed = self._watcher.wait(0)
+            elif key.data == _CHECK_FINISHED:
+                wakeup.check_finished = True
+            elif key.data == _READY:
+                wakeup.ready = self._readiness.receive()
+            elif key.data == _SIGNAL:
+                self._drain_signals()
+        if polling:
+            wakeup.file_changed = self._watcher.wait(0)
+        wakeup.shutdown = self._shutdown_requested or (
+            self._shutdown is not None and self._shutdown.is_set()
+        )
+        return wakeup
+
+    def close(self) -> None:
+        for signum, handler in self._previous_handlers.items():
+            signal.signal(signum, handler)
+        self._previous_handlers = {}
+        if self._signal_socket is not None:
+            signal.set_wakeup_fd(self._previous_wakeup_fd)
+            self._signal_socket.close()
+            self._signal_write_socket.close()
+            self._signal_socket = None
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+        self._selector.close()
+
+    def _install_signal_handlers(self) -> None:
+        read_socket, write_socket = socket.socketpair()
+        read_socket.setblocking(False)
+        write_socket.setblocking(False)
+        try:
+            self._previous_wakeup_fd = signal.set_wakeup_fd(
+                write_socket.fileno(), warn_on_full_buffer=False
+            )
+        except ValueError:
+            log.debug("Not on the main thread, signals are not handled")
+            read_socket.close()
+            write_socket.close()
+            return
+        self._signal_socket = read_socket
+        self._signal_write_socket = write_socket
+        self._selector.register(read_socket, selectors.EVENT_READ, _SIGNAL)
+        for signum in _SHUTDOWN_SIGNALS:
+            self._install_handler(signum, self._request_shutdown)
+
+    def _install_handler(self, signum: int, handler: Any) -> None:
+        if self._signal_socket is None:
+            return
+        previous = signal.signal(signum, handler)
+        self._previous_handlers.setdefault(signum, previous)
+
+    def _request_shutdown(self, signum: int, frame: Any) -> None:
+        log.info("Received %s", signal.Signals(signum).name)
+        self._shutdown_requested = True
+
+    def _drain_signals(self) -> None:
+        try:
+            while self._signal_socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def _at_most(timeout: Optional[float], limit: float) -> float:
+    return limit if timeout is None else min(timeout, limit)
@@ -0,0 +1,153 @@
+import logging
+import os
+import pathlib
+import shutil
+import socket
+import stat
+import tempfile
+from typing import Sequence
+
+
+log = logging.getLogger(__name__)
+
+
+_UNNAMED = "unknown"
+# Runs in the program's python: moves the sockets to 3, 4, ... like sd_listen_fds(3)
+# expects and sets LISTEN_PID to its own pid, then becomes the program without
+# changing the pid. Popen can't do either, it passes fds under their own numbers.
+_TRAMPOLINE = """\
+import fcntl, os, sys
+fds = [int(fd) for fd in sys.argv[1].split(",")]
+moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, 3 + len(fds)) for fd in fds]
+for fd in fds:
+    os.close(fd)
+for i, fd in enumerate(moved):
+    os.dup2(fd, 3 + i)
+    os.close(fd)
+os.environ["LISTEN_PID"] = str(os.getpid())
+os.execv(sys.argv[2], sys.argv[2:])
+"""
+
+
+class ListeningSockets:
+    """Sockets the supervisor listens on for the program, passed like systemd does
+
+    The sockets stay open while the program restarts or is replaced, so
+    connections wait in the backlog instead of being refused. Programs pick
+    them up with LISTEN_FDS and LISTEN_PID, e.g. with
+    `socket.socket(fileno=3)` or `systemd.daemon.listen_fds()`.
+    """
+
+    def __init__(self, sockets: Sequence[socket.socket], names: Sequence[str]) -> None:
+        self.sockets = list(sockets)
+        self.names = list(names)
+
+    def fds(self) -> list[int]:
+        return [s.fileno() for s in self.sockets]
+
+    def wrap(self, python: pathlib.Path, command: Sequence) -> list:
+        """`command` started by `python` so that it finds the sockets from fd 3 on"""
+        return [
+            python,
+            "-c",
+            _TRAMPOLINE,
+            ",".join(str(fd) for fd in self.fds()),
+            *command,
+        ]
+
+    def environment(self) -> dict[str, str]:
+        environment = {"LISTEN_FDS": str(len(self.sockets))}
+        if any(name != _UNNAMED for name in self.names):
+            environment["LISTEN_FDNAMES"] = ":".join(self.names)
+        return environment
+
+    def close(self) -> None:
+        for s in self.sockets:
+            if s.family == socket.AF_UNIX:
+                try:
+                    os.remove(s.getsockname())
+                except OSError:
+                    pass
+            s.close()
+        self.sockets = []
+
+
+def listen(addresses: Sequence[str]) -> ListeningSockets:
+    """Listen on `addresses` like `8080`, `127.0.0.1:8080`, `[::1]:8080` or
+    `unix:/run/app.sock`, each optionally named like `http=8080`
+    """
+    sockets = []
+    names = []
+    try:
+        for address in addresses:
+            name, _, address = address.rpartition("=")
+            sockets.append(_listen(address))
+            names.append(name or _UNNAMED)
+            log.info("Listening on %s for the program", address)
+    except (OSError, ValueError):
+        for s in sockets:
+            s.close()
+        raise
+    return ListeningSockets(sockets, names)
+
+
+def _listen(address: str) -> socket.socket:
+    if address.startswith("unix:"):
+        socket_path = address[len("unix:") :]
+        # Left behind by an earlier supervisor that was killed
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.bind(socket_path)
+            s.listen()
+        except OSError:
+            s.close()
+            raise
+        return s
+    host, _, port = address.rpartition(":")
+    if not port.isdigit():
+        raise ValueError(f"{address} is not a port, host:port or unix:path")
+    if not host and socket.has_dualstack_ipv6():
+        return socket.create_server(
+            ("", int(port)), family=socket.AF_INET6, dualstack_ipv6=True
+        )
+    if host.startswith("[") and host.endswith("]"):
+        return socket.create_server((host[1:-1], int(port)), family=socket.AF_INET6)
+    return socket.create_server((host, int(port)))
+
+
+class Readiness:
+    """The NOTIFY_SOCKET of one program, it sends READY=1 once it serves
+
+    This is the sd_notify(3) protocol, programs use e.g.
+    `systemd.daemon.notify("READY=1")` or send the datagram themselves.
+    """
+
+    def __init__(self) -> None:
+        self._directory = tempfile.mkdtemp(prefix="autoupdater-notify-")
+        self.path = os.path.join(self._directory, "notify")
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+        self._socket.setblocking(False)
+        self.is_ready = False
+
+    def fileno(self) -> int:
+        return self._socket.fileno()
+
+    def environment(self) -> dict[str, str]:
+        return {"NOTIFY_SOCKET": self.path}
+
+    def receive(self) -> bool:
+        """Read the messages that arrived, True once the program said it's ready"""
+        while True:
+            try:
+                message = self._socket.recv(4096)
+            except OSError:
+                return self.is_ready
+            if "READY=1" in message.decode(errors="replace").splitlines():
+                self.is_ready = True
+
+    def close(self) -> None:
+        self._socket.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
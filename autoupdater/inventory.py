@@ -0,0 +1,140 @@
+import email.parser
+import glob
+import json
+import logging
+import os
+import pathlib
+from os import path
+from typing import Any, Optional
+
+
+log = logging.getLogger(__name__)
+
+
+# Same as what `pip freeze` leaves out unless `--all` is given
+_EXCLUDED = {"pip", "setuptools", "wheel", "distribute"}
+
+_cache: dict[pathlib.Path, tuple[tuple[tuple[str, int], ...], list[str]]] = {}
+
+
+def site_packages_dirs(venv_dir: pathlib.Path) -> list[str]:
+    return sorted(glob.glob(str(venv_dir / "lib" / "python*" / "site-packages")))
+
+
+def freeze(venv_dir: pathlib.Path) -> Optional[str]:
+    """Equivalent of `pip freeze` for the venv, without starting pip
+
+    Installing or removing a distribution always changes the site-packages
+    directory, so results are cached for as long as its mtime stays the same.
+    Returns None if the venv has no site-packages to scan.
+    """
+    directories = site_packages_dirs(venv_dir)
+    if not directories:
+        return None
+    try:
+        key = tuple((d, os.stat(d).st_mtime_ns) for d in directories)
+    except OSError:
+        return None
+    cached = _cache.get(venv_dir)
+    if cached is not None and cached[0] == key:
+        return "\n".join(cached[1])
+    lines = sorted(
+        (line for d in directories for line in _scan(d)), key=lambda l: l.lower()
+    )
+    _cache[venv_dir] = (key, lines)
+    return "\n".join(lines)
+
+
+def requires_dist(venv_dir: pathlib.Path) -> dict[str, list[str]]:
+    """The Requires-Dist lines of every installed distribution, by its name"""
+    requires = {}
+    for site_packages in site_packages_dirs(venv_dir):
+        for entry in os.scandir(site_packages):
+            if not entry.name.endswith(".dist-info"):
+                continue
+            try:
+                with open(path.join(entry.path, "METADATA"), "rb") as f:
+                    metadata = email.parser.BytesParser().parse(f, headersonly=True)
+            except OSError:
+                continue
+            name = metadata.get("Name")
+            if name is not None:
+                requires[name] = metadata.get_all("Requires-Dist") or []
+    return requires
+
+
+def snapshot(venv_dir: pathlib.Path) -> Optional[dict[str, Any]]:
+    """The last scan of the venv in a form that can be stored as JSON"""
+    cached = _cache.get(venv_dir)
+    if cached is None:
+        return None
+    key, lines = cached
+    return {"key": [list(entry) for entry in key], "lines": lines}
+
+
+def restore(venv_dir: pathlib.Path, data: dict[str, Any]) -> None:
+    """Take a stored snapshot as the last scan, it is still checked against mtimes"""
+    try:
+        key = tuple((str(d), int(mtime)) for d, mtime in data["key"])
+        lines = [str(line) for line in data["lines"]]
+    except (KeyError, TypeError, ValueError):
+        log.debug("Ignoring an invalid inventory snapshot of %s", venv_dir)
+        return
+    _cache[venv_dir] = (key, lines)
+
+
+def _scan(site_packages: str) -> list[str]:
+    lines = []
+    for entry in os.scandir(site_packages):
+        if entry.name.endswith(".dist-info"):
+            metadata_file = path.join(entry.path, "METADATA")
+        elif entry.name.endswith(".egg-info"):
+            metadata_file = (
+                path.join(entry.path, "PKG-INFO") if entry.is_dir() else entry.path
+            )
+        else:
+            continue
+        metadata = _read_metadata(metadata_file)
+        name = metadata.get("Name")
+        version = metadata.get("Version")
+        if name is None or version is None:
+            log.debug("Ignoring %s without a name or version", entry.path)
+            continue
+        if name.lower() in _EXCLUDED:
+            continue
+        lines.append(_freeze_line(entry.path, name, version))
+    return lines
+
+
+def _read_metadata(metadata_file: str) -> dict[str, str]:
+    headers = {}
+    try:
+        with open(metadata_file, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    # The body (long description) starts after the first empty line
+                    break
+                key, _, value = line.partition(":")
+                if key in ("Name", "Version"):
+                    headers.setdefault(key, value.strip())
+    except OSError:
+        pass
+    return headers
+
+
+def _freeze_line(dist_path: str, name: str, version: str) -> str:
+    try:
+        with open(path.join(dist_path, "direct_url.json"), "r") as f:
+            direct_url = json.load(f)
+    except (OSError, ValueError):
+        return f"{name}=={version}"
+    url = direct_url.get("url")
+    if url is None:
+        return f"{name}=={version}"
+    if "vcs_info" in direct_url:
+        vcs_info = direct_url["vcs_info"]
+        return f"{name} @ {vcs_info.get('vcs')}+{url}@{vcs_info.get('commit_id')}"
+    archive_hash = direct_url.get("archive_info", {}).get("hash")
+    if archive_hash:
+        return f"{name} @ {url}#{archive_hash}"
+    return f"{name} @ {url}"
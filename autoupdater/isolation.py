@@ -0,0 +1,133 @@
+import dataclasses
+import logging
+import os
+import pathlib
+import shutil
+import threading
+from typing import Optional, Sequence
+
+
+log = logging.getLogger(__name__)
+
+
+_CGROUP_ROOT = pathlib.Path("/sys/fs/cgroup")
+# cgroup v2 only lets a cgroup without processes of its own limit its children,
+# so the supervisor moves into this child of its cgroup first
+_SUPERVISOR_CGROUP = "supervisor"
+_CPU_PERIOD = 100000
+_IO_CLASSES = {"idle": ["-c", "3"], "best-effort": ["-c", "2", "-n", "7"]}
+# Moves the shell into the cgroup whose cgroup.procs is $0, then becomes the command
+_ENTER_CGROUP = 'echo $$ > "$0" && exec "$@"'
+
+
+@dataclasses.dataclass(frozen=True)
+class Limits:
+    """How much of the machine a subprocess may use, None leaves a setting alone
+
+    `nice` is added to the niceness of the supervisor, `io_class` is "idle" or
+    "best-effort" (at the lowest priority), `cpus` the CPUs it may run on.
+    `cpu_quota` (in CPUs, 0.5 is half of one) and `memory_max` (in bytes) are
+    enforced with a cgroup v2 named `cgroup` next to the supervisor, if the
+    supervisor is allowed to create one (e.g. systemd's `Delegate=yes`).
+    """
+
+    nice: Optional[int] = None
+    io_class: Optional[str] = None
+    cpus: Optional[tuple[int, ...]] = None
+    cpu_quota: Optional[float] = None
+    memory_max: Optional[int] = None
+    cgroup: str = "maintenance"
+
+    def prepare(self) -> None:
+        """Set up the cgroup before there are processes that would be in the way"""
+        if self.cpu_quota is not None or self.memory_max is not None:
+            _cgroup(self.cgroup, self.cpu_quota, self.memory_max)
+
+    def wrap(self, command: Sequence) -> list:
+        """`command` started through the tools that apply the limits"""
+        prefix: list = []
+        if self.cpu_quota is not None or self.memory_max is not None:
+            procs_file = _cgroup(self.cgroup, self.cpu_quota, self.memory_max)
+            if procs_file is not None:
+                prefix += ["sh", "-c", _ENTER_CGROUP, str(procs_file)]
+        if self.cpus is not None and _have("taskset"):
+            prefix += ["taskset", "--cpu-list", ",".join(map(str, self.cpus))]
+        if self.io_class is not None and _have("ionice"):
+            prefix += ["ionice", *_IO_CLASSES[self.io_class]]
+        if self.nice is not None and _have("nice"):
+            prefix += ["nice", "-n", str(self.nice)]
+        return prefix + list(command)
+
+
+NO_LIMITS = Limits()
+
+_lock = threading.Lock()
+_missing_tools: set[str] = set()
+_cgroups: dict[tuple[str, Optional[float], Optional[int]], Optional[pathlib.Path]] = {}
+
+
+def _have(tool: str) -> bool:
+    if shutil.which(tool) is not None:
+        return True
+    with _lock:
+        if tool not in _missing_tools:
+            _missing_tools.add(tool)
+            log.warning("%s is not installed, not using it to limit processes", tool)
+    return False
+
+
+def _cgroup(
+    name: str, cpu_quota: Optional[float], memory_max: Optional[int]
+) -> Optional[pathlib.Path]:
+    """The cgroup.procs file of the cgroup `name`, set up once"""
+    key = (name, cpu_quota, memory_max)
+    with _lock:
+        if key not in _cgroups:
+            try:
+                _cgroups[key] = _set_up_cgroup(name, cpu_quota, memory_max)
+            except OSError as e:
+                log.warning("Could not set up the cgroup %s, not limiting: %s", name, e)
+                _cgroups[key] = None
+        return _cgroups[key]
+
+
+def _own_cgroup() -> pathlib.Path:
+    with open("/proc/self/cgroup", "r") as f:
+        for line in f:
+            hierarchy, _, cgroup_path = line.rstrip("\n").split(":", maxsplit=2)
+            if hierarchy == "0":
+                return _CGROUP_ROOT / cgroup_path.lstrip("/")
+    raise OSError("Not running in a cgroup v2 hierarchy")
+
+
+def _set_up_cgroup(
+    name: str, cpu_quota: Optional[float], memory_max: Optional[int]
+) -> pathlib.Path:
+    own = _own_cgroup()
+    # Every cgroup v2 directory has it, it is never created by hand
+    if not (own / "cgroup.controllers").is_file():
+        raise OSError(f"{own} is not a cgroup v2")
+    if own.name == _SUPERVISOR_CGROUP:
+        parent = own.parent
+    else:
+        parent = own
+        os.makedirs(parent / _SUPERVISOR_CGROUP, exist_ok=True)
+        with open(parent / _SUPERVISOR_CGROUP / "cgroup.procs", "w") as f:
+            f.write(str(os.getpid()))
+    controllers = []
+    if cpu_quota is not None:
+        controllers.append("+cpu")
+    if memory_max is not None:
+        controllers.append("+memory")
+    with open(parent / "cgroup.subtree_control", "w") as f:
+        f.write(" ".join(controllers))
+    cgroup = parent / name
+    os.makedirs(cgroup, exist_ok=True)
+    if cpu_quota is not None:
+        with open(cgroup / "cpu.max", "w") as f:
+            f.write(f"{max(1000, int(cpu_quota * _CPU_PERIOD))} {_CPU_PERIOD}")
+    if memory_max is not None:
+        with open(cgroup / "memory.max", "w") as f:
+            f.write(str(memory_max))
+    log.info("Limiting processes with the cgroup %s", cgroup)
+    return cgroup / "cgroup.procs"
@@ -0,0 +1,70 @@
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+from typing import Any, Optional
+
+
+log = logging.getLogger(__name__)
+
+
+_JOURNAL_FILE = "state.json"
+
+
+@dataclasses.dataclass()
+class Entry:
+    """What the supervisor knew about its venv when it last changed"""
+
+    venv_name: str
+    installed_digest: bytes
+    last_updated_timestamp: float = 0
+    when_last_update_attempt: float = 0
+    # inventory.snapshot() of the venv
+    inventory: Optional[dict[str, Any]] = None
+    # The requirements the last update failed to install, if it failed
+    failed_digest: Optional[bytes] = None
+
+
+def journal_file(base_directory: pathlib.Path) -> pathlib.Path:
+    return base_directory / _JOURNAL_FILE
+
+
+def load(base_directory: pathlib.Path) -> Optional[Entry]:
+    try:
+        with open(journal_file(base_directory), "r") as f:
+            data = json.load(f)
+        return Entry(
+            venv_name=data["venv_name"],
+            installed_digest=bytes.fromhex(data["installed_digest"]),
+            last_updated_timestamp=data.get("last_updated_timestamp", 0),
+            when_last_update_attempt=data.get("when_last_update_attempt", 0),
+            inventory=data.get("inventory"),
+            failed_digest=(
+                bytes.fromhex(data["failed_digest"])
+                if data.get("failed_digest")
+                else None
+            ),
+        )
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log.warning("Ignoring the unreadable %s: %s", journal_file(base_directory), e)
+        return None
+
+
+def save(base_directory: pathlib.Path, entry: Entry) -> None:
+    """Replace the journal, it is either the old or the new one after a power cut"""
+    file_path = journal_file(base_directory)
+    tmp_file = file_path.with_name(file_path.name + ".tmp")
+    data = dataclasses.asdict(entry)
+    data["installed_digest"] = entry.installed_digest.hex()
+    data["failed_digest"] = entry.failed_digest.hex() if entry.failed_digest else None
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file_path)
+    except OSError:
+        log.exception("Could not write %s", file_path)
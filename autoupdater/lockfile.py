@@ -0,0 +1,242 @@
+import email.parser
+import hashlib
+import logging
+import os
+import pathlib
+import subprocess
+import tempfile
+import time
+import zipfile
+from os import path
+from typing import Iterator, Optional, Sequence
+
+from autoupdater import isolation, markers, requirements
+
+
+log = logging.getLogger(__name__)
+
+
+class IncompleteLock(Exception):
+    pass
+
+
+DEFAULT_BUDGET = 1024 * 1024 * 1024
+_HASHED_DIRECTORY = "hashed"
+# Never part of a lockfile, but always there in a venv
+_ALWAYS_INSTALLED = {"pip", "setuptools", "wheel"}
+
+
+def cache_dir(base_directory: pathlib.Path) -> pathlib.Path:
+    return base_directory / _HASHED_DIRECTORY
+
+
+def is_locked(targets: list[requirements.Requirement]) -> bool:
+    """Whether every requirement is pinned to one version and has hashes"""
+    return bool(targets) and all(
+        target.name is not None
+        and target.version is not None
+        and target.hashes
+        and not target.editable
+        for target in targets
+    )
+
+
+def cached_file(
+    directory: pathlib.Path, target: requirements.Requirement
+) -> Optional[pathlib.Path]:
+    """A file in the cache that matches one of the target's hashes"""
+    for algorithm, _, digest in (h.partition(":") for h in target.hashes):
+        if algorithm != "sha256":
+            continue
+        try:
+            file_names = os.listdir(directory / digest)
+        except OSError:
+            continue
+        if file_names:
+            return directory / digest / file_names[0]
+    return None
+
+
+def fetch(
+    pip_path: pathlib.Path,
+    targets: list[requirements.Requirement],
+    options: list[str],
+    directory: pathlib.Path,
+    limits: isolation.Limits = isolation.NO_LIMITS,
+) -> list[pathlib.Path]:
+    """Make sure a file matching the hashes of every target is in the cache
+
+    Files are stored by their sha256 so each version is only ever downloaded
+    once. Returns the files in the order of `targets`.
+    """
+    missing = [target for target in targets if cached_file(directory, target) is None]
+    if missing:
+        log.info("Downloading %s locked distributions...", len(missing))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            requirements_file = path.join(tmp_dir, "requirements.txt")
+            with open(requirements_file, "w") as f:
+                f.write("\n".join(options + [target.line for target in missing]))
+            download_dir = path.join(tmp_dir, "downloads")
+            subprocess.run(
+                limits.wrap(
+                    [
+                        pip_path.absolute(),
+                        "download",
+                        "--no-deps",
+                        "--require-hashes",
+                        "--dest",
+                        download_dir,
+                        "-r",
+                        requirements_file,
+                    ]
+                ),
+                check=True,
+            )
+            for file_name in os.listdir(download_dir):
+                _store(directory, pathlib.Path(download_dir) / file_name)
+
+    files = []
+    now = time.time()
+    for target in targets:
+        cached = cached_file(directory, target)
+        if cached is None:
+            raise IncompleteLock(f"Nothing matches the hashes of {target.line!r}")
+        # The modification time tells `evict` when the file was last needed
+        os.utime(cached, (now, now))
+        files.append(cached)
+    return files
+
+
+def evict(directory: pathlib.Path, budget: int) -> None:
+    """Remove the least recently used files until the cache fits `budget` bytes"""
+    files = []
+    for digest_dir in _subdirectories(directory):
+        for file_name in _file_names(digest_dir):
+            file_path = digest_dir / file_name
+            try:
+                stat = file_path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, file_name, stat.st_size, file_path))
+    total = sum(size for _, _, size, _ in files)
+    for _, _, size, file_path in sorted(files):
+        if total <= budget:
+            break
+        log.info("Removing the least recently used file %s", file_path.name)
+        try:
+            os.remove(file_path)
+            # Still in use if a download into it is under way
+            os.rmdir(file_path.parent)
+        except OSError:
+            pass
+        total -= size
+
+
+def _subdirectories(directory: pathlib.Path) -> list[pathlib.Path]:
+    try:
+        return [directory / name for name in os.listdir(directory)]
+    except OSError:
+        return []
+
+
+def _file_names(directory: pathlib.Path) -> list[str]:
+    try:
+        return [name for name in os.listdir(directory) if not name.startswith(".")]
+    except OSError:
+        return []
+
+
+def _store(directory: pathlib.Path, file_path: pathlib.Path) -> None:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            sha256.update(chunk)
+    destination = directory / sha256.hexdigest()
+    os.makedirs(destination, exist_ok=True)
+    os.replace(file_path, destination / file_path.name)
+
+
+def check_complete(
+    files: list[pathlib.Path],
+    targets: list[requirements.Requirement],
+    environment: Optional[dict[str, str]],
+) -> None:
+    """Raise if a wheel in `files` depends on something `targets` doesn't pin"""
+    pinned = {target.name: target.version for target in targets}
+    problems = []
+    for file_path in files:
+        if file_path.suffix != ".whl":
+            log.debug("Can't check the dependencies of %s", file_path.name)
+            continue
+        for dependency in _requires_dist(file_path):
+            if dependency.marker is not None and environment is not None:
+                try:
+                    if not markers.evaluate(dependency.marker, environment):
+                        continue
+                except markers.InvalidMarker:
+                    continue
+            if dependency.name is None or dependency.name in _ALWAYS_INSTALLED:
+                continue
+            if dependency.name not in pinned:
+                problems.append(f"{dependency.name} (needed by {file_path.name})")
+            elif (
+                dependency.specifier
+                and markers.version_matches(
+                    pinned[dependency.name], dependency.specifier
+                )
+                is False
+            ):
+                problems.append(
+                    f"{dependency.name}{dependency.specifier} (needed by"
+                    f" {file_path.name}, {pinned[dependency.name]} is pinned)"
+                )
+    if problems:
+        raise IncompleteLock("The lockfile is missing " + ", ".join(problems))
+
+
+def _requires_dist(wheel: pathlib.Path) -> Iterator[requirements.Requirement]:
+    with zipfile.ZipFile(wheel) as archive:
+        metadata_files = [
+            name
+            for name in archive.namelist()
+            if name.count("/") == 1 and name.endswith(".dist-info/METADATA")
+        ]
+        if not metadata_files:
+            return
+        metadata = email.parser.BytesParser().parsebytes(
+            archive.read(metadata_files[0]), headersonly=True
+        )
+    for value in metadata.get_all("Requires-Dist") or []:
+        requirement = requirements.parse_line(value)
+        if requirement is not None:
+            yield requirement
+
+
+def install_options(
+    links_directory: pathlib.Path, files: Sequence[pathlib.Path] = ()
+) -> list[str]:
+    """Install exactly the pinned files, without resolving or looking at an index
+
+    Building one of `files` from source needs its build dependencies, pip gets
+    them from the index of the requirements file then. The pinned files
+    themselves are still checked against their hashes.
+    """
+    sdists = [file_path.name for file_path in files if file_path.suffix != ".whl"]
+    if sdists:
+        log.info("Building %s, so the index stays enabled", ", ".join(sdists))
+    return [
+        "--no-deps",
+        "--require-hashes",
+        *([] if sdists else ["--no-index"]),
+        "--find-links",
+        str(links_directory),
+    ]
+
+
+def link_files(files: list[pathlib.Path], links_directory: pathlib.Path) -> None:
+    """Put `files` next to each other so pip can find them with --find-links"""
+    os.makedirs(links_directory, exist_ok=True)
+    for file_path in files:
+        link = links_directory / file_path.name
+        if not path.lexists(link):
+            os.symlink(file_path.absolute(), link)
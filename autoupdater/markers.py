@@ -0,0 +1,262 @@
+import math
+import re
+from typing import Optional
+
+
+# Just enough of PEP 440 and PEP 508 to compare pinned requirements. This is not
+# a full implementation, versions that can't be understood are reported as such
+# so the caller can leave the decision to pip.
+
+
+class InvalidMarker(Exception):
+    pass
+
+
+_VERSION = re.compile(
+    r"""
+    ^\s*v?
+    (?:(?P<epoch>\d+)!)?
+    (?P<release>\d+(?:\.\d+)*)
+    (?:[-_.]?(?P<pre_l>a|alpha|b|beta|c|rc|pre|preview)[-_.]?(?P<pre_n>\d*))?
+    (?:(?:-(?P<post_n1>\d+))|(?:[-_.]?(?:post|rev|r)[-_.]?(?P<post_n2>\d*)))?
+    (?:[-_.]?dev[-_.]?(?P<dev_n>\d*))?
+    (?:\+[a-z0-9]+(?:[-_.][a-z0-9]+)*)?
+    \s*$
+    """,
+    re.VERBOSE | re.IGNORECASE,
+)
+_PRE_RELEASE_ORDER = {"a": 0, "alpha": 0, "b": 1, "beta": 1}
+
+VersionKey = tuple
+
+
+def version_key(version: str) -> Optional[VersionKey]:
+    match = _VERSION.match(version)
+    if match is None:
+        return None
+    release = [int(part) for part in match["release"].split(".")]
+    while len(release) > 1 and release[-1] == 0:
+        release.pop()
+    if match["pre_l"]:
+        pre = (
+            _PRE_RELEASE_ORDER.get(match["pre_l"].lower(), 2),
+            int(match["pre_n"] or 0),
+        )
+    else:
+        pre = (math.inf, 0)
+    post_n = match["post_n1"] or match["post_n2"]
+    post_given = match["post_n1"] is not None or match["post_n2"] is not None
+    post = int(post_n or 0) if post_given else -1
+    dev = int(match["dev_n"] or 0) if match["dev_n"] is not None else math.inf
+    if match["pre_l"] is None and post == -1 and dev != math.inf:
+        # 1.0.dev0 comes before 1.0a0
+        pre = (-1, 0)
+    return (int(match["epoch"] or 0), tuple(release), pre, post, dev)
+
+
+def _release(version: str) -> Optional[list[int]]:
+    match = _VERSION.match(version)
+    if match is None:
+        return None
+    return [int(part) for part in match["release"].split(".")]
+
+
+def _matches_one(version: str, operator: str, other: str) -> Optional[bool]:
+    if operator == "===":
+        return version.strip().lower() == other.strip().lower()
+    if operator in ("==", "!=") and other.endswith(".*"):
+        release = _release(version)
+        prefix = _release(other[:-2])
+        if release is None or prefix is None:
+            return None
+        release += [0] * (len(prefix) - len(release))
+        matches = release[: len(prefix)] == prefix
+        return matches if operator == "==" else not matches
+    key = version_key(version)
+    other_key = version_key(other)
+    if key is None or other_key is None:
+        return None
+    if operator == "==":
+        return key == other_key
+    if operator == "!=":
+        return key != other_key
+    if operator == ">=":
+        return key >= other_key
+    if operator == "<=":
+        return key <= other_key
+    if operator == ">":
+        return key > other_key
+    if operator == "<":
+        return key < other_key
+    if operator == "~=":
+        prefix = _release(other)
+        if prefix is None or len(prefix) < 2:
+            return None
+        return key >= other_key and bool(
+            _matches_one(version, "==", ".".join(str(p) for p in prefix[:-1]) + ".*")
+        )
+    return None
+
+
+_SPECIFIER = re.compile(r"^\s*(===|==|!=|<=|>=|~=|<|>)\s*(\S+)\s*$")
+
+
+def version_matches(version: str, specifiers: str) -> Optional[bool]:
+    """Whether `version` satisfies e.g. `>=1.0,<2`, None if that can't be told"""
+    result = True
+    for specifier in specifiers.split(","):
+        if not specifier.strip():
+            continue
+        match = _SPECIFIER.match(specifier)
+        if match is None:
+            return None
+        matches = _matches_one(version, match[1], match[2])
+        if matches is None:
+            return None
+        result = result and matches
+    return result
+
+
+_MARKER_TOKEN = re.compile(
+    r"""
+    \s*(?:
+        (?P<string>'[^']*'|"[^"]*")
+        |(?P<operator>===|==|!=|<=|>=|~=|<|>|not\s+in\b|in\b)
+        |(?P<boolean>and\b|or\b)
+        |(?P<paren>[()])
+        |(?P<variable>[A-Za-z_][A-Za-z0-9_.]*)
+    )
+    """,
+    re.VERBOSE,
+)
+_VERSION_VARIABLES = {"python_version", "python_full_version", "implementation_version"}
+
+Token = tuple[str, str]
+
+
+def _tokenize(marker: str) -> list[Token]:
+    tokens = []
+    position = 0
+    marker = marker.strip()
+    while position < len(marker):
+        match = _MARKER_TOKEN.match(marker, position)
+        if match is None or match.end() == position:
+            raise InvalidMarker(f"Unexpected input at {marker[position:]!r}")
+        kind = match.lastgroup
+        value = match[kind]
+        if kind == "operator":
+            value = " ".join(value.split())
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class _MarkerParser:
+    def __init__(self, tokens: list[Token], environment: dict[str, str]) -> None:
+        self.tokens = tokens
+        self.position = 0
+        self.environment = environment
+
+    def parse(self) -> bool:
+        result = self._or()
+        if self.position != len(self.tokens):
+            raise InvalidMarker(f"Unexpected {self.tokens[self.position][1]!r}")
+        return result
+
+    def _peek(self) -> Optional[Token]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _next(self) -> Token:
+        token = self._peek()
+        if token is None:
+            raise InvalidMarker("Unexpected end of marker")
+        self.position += 1
+        return token
+
+    def _or(self) -> bool:
+        result = self._and()
+        while self._peek() == ("boolean", "or"):
+            self._next()
+            # Evaluate both sides so syntax errors are always found
+            right = self._and()
+            result = result or right
+        return result
+
+    def _and(self) -> bool:
+        result = self._atom()
+        while self._peek() == ("boolean", "and"):
+            self._next()
+            right = self._atom()
+            result = result and right
+        return result
+
+    def _atom(self) -> bool:
+        if self._peek() == ("paren", "("):
+            self._next()
+            result = self._or()
+            if self._next() != ("paren", ")"):
+                raise InvalidMarker("Missing ')'")
+            return result
+        left_kind, left = self._value()
+        kind, operator = self._next()
+        if kind != "operator":
+            raise InvalidMarker(f"Expected an operator, got {operator!r}")
+        right_kind, right = self._value()
+        variable = left_kind if left_kind in _VERSION_VARIABLES else right_kind
+        return _compare(left, operator, right, variable in _VERSION_VARIABLES)
+
+    def _value(self) -> tuple[str, str]:
+        kind, value = self._next()
+        if kind == "string":
+            return "string", value[1:-1]
+        if kind == "variable":
+            if value not in self.environment:
+                raise InvalidMarker(f"Unknown variable {value!r}")
+            return value, self.environment[value]
+        raise InvalidMarker(f"Expected a value, got {value!r}")
+
+
+def _compare(left: str, operator: str, right: str, is_version: bool) -> bool:
+    if operator == "in":
+        return left in right
+    if operator == "not in":
+        return left not in right
+    if is_version:
+        result = _matches_one(left, operator, right)
+        if result is not None:
+            return result
+    if operator in ("==", "==="):
+        return left == right
+    if operator == "!=":
+        return left != right
+    raise InvalidMarker(f"Can't compare {left!r} {operator} {right!r}")
+
+
+def evaluate(marker: str, environment: dict[str, str]) -> bool:
+    """Evaluate a PEP 508 environment marker like `python_version >= "3.11"`"""
+    return _MarkerParser(_tokenize(marker), {"extra": "", **environment}).parse()
+
+
+# Run with the venv's interpreter to get the environment markers are evaluated in
+ENVIRONMENT_SCRIPT = """
+import json, os, platform, sys
+info = sys.implementation.version
+version = "{0.major}.{0.minor}.{0.micro}".format(info)
+if info.releaselevel != "final":
+    version += info.releaselevel[0] + str(info.serial)
+print(json.dumps({
+    "implementation_name": sys.implementation.name,
+    "implementation_version": version,
+    "os_name": os.name,
+    "platform_machine": platform.machine(),
+    "platform_release": platform.release(),
+    "platform_system": platform.system(),
+    "platform_version": platform.version(),
+    "python_full_version": platform.python_version(),
+    "platform_python_implementation": platform.python_implementation(),
+    "python_version": ".".join(platform.python_version_tuple()[:2]),
+    "sys_platform": sys.platform,
+}))
+"""
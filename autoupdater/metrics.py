@@ -0,0 +1,218 @@
+import contextlib
+import dataclasses
+import http.server
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Iterator, Optional
+
+
+log = logging.getLogger(__name__)
+
+# The status file is rewritten at most this often, `flush` writes it right away
+STATUS_INTERVAL = 10
+
+
+@dataclasses.dataclass()
+class Phase:
+    count: int = 0
+    total_seconds: float = 0
+    last_seconds: float = 0
+    last_finished: float = 0
+    failures: int = 0
+
+
+class Metrics:
+    """Timings of the phases of an update and counters of what happened
+
+    If a `status_file` is given it is atomically rewritten when something
+    changes, at most every `status_interval` seconds and on `flush`.
+    Registered metrics are exposed by `serve`.
+    """
+
+    def __init__(
+        self,
+        labels: Optional[dict[str, str]] = None,
+        status_file: Optional[pathlib.Path] = None,
+        status_interval: float = STATUS_INTERVAL,
+    ) -> None:
+        self.labels = labels or {}
+        self.status_file = status_file
+        self.status_interval = status_interval
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._phases: dict[str, Phase] = {}
+        self._counters: dict[str, float] = {}
+        self._gauges: dict[str, float] = {}
+        self._info: dict[str, str] = {}
+        self._changed = False
+        self._last_written: Optional[float] = None
+
+    @contextlib.contextmanager
+    def span(self, name: str, level: int = logging.INFO) -> Iterator[None]:
+        """Time a phase, routine ones log at a lower `level` (failures at INFO)"""
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            log.log(
+                max(level, logging.INFO) if failed else level,
+                "Phase %s %s after %.3fs",
+                name,
+                "failed" if failed else "finished",
+                duration,
+            )
+            with self._lock:
+                phase = self._phases.setdefault(name, Phase())
+                phase.count += 1
+                phase.total_seconds += duration
+                phase.last_seconds = duration
+                phase.last_finished = time.time()
+                if failed:
+                    phase.failures += 1
+            self._write_if_due()
+
+    def increment(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+        self._write_if_due()
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+        self._write_if_due()
+
+    def set_info(self, name: str, value: str) -> None:
+        with self._lock:
+            self._info[name] = value
+        self._write_if_due()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "labels": dict(self.labels),
+                "updated": time.time(),
+                "phases": {
+                    name: dataclasses.asdict(phase)
+                    for name, phase in self._phases.items()
+                },
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "info": dict(self._info),
+            }
+
+    def flush(self) -> None:
+        """Write the status file now if anything changed since it was written"""
+        with self._lock:
+            changed = self._changed
+        if changed:
+            self.write_status()
+
+    def _write_if_due(self) -> None:
+        with self._lock:
+            self._changed = True
+            due = (
+                self._last_written is None
+                or time.monotonic() - self._last_written >= self.status_interval
+            )
+        if due:
+            self.write_status()
+
+    def write_status(self) -> None:
+        if self.status_file is None:
+            return
+        with self._lock:
+            self._changed = False
+            self._last_written = time.monotonic()
+        tmp_file = self.status_file.with_name(self.status_file.name + ".tmp")
+        with self._write_lock:
+            try:
+                with open(tmp_file, "w") as f:
+                    json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+                os.replace(tmp_file, self.status_file)
+            except OSError:
+                log.exception("Could not write %s", self.status_file)
+
+
+_registry: list[Metrics] = []
+
+
+def register(metrics: Metrics) -> Metrics:
+    _registry.append(metrics)
+    return metrics
+
+
+def _labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in sorted(labels.items())
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def prometheus_text(registry: Optional[list[Metrics]] = None) -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    samples: dict[str, list[str]] = {}
+    types: dict[str, str] = {}
+
+    def add(name: str, kind: str, labels: dict[str, str], value: float) -> None:
+        metric = f"autoupdater_{name}"
+        types[metric] = kind
+        samples.setdefault(metric, []).append(f"{metric}{_labels(labels)} {value}")
+
+    for metrics in _registry if registry is None else registry:
+        snapshot = metrics.snapshot()
+        labels = snapshot["labels"]
+        for name, value in snapshot["counters"].items():
+            add(f"{name}_total", "counter", labels, value)
+        for name, value in snapshot["gauges"].items():
+            add(name, "gauge", labels, value)
+        if snapshot["info"]:
+            add("info", "gauge", {**labels, **snapshot["info"]}, 1)
+        for name, phase in snapshot["phases"].items():
+            phase_labels = {**labels, "phase": name}
+            add("phase_runs_total", "counter", phase_labels, phase["count"])
+            add("phase_failures_total", "counter", phase_labels, phase["failures"])
+            add("phase_seconds_total", "counter", phase_labels, phase["total_seconds"])
+            add("phase_last_seconds", "gauge", phase_labels, phase["last_seconds"])
+
+    lines = []
+    for metric, metric_samples in samples.items():
+        lines.append(f"# TYPE {metric} {types[metric]}")
+        lines.extend(metric_samples)
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        log.debug(format, *args)
+
+
+def serve(port: int, host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+    """Serve the registered metrics on http://host:port/metrics in the background"""
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Serving metrics on http://%s:%s/metrics", host, server.server_address[1])
+    return server
@@ -0,0 +1,363 @@
+import html
+import html.parser
+import http.server
+import logging
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+import threading
+import urllib.parse
+from typing import Iterator, Optional
+
+import requests
+
+from autoupdater import lockfile, requirements, wheelhouse, wheelstore
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_UPSTREAM = "https://pypi.org/simple/"
+DEFAULT_PORT = 8765
+# A peer that doesn't answer this quickly is treated as gone
+_PEER_TIMEOUT = 2
+_UPSTREAM_TIMEOUT = 30
+_INDEX_OPTION = re.compile(r"^(?:-i|--index-url)[=\s]\s*(\S+)$")
+# Attributes of upstream links that pip looks at and that stay true for our copy
+_KEPT_ATTRIBUTES = ("data-requires-python", "data-yanked")
+# Where the services of a config share their downloads, see `core.run_many`
+_SHARED_DIRECTORY = "cache"
+
+
+class _LinkParser(html.parser.HTMLParser):
+    def __init__(self) -> None:
+        super().__init__()
+        self.links: list[dict[str, Optional[str]]] = []
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag == "a":
+            self.links.append(dict(attrs))
+
+
+class PeerCache:
+    """The distributions of one device, as a PEP 503 simple index for its peers
+
+    Files are taken from the prefetched wheelhouses, the hash addressed cache
+    and the built wheels under `base_directory`, and the ones the services of
+    a config share in its cache directory. Projects are also looked up on `upstream`,
+    and files only found there are downloaded into the cache the first time a
+    peer asks for them, so a site needs each file from upstream only once.
+    """
+
+    def __init__(
+        self,
+        base_directory: pathlib.Path,
+        upstream: Optional[str] = DEFAULT_UPSTREAM,
+        fetcher: Optional[requirements.Fetcher] = None,
+    ) -> None:
+        self.base_directory = base_directory
+        self.upstream = upstream.rstrip("/") + "/" if upstream else None
+        self.fetcher = fetcher or requirements.Fetcher()
+        self._upstream_urls: dict[tuple[str, str], str] = {}
+        self._hashes: dict[tuple[pathlib.Path, float, int], str] = {}
+        self._lock = threading.Lock()
+
+    def local_files(self) -> Iterator[tuple[str, pathlib.Path]]:
+        """Every distribution this device has, with its sha256"""
+        shared = self.base_directory / _SHARED_DIRECTORY
+        for store in [
+            lockfile.cache_dir(self.base_directory),
+            lockfile.cache_dir(shared),
+        ]:
+            for digest_dir in _subdirectories(store):
+                for file_name in _file_names(digest_dir):
+                    yield digest_dir.name, digest_dir / file_name
+        for directory in [
+            *_subdirectories(wheelhouse.root_dir(self.base_directory)),
+            wheelstore.store_dir(self.base_directory),
+            wheelstore.store_dir(shared),
+        ]:
+            for file_name in _file_names(directory):
+                file_path = directory / file_name
+                digest = self._sha256(file_path)
+                if digest is not None:
+                    yield digest, file_path
+
+    def projects(self) -> list[str]:
+        names = set()
+        for _, file_path in self.local_files():
+            name = _project_name(file_path.name)
+            if name is not None:
+                names.add(name)
+        return sorted(names)
+
+    def project_links(self, project: str) -> dict[str, tuple[str, dict[str, str]]]:
+        """File name -> (sha256, extra link attributes) of everything for `project`"""
+        project = requirements.canonical_name(project)
+        links: dict[str, tuple[str, dict[str, str]]] = {}
+        for digest, file_path in self.local_files():
+            if _project_name(file_path.name) == project:
+                links[file_path.name] = (digest, {})
+        for file_name, digest, url, attributes in self._upstream_links(project):
+            with self._lock:
+                self._upstream_urls[(digest, file_name)] = url
+            links.setdefault(file_name, (digest, attributes))
+        return links
+
+    def file(self, digest: str, file_name: str) -> Optional[pathlib.Path]:
+        """The file to send for a link, fetched from upstream if need be"""
+        for local_digest, file_path in self.local_files():
+            if local_digest == digest and file_path.name == file_name:
+                return file_path
+        with self._lock:
+            url = self._upstream_urls.get((digest, file_name))
+        if url is None:
+            return None
+        destination = lockfile.cache_dir(self.base_directory) / digest
+        os.makedirs(destination, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=destination, prefix=".", delete=False
+        ) as f:
+            partial = pathlib.Path(f.name)
+        try:
+            actual = self.fetcher.download(url, partial)
+            if actual != digest:
+                log.warning("%s does not match its sha256, not serving it", url)
+                return None
+            os.replace(partial, destination / file_name)
+        except requests.RequestException as e:
+            log.warning("Could not download %s: %s", url, e)
+            return None
+        finally:
+            if os.path.lexists(partial):
+                os.remove(partial)
+        log.info("Cached %s for peers", file_name)
+        return destination / file_name
+
+    def _upstream_links(
+        self, project: str
+    ) -> Iterator[tuple[str, str, str, dict[str, str]]]:
+        if self.upstream is None:
+            return
+        page_url = f"{self.upstream}{project}/"
+        try:
+            response = self.fetcher.session.get(
+                page_url,
+                headers={"Accept": "text/html"},
+                timeout=_UPSTREAM_TIMEOUT,
+            )
+        except requests.RequestException as e:
+            log.info("Could not reach %s: %s", page_url, e)
+            return
+        if response.status_code != 200:
+            return
+        parser = _LinkParser()
+        parser.feed(response.text)
+        for attributes in parser.links:
+            href = attributes.get("href")
+            if not href:
+                continue
+            url, _, fragment = urllib.parse.urljoin(response.url, href).partition("#")
+            digest = dict(part.partition("=")[::2] for part in fragment.split("&")).get(
+                "sha256"
+            )
+            if not digest:
+                # Without a hash the file couldn't be stored by its sha256
+                continue
+            file_name = urllib.parse.unquote(url.rsplit("/", maxsplit=1)[-1])
+            yield file_name, digest, url, {
+                name: value
+                for name, value in attributes.items()
+                if name in _KEPT_ATTRIBUTES and value is not None
+            }
+
+    def _sha256(self, file_path: pathlib.Path) -> Optional[str]:
+        try:
+            stat = file_path.stat()
+        except OSError:
+            return None
+        key = (file_path, stat.st_mtime, stat.st_size)
+        with self._lock:
+            digest = self._hashes.get(key)
+        if digest is None:
+            digest = wheelhouse.file_sha256(file_path)
+            with self._lock:
+                self._hashes[key] = digest
+        return digest
+
+
+def _subdirectories(directory: pathlib.Path) -> list[pathlib.Path]:
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return []
+    return [
+        directory / entry
+        for entry in sorted(entries)
+        if not entry.startswith(".") and os.path.isdir(directory / entry)
+    ]
+
+
+def _file_names(directory: pathlib.Path) -> list[str]:
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return []
+    return [
+        entry
+        for entry in sorted(entries)
+        if not entry.startswith(".") and _project_name(entry) is not None
+    ]
+
+
+def _project_name(file_name: str) -> Optional[str]:
+    name, _ = requirements.name_and_version_from_url(file_name)
+    return requirements.canonical_name(name) if name else None
+
+
+def _page(title: str, links: list[tuple[str, str, dict[str, str]]]) -> bytes:
+    lines = [
+        "<!DOCTYPE html>",
+        "<html>",
+        f"<head><title>{html.escape(title)}</title></head>",
+        "<body>",
+    ]
+    for href, text, attributes in links:
+        extra = "".join(
+            f' {name}="{html.escape(value)}"' for name, value in attributes.items()
+        )
+        lines.append(
+            f'<a href="{html.escape(href)}"{extra}>{html.escape(text)}</a><br/>'
+        )
+    lines += ["</body>", "</html>", ""]
+    return "\n".join(lines).encode("utf-8")
+
+
+class _IndexHandler(http.server.BaseHTTPRequestHandler):
+    server: "_IndexServer"
+
+    def do_GET(self) -> None:
+        cache = self.server.cache
+        parts = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+        if parts == ["simple"]:
+            self._send_page(
+                _page(
+                    "Simple index",
+                    [(f"/simple/{name}/", name, {}) for name in cache.projects()],
+                )
+            )
+        elif len(parts) == 2 and parts[0] == "simple":
+            project = requirements.canonical_name(parts[1])
+            if parts[1] != project or not self.path.endswith("/"):
+                self._redirect(f"/simple/{project}/")
+                return
+            links = cache.project_links(project)
+            if not links:
+                self.send_error(404)
+                return
+            self._send_page(
+                _page(
+                    f"Links for {project}",
+                    [
+                        (
+                            f"/files/{digest}/{urllib.parse.quote(file_name)}"
+                            f"#sha256={digest}",
+                            file_name,
+                            attributes,
+                        )
+                        for file_name, (digest, attributes) in sorted(links.items())
+                    ],
+                )
+            )
+        elif len(parts) == 3 and parts[0] == "files":
+            file_path = cache.file(parts[1], urllib.parse.unquote(parts[2]))
+            if file_path is None:
+                self.send_error(404)
+                return
+            self._send_file(file_path)
+        else:
+            self.send_error(404)
+
+    def _send_page(self, body: bytes) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, file_path: pathlib.Path) -> None:
+        try:
+            f = open(file_path, "rb")
+        except OSError:
+            self.send_error(404)
+            return
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def _redirect(self, location: str) -> None:
+        self.send_response(301)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format: str, *args: object) -> None:
+        log.debug(format, *args)
+
+
+class _IndexServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], cache: PeerCache) -> None:
+        super().__init__(address, _IndexHandler)
+        self.cache = cache
+
+
+def serve(
+    cache: PeerCache, port: int = DEFAULT_PORT, host: str = "0.0.0.0"
+) -> http.server.ThreadingHTTPServer:
+    """Serve `cache` on http://host:port/simple/ in the background"""
+    server = _IndexServer((host, port), cache)
+    threading.Thread(
+        target=server.serve_forever, name="serve-cache", daemon=True
+    ).start()
+    log.info(
+        "Serving the cache on http://%s:%s/simple/", host, server.server_address[1]
+    )
+    return server
+
+
+def is_reachable(session: requests.Session, peer_index: str) -> bool:
+    try:
+        response = session.get(peer_index, timeout=_PEER_TIMEOUT)
+    except requests.RequestException as e:
+        log.info("The peer index %s is not reachable: %s", peer_index, e)
+        return False
+    return response.status_code == 200
+
+
+def index_options(options: list[str], peer_index: str) -> list[str]:
+    """Requirements file options that try `peer_index` before the upstream index
+
+    pip looks at both indexes and takes the first of equally good files, so
+    files the peer has are downloaded from the peer, anything else upstream.
+    """
+    upstream = DEFAULT_UPSTREAM
+    kept = []
+    for option in options:
+        match = _INDEX_OPTION.match(option.strip())
+        if match is not None:
+            upstream = match[1]
+        else:
+            kept.append(option)
+    peer_options = [f"--index-url {peer_index}", f"--extra-index-url {upstream}"]
+    url = urllib.parse.urlsplit(peer_index)
+    if url.scheme == "http" and url.hostname:
+        # pip ignores plain http indexes unless told to trust them
+        peer_options.append(f"--trusted-host {url.netloc}")
+    return peer_options + kept
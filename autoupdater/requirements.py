@@ -1,71 +1,715 @@
+import concurrent.futures
+import dataclasses
+import functools
 import hashlib
+import json
+import os
+import pathlib
 import re
+import subprocess
+import threading
 import time
-from typing import Optional
+from typing import Iterable, Iterator, Optional, Sequence
 
 import requests
+import requests.adapters
 
 import logging
 
+from autoupdater import markers, schedule
+from autoupdater import metrics as metrics_module
+
 log = logging.getLogger(__name__)
 
 
+@dataclasses.dataclass(frozen=True)
+class Requirement:
+    """A single parsed requirement, `line` is what gets passed on to pip"""
+
+    line: str
+    name: Optional[str] = None
+    specifier: str = ""
+    url: Optional[str] = None
+    version: Optional[str] = None
+    marker: Optional[str] = None
+    editable: bool = False
+    # As given with --hash, like "sha256:<hex digest>"
+    hashes: tuple[str, ...] = ()
+
+    def is_satisfied_by(self, installed: "Requirement") -> bool:
+        if self.editable or installed.version is None:
+            return False
+        if self.url is not None:
+            return self.version is not None and markers.version_key(
+                self.version
+            ) == markers.version_key(installed.version)
+        if not self.specifier:
+            return True
+        return bool(markers.version_matches(installed.version, self.specifier))
+
+
+@dataclasses.dataclass()
+class Plan:
+    install: list[str] = dataclasses.field(default_factory=list)
+    upgrade: list[str] = dataclasses.field(default_factory=list)
+    replaced: list[str] = dataclasses.field(default_factory=list)
+    remove: list[str] = dataclasses.field(default_factory=list)
+    options: list[str] = dataclasses.field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not (self.install or self.upgrade or self.remove)
+
+
+_NAME_AT_URL = re.compile(
+    r"^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*@\s*(?P<url>\S.*)$"
+)
+_NAME_AND_SPECIFIER = re.compile(
+    r"^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*(?P<specifier>.*)$"
+)
+_ARCHIVE_EXTENSIONS = (".whl", ".tar.gz", ".tar.bz2", ".zip", ".tgz")
+_COMMENT = re.compile(r"(^|\s)#.*$")
+_REQUIREMENT_OPTION = re.compile(r"\s+--?[A-Za-z]")
+_HASH_OPTION = re.compile(r"--hash[=\s]\s*(\S+)")
+
+
+def canonical_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def name_and_version_from_url(url: str) -> tuple[Optional[str], Optional[str]]:
+    url, _, fragment = url.partition("#")
+    for part in fragment.split("&"):
+        if part.startswith("egg="):
+            return part[len("egg=") :], None
+    file_name = url.rstrip("/").rsplit("/", maxsplit=1)[-1]
+    if file_name.endswith(".whl"):
+        parts = file_name.split("-")
+        if len(parts) >= 5:
+            return parts[0], parts[1]
+    for extension in _ARCHIVE_EXTENSIONS:
+        if file_name.endswith(extension):
+            name, _, version = file_name[: -len(extension)].rpartition("-")
+            if name:
+                return name, version
+    return None, None
+
+
+def parse_line(line: str) -> Optional[Requirement]:
+    """Parse a requirements (or `pip freeze`) line, None for options and blanks"""
+    line = _COMMENT.sub("", line).strip()
+    if not line:
+        return None
+    editable = False
+    body = line
+    if line.startswith(("-e ", "-e=", "--editable ", "--editable=")):
+        editable = True
+        body = re.split(r"[\s=]", line, maxsplit=1)[1].strip()
+    elif line.startswith("-"):
+        return None
+    hashes = tuple(_HASH_OPTION.findall(body))
+    body = _REQUIREMENT_OPTION.split(body, maxsplit=1)[0].strip()
+    # In URLs a ';' only starts the marker if there is whitespace before it
+    separator = re.search(r"\s;" if "://" in body else ";", body)
+    marker = ""
+    if separator is not None:
+        marker = body[separator.end() :].strip()
+        body = body[: separator.start()].strip()
+
+    match = _NAME_AT_URL.match(body)
+    if match is not None:
+        url = match["url"].strip()
+        _, version = name_and_version_from_url(url)
+        return Requirement(
+            line=line,
+            name=canonical_name(match["name"]),
+            url=url,
+            version=version,
+            marker=marker or None,
+            editable=editable,
+            hashes=hashes,
+        )
+    if editable or "/" in body or "://" in body or body.endswith(_ARCHIVE_EXTENSIONS):
+        name, version = name_and_version_from_url(body)
+        return Requirement(
+            line=line,
+            name=canonical_name(name) if name else None,
+            url=body,
+            version=version,
+            marker=marker or None,
+            editable=editable,
+            hashes=hashes,
+        )
+    match = _NAME_AND_SPECIFIER.match(body)
+    if match is None:
+        log.warning("Could not parse requirement %r", line)
+        return Requirement(line=line, marker=marker or None, hashes=hashes)
+    specifier = match["specifier"].strip().strip("()").replace(" ", "")
+    version = None
+    if re.fullmatch(r"===?[^,*]+", specifier):
+        version = specifier.lstrip("=")
+    return Requirement(
+        line=line,
+        name=canonical_name(match["name"]),
+        specifier=specifier,
+        version=version,
+        marker=marker or None,
+        hashes=hashes,
+    )
+
+
+def _logical_lines(content: str) -> Iterator[str]:
+    current = ""
+    for line in content.split("\n"):
+        if line.rstrip().endswith("\\") and not _COMMENT.search(line):
+            current += line.rstrip()[:-1] + " "
+            continue
+        yield current + line
+        current = ""
+    if current:
+        yield current
+
+
+def parse_requirements(
+    requirements_content: str, environment: Optional[dict[str, str]] = None
+) -> tuple[list[Requirement], list[str]]:
+    """Returns the requirements that apply to `environment` and the global options
+
+    Markers are only evaluated if an `environment` is given.
+    """
+    parsed = []
+    options = []
+    for line in _logical_lines(requirements_content):
+        requirement = parse_line(line)
+        if requirement is None:
+            option = _COMMENT.sub("", line).strip()
+            if option:
+                options.append(option)
+            continue
+        if requirement.marker is not None and environment is not None:
+            try:
+                if not markers.evaluate(requirement.marker, environment):
+                    continue
+            except markers.InvalidMarker:
+                log.warning("Could not evaluate the marker of %r", requirement.line)
+        parsed.append(requirement)
+    return parsed, options
+
+
+def plan(
+    pip_freeze_content: str,
+    requirements_content: str,
+    environment: Optional[dict[str, str]] = None,
+) -> Plan:
+    """Work out how to get from what is installed to the requirements"""
+    installed = {}
+    for line in pip_freeze_content.split("\n"):
+        requirement = parse_line(line)
+        if requirement is not None and requirement.name is not None:
+            installed[requirement.name] = requirement
+
+    targets, options = parse_requirements(requirements_content, environment)
+    result = Plan(options=options)
+    target_names = set()
+    for target in targets:
+        if target.name is None:
+            result.install.append(target.line)
+            continue
+        if target.name in target_names:
+            continue
+        target_names.add(target.name)
+        current = installed.get(target.name)
+        if current is None:
+            result.install.append(target.line)
+        elif not target.is_satisfied_by(current):
+            result.upgrade.append(target.line)
+            result.replaced.append(current.line)
+    result.remove = [
+        requirement.line
+        for name, requirement in installed.items()
+        if name not in target_names
+    ]
+    return result
+
+
 def diff(
-    pip_freeze_content: str, requirements_content: str
+    pip_freeze_content: str,
+    requirements_content: str,
+    environment: Optional[dict[str, str]] = None,
 ) -> tuple[list[str], list[str]]:
-    target_requirements = [
-        (normalize_line(line), strip_line(line))
-        for line in requirements_content.split("\n")
-        if normalize_line(line)
-    ]
-    clean_target_requirements = [r[0] for r in target_requirements]
-    installed_requirements = [
-        normalize_line(line)
-        for line in pip_freeze_content.split("\n")
-        if normalize_line(line)
-    ]
-    requirements_to_remove = [
-        line for line in installed_requirements if line not in clean_target_requirements
-    ]
+    update_plan = plan(pip_freeze_content, requirements_content, environment)
+    requirements_to_install = update_plan.install + update_plan.upgrade
+    if requirements_to_install:
+        requirements_to_install = update_plan.options + requirements_to_install
+    return update_plan.remove + update_plan.replaced, requirements_to_install
 
-    requirements_to_install = [
-        line
-        for clean_requirement, line in target_requirements
-        if clean_requirement not in installed_requirements
-    ]
-    return requirements_to_remove, requirements_to_install
 
+@functools.lru_cache(maxsize=None)
+def interpreter_environment(python_path: pathlib.Path) -> dict[str, str]:
+    """The values environment markers are evaluated with for an interpreter"""
+    result = subprocess.run(
+        [python_path, "-c", markers.ENVIRONMENT_SCRIPT],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(result.stdout)
+
+
+_FETCH_TIMEOUT = 30
+_DOWNLOAD_TIMEOUT = 60
+# Longer waits between retries give up and leave the URL alone for a while instead
+_MAX_RETRY_DELAY = 60
+DEFAULT_MIRROR_TIMEOUT = 10
+# The next mirror is asked once the fastest one took this many times its usual time
+_HEDGE_FACTOR = 2
+_MIN_HEDGE_DELAY = 0.5
+# Weight of the newest measurement in the remembered latency of a mirror
+_LATENCY_WEIGHT = 0.3
+_LATENCY_FILE = "mirrors.json"
+
+
+@dataclasses.dataclass()
+class CacheEntry:
+    """Validators and digest of the last successful response for a URL"""
+
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    digest: Optional[bytes] = None
+    # Until then the server allowed us to use the response without asking again
+    fresh_until: float = 0
+
+    def conditional_headers(self) -> dict[str, str]:
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class Fetcher:
+    """Fetch remote requirements files over a pooled session
+
+    The ETag/Last-Modified validators, digest and body of the last response are
+    kept for every URL (on disk if a `cache_directory` is given) so that unchanged
+    files are answered with a 304 and neither downloaded nor hashed again.
+    Responses are not requested again while `Cache-Control: max-age` allows.
+    Failed requests are retried with jittered exponential backoff, and a URL that
+    keeps failing (or whose server asked for it with `Retry-After`) is left alone
+    for a while. How long mirrors of a requirements file took to answer is kept
+    too, see `race`. A fetcher can be shared between threads.
+    """
+
+    def __init__(
+        self,
+        cache_directory: Optional[pathlib.Path] = None,
+        download_concurrency: int = 4,
+        downloads_per_host: int = 2,
+        metrics: Optional[metrics_module.Metrics] = None,
+        mirror_timeout: float = DEFAULT_MIRROR_TIMEOUT,
+    ) -> None:
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=download_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.cache_directory = cache_directory
+        self.download_concurrency = download_concurrency
+        self.downloads_per_host = downloads_per_host
+        self.metrics = metrics or metrics_module.Metrics()
+        self.mirror_timeout = mirror_timeout
+        self._entries: dict[str, CacheEntry] = {}
+        self._bodies: dict[str, bytes] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._generations: dict[str, int] = {}
+        self._results: dict[str, bool] = {}
+        self._retry_backoff = schedule.Backoff(base=2, cap=_MAX_RETRY_DELAY)
+        self._failure_backoff = schedule.Backoff(base=30, cap=60 * 60)
+        self._failures: dict[str, int] = {}
+        self._not_before: dict[str, float] = {}
+        self._latencies: Optional[dict[str, float]] = None
+        self._latency_lock = threading.Lock()
+
+    def digest(
+        self, url: str, retries: int = 10, timeout: float = _FETCH_TIMEOUT
+    ) -> Optional[bytes]:
+        if not self._refresh(url, retries, timeout):
+            return None
+        return self._entry(url).digest
+
+    def read(
+        self, url: str, retries: int = 10, timeout: float = _FETCH_TIMEOUT
+    ) -> Optional[bytes]:
+        if not self._refresh(url, retries, timeout):
+            return None
+        return self._body(url)
+
+    def cached(self, url: str) -> Optional[bytes]:
+        """The body of the last response for `url`, without asking its server"""
+        return self._body(url)
 
-def _load_file_from_web(requirements_file: str, retries: int = 10) -> Optional[bytes]:
-    for try_ in range(retries):
-        response = requests.get(requirements_file)
-        if response.status_code == 200:
-            break
-        time.sleep(30)
-    else:
+    def race(self, sources: Sequence[str], quorum: int = 1) -> Optional[bytes]:
+        """The content of the first of `sources` (URLs or paths) that answered
+
+        The source that answered fastest so far is asked first, the next one
+        whenever a source fails or takes twice as long as the fastest usually
+        does. Every source gets one attempt of at most `mirror_timeout` seconds.
+        With a `quorum` above one, that many sources are asked at once and the
+        content is only used once `quorum` of them agree on its digest.
+        """
+        waiting = self.fastest_first(sources)
+        votes: dict[bytes, int] = {}
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(waiting), thread_name_prefix="mirror"
+        )
+        running: dict[concurrent.futures.Future, str] = {}
+
+        def ask_next() -> None:
+            source = waiting.pop(0)
+            running[pool.submit(self._timed_read, source)] = source
+
+        try:
+            for _ in range(min(quorum, len(waiting))):
+                ask_next()
+            while running:
+                done, _ = concurrent.futures.wait(
+                    running,
+                    timeout=self._hedge_delay(running.values()) if waiting else None,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                if not done:
+                    log.info("Mirrors are slow, also asking %s", waiting[0])
+                    ask_next()
+                for future in done:
+                    source = running.pop(future)
+                    data = future.result()
+                    if data is not None:
+                        digest = digest_from_content(data)
+                        votes[digest] = votes.get(digest, 0) + 1
+                        if votes[digest] >= quorum:
+                            log.debug("Using the requirements from %s", source)
+                            return data
+                    if waiting:
+                        ask_next()
+        finally:
+            # Slower sources finish in the background, within their timeout
+            pool.shutdown(wait=False)
+        if len(votes) > 1:
+            log.error("The mirrors disagree on the requirements, no %s agree", quorum)
+        else:
+            log.error("Not enough mirrors answered with the requirements")
+        return None
+
+    def fastest_first(self, sources: Sequence[str]) -> list[str]:
+        """`sources` by how fast they answered, the ones never asked first"""
+        latencies = self._load_latencies()
+        return sorted(sources, key=lambda source: latencies.get(source, 0))
+
+    def record_latency(self, source: str, seconds: float) -> None:
+        with self._latency_lock:
+            latencies = self._load_latencies()
+            if source in latencies:
+                seconds = (
+                    _LATENCY_WEIGHT * seconds
+                    + (1 - _LATENCY_WEIGHT) * latencies[source]
+                )
+            latencies[source] = seconds
+            if self.cache_directory is None:
+                return
+            try:
+                os.makedirs(self.cache_directory, exist_ok=True)
+                _write_atomically(
+                    self.cache_directory / _LATENCY_FILE,
+                    json.dumps(latencies, indent=2, sort_keys=True).encode("utf-8"),
+                )
+            except OSError:
+                log.exception("Could not write the latencies of the mirrors")
+
+    def _timed_read(self, source: str) -> Optional[bytes]:
+        started = time.monotonic()
+        if is_url(source):
+            data = self.read(source, retries=1, timeout=self.mirror_timeout)
+        else:
+            data = read_requirements_file(source)
+        # A failure counts as taking the whole timeout
+        elapsed = time.monotonic() - started if data is not None else None
+        self.record_latency(source, self.mirror_timeout if elapsed is None else elapsed)
+        return data
+
+    def _hedge_delay(self, sources: Iterable[str]) -> float:
+        latencies = self._load_latencies()
+        fastest = min(latencies.get(source, 0) for source in sources)
+        return min(self.mirror_timeout, max(_MIN_HEDGE_DELAY, _HEDGE_FACTOR * fastest))
+
+    def _load_latencies(self) -> dict[str, float]:
+        if self._latencies is None:
+            self._latencies = {}
+            if self.cache_directory is not None:
+                try:
+                    with open(self.cache_directory / _LATENCY_FILE, "r") as f:
+                        self._latencies = {
+                            source: float(seconds)
+                            for source, seconds in json.load(f).items()
+                        }
+                except (OSError, ValueError, AttributeError):
+                    pass
+        return self._latencies
+
+    def download(self, url: str, destination: pathlib.Path) -> str:
+        """Stream `url` into `destination` and return its sha256 hex digest"""
+        sha256 = hashlib.sha256()
+        with self.session.get(url, stream=True, timeout=_DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            with open(destination, "wb") as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    sha256.update(chunk)
+                    f.write(chunk)
+        self.metrics.increment("downloaded_bytes", destination.stat().st_size)
+        return sha256.hexdigest()
+
+    def _refresh(self, url: str, retries: int, timeout: float) -> bool:
+        # Callers asking for the same URL at the same time share a single request
+        lock = self._locks.setdefault(url, threading.Lock())
+        generation = self._generations.get(url, 0)
+        with lock:
+            if self._generations.get(url, 0) != generation:
+                return self._results[url]
+            result = self._refresh_unlocked(url, retries, timeout)
+            self._results[url] = result
+            self._generations[url] = generation + 1
+            return result
+
+    def _refresh_unlocked(self, url: str, retries: int, timeout: float) -> bool:
+        entry = self._entry(url)
+        cached = entry.digest is not None and self._body(url) is not None
+        now = time.time()
+        if cached and now < entry.fresh_until:
+            log.debug("%s is still fresh", url)
+            return True
+        if now < self._not_before.get(url, 0):
+            log.info(
+                "Not asking for %s again for another %.0fs",
+                url,
+                self._not_before[url] - now,
+            )
+            return False
+        response = self._get(
+            url, entry.conditional_headers() if cached else {}, retries, timeout
+        )
+        if response is None:
+            self.metrics.increment("fetch_failures")
+            return False
+        if response.status_code == 304:
+            log.debug("%s not modified", url)
+            self.metrics.increment("fetches_not_modified")
+            entry.fresh_until = _fresh_until(response)
+            self._save(url, entry)
+        else:
+            self._store(url, response)
+        return True
+
+    def _get(
+        self, url: str, headers: dict[str, str], retries: int, timeout: float
+    ) -> Optional[requests.Response]:
+        for attempt in range(retries):
+            try:
+                response = self.session.get(url, headers=headers, timeout=timeout)
+            except requests.RequestException as e:
+                log.warning("Could not load the requirements from %s: %s", url, e)
+                response = None
+            else:
+                if response.status_code in (200, 304):
+                    self._failures.pop(url, None)
+                    return response
+                log.warning(
+                    "Could not load the requirements from %s: Status code %s",
+                    url,
+                    response.status_code,
+                )
+            delay = self._retry_backoff.delay(attempt)
+            if (
+                response is not None
+                and response.status_code in schedule.THROTTLED_STATUS_CODES
+            ):
+                requested = schedule.retry_after(response.headers, time.time())
+                if requested is not None and requested > _MAX_RETRY_DELAY:
+                    log.error("%s asked to come back in %.0fs", url, requested)
+                    self._not_before[url] = time.time() + requested
+                    return None
+                if requested is not None:
+                    delay = requested
+            if attempt < retries - 1:
+                time.sleep(delay)
+        failures = self._failures.get(url, 0)
+        self._failures[url] = failures + 1
+        delay = self._failure_backoff.delay(failures)
         log.error(
-            "Could not load the requirements from %s: Status code %s",
-            requirements_file,
-            response.status_code,
+            "Could not load the requirements from %s, not trying again for %.0fs",
+            url,
+            delay,
         )
+        self._not_before[url] = time.time() + delay
         return None
-    return response.content
 
+    def _store(self, url: str, response: requests.Response) -> CacheEntry:
+        entry = CacheEntry(
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            digest=digest_from_content(response.content),
+            fresh_until=_fresh_until(response),
+        )
+        self._entries[url] = entry
+        self._bodies[url] = response.content
+        self.metrics.increment("downloaded_bytes", len(response.content))
+        self._save(url, entry, response.content)
+        return entry
 
-def digest_from_requirements_file(requirements_file: str) -> Optional[bytes]:
-    if requirements_file.startswith("https://") or requirements_file.startswith(
-        "http://"
-    ):
-        data = _load_file_from_web(requirements_file)
-    else:
+    def _entry(self, url: str) -> CacheEntry:
+        if url not in self._entries:
+            self._entries[url] = self._load_entry(url)
+        return self._entries[url]
+
+    def _body(self, url: str) -> Optional[bytes]:
+        if url not in self._bodies and self.cache_directory is not None:
+            try:
+                with open(self._cache_path(url, ".body"), "rb") as f:
+                    self._bodies[url] = f.read()
+            except OSError:
+                return None
+        return self._bodies.get(url)
+
+    def _cache_path(self, url: str, suffix: str) -> pathlib.Path:
+        assert self.cache_directory is not None
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+        return self.cache_directory / f"{key}{suffix}"
+
+    def _load_entry(self, url: str) -> CacheEntry:
+        if self.cache_directory is None:
+            return CacheEntry()
+        try:
+            with open(self._cache_path(url, ".json"), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return CacheEntry()
+        return CacheEntry(
+            etag=data.get("etag"),
+            last_modified=data.get("last_modified"),
+            digest=bytes.fromhex(data["digest"]) if data.get("digest") else None,
+            fresh_until=data.get("fresh_until", 0),
+        )
+
+    def _save(self, url: str, entry: CacheEntry, body: Optional[bytes] = None) -> None:
+        if self.cache_directory is None:
+            return
         try:
-            with open(requirements_file, "rb") as file_:
-                data = file_.read()
+            os.makedirs(self.cache_directory, exist_ok=True)
+            # The body is written first so a valid entry never points at a stale body
+            if body is not None:
+                _write_atomically(self._cache_path(url, ".body"), body)
+            _write_atomically(
+                self._cache_path(url, ".json"),
+                json.dumps(
+                    {
+                        "url": url,
+                        "etag": entry.etag,
+                        "last_modified": entry.last_modified,
+                        "digest": entry.digest.hex() if entry.digest else None,
+                        "fresh_until": entry.fresh_until,
+                    }
+                ).encode("utf-8"),
+            )
         except OSError:
-            data = None
+            log.exception("Could not write the requirements cache for %s", url)
+
+
+def _fresh_until(response: requests.Response) -> float:
+    age = schedule.max_age(response.headers)
+    return 0 if age is None else time.time() + age
+
+
+def _write_atomically(file_path: pathlib.Path, data: bytes) -> None:
+    tmp_path = file_path.with_name(file_path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+
+_default_fetcher: Optional[Fetcher] = None
+
+
+def default_fetcher() -> Fetcher:
+    global _default_fetcher
+    if _default_fetcher is None:
+        _default_fetcher = Fetcher()
+    return _default_fetcher
+
+
+def is_url(requirements_file: str) -> bool:
+    return requirements_file.startswith("https://") or requirements_file.startswith(
+        "http://"
+    )
+
+
+def _load_file_from_web(
+    requirements_file: str, retries: int = 10, fetcher: Optional[Fetcher] = None
+) -> Optional[bytes]:
+    return (fetcher or default_fetcher()).read(requirements_file, retries)
+
+
+def read_requirements_file(
+    requirements_file: str,
+    fetcher: Optional[Fetcher] = None,
+    mirrors: Sequence[str] = (),
+    quorum: int = 1,
+) -> Optional[bytes]:
+    """The requirements file, or the same file from the fastest of its `mirrors`"""
+    if mirrors:
+        return (fetcher or default_fetcher()).race(
+            [requirements_file, *mirrors], quorum
+        )
+    if is_url(requirements_file):
+        return _load_file_from_web(requirements_file, fetcher=fetcher)
+    try:
+        with open(requirements_file, "rb") as file_:
+            return file_.read()
+    except OSError:
+        return None
+
+
+def cached_requirements_file(
+    requirements_file: str,
+    digest: bytes,
+    fetcher: Optional[Fetcher] = None,
+    mirrors: Sequence[str] = (),
+) -> Optional[bytes]:
+    """The requirements file with `digest` as it was fetched before, if it was"""
+    for source in [requirements_file, *mirrors]:
+        if is_url(source):
+            data = (fetcher or default_fetcher()).cached(source)
+        else:
+            data = read_requirements_file(source)
+        if data is not None and digest_from_content(data) == digest:
+            return data
+    return None
+
+
+def digest_from_requirements_file(
+    requirements_file: str,
+    fetcher: Optional[Fetcher] = None,
+    mirrors: Sequence[str] = (),
+    quorum: int = 1,
+) -> Optional[bytes]:
+    if mirrors:
+        data = read_requirements_file(requirements_file, fetcher, mirrors, quorum)
+        return None if data is None else digest_from_content(data)
+    if is_url(requirements_file):
+        return (fetcher or default_fetcher()).digest(requirements_file)
+    data = read_requirements_file(requirements_file)
     if data is None:
         return None
+    return digest_from_content(data)
+
 
+def digest_from_content(data: bytes) -> bytes:
     text = data.decode("utf-8")
 
     def clean_line(line: str) -> bool:
@@ -0,0 +1,157 @@
+import collections
+import datetime
+import email.utils
+import random
+from typing import Mapping, Optional
+
+
+# Status codes with which a server asks its clients to come back later
+THROTTLED_STATUS_CODES = (429, 503)
+
+
+class Backoff:
+    """Exponential backoff with full jitter
+
+    The delay before retry `n` is drawn uniformly from [0, min(cap, base * 2**n)]
+    so that clients which failed at the same moment don't retry in lockstep.
+    """
+
+    def __init__(
+        self, base: float, cap: float, rng: Optional[random.Random] = None
+    ) -> None:
+        self.base = base
+        self.cap = cap
+        self.rng = rng or random.Random()
+
+    def delay(self, attempt: int) -> float:
+        # Capping the exponent keeps huge attempt numbers from overflowing
+        return self.rng.uniform(0, min(self.cap, self.base * 2 ** min(attempt, 32)))
+
+
+def jittered(
+    interval: float, jitter: float, rng: Optional[random.Random] = None
+) -> float:
+    """`interval` moved randomly by up to `jitter` (a fraction) in either direction"""
+    if jitter <= 0:
+        return interval
+    return interval * (rng or random).uniform(1 - jitter, 1 + jitter)
+
+
+def retry_after(headers: Mapping[str, str], now: float) -> Optional[float]:
+    """Seconds to wait according to a Retry-After header, if there is one"""
+    value = headers.get("Retry-After")
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, date.timestamp() - now)
+
+
+def max_age(headers: Mapping[str, str]) -> Optional[float]:
+    """How long a response may be used without asking again, from Cache-Control"""
+    value = headers.get("Cache-Control")
+    if not isinstance(value, str):
+        return None
+    age = None
+    for directive in value.split(","):
+        name, _, argument = directive.strip().partition("=")
+        name = name.strip().lower()
+        if name in ("no-cache", "no-store"):
+            return None
+        if name == "max-age":
+            try:
+                age = float(argument.strip().strip('"'))
+            except ValueError:
+                return None
+    return age
+
+
+# sysexits.h EX_USAGE up to EX_CONFIG, the program says retrying won't help
+_PERMANENT_EXIT_CODES = range(64, 79)
+
+
+def classify_exit(returncode: Optional[int]) -> str:
+    """Why a program stopped, from its exit code (None if it never ran)"""
+    if returncode is None:
+        return "error"
+    if returncode == 0:
+        return "clean"
+    if returncode < 0:
+        return "signal"
+    if returncode in _PERMANENT_EXIT_CODES:
+        return "permanent"
+    return "crash"
+
+
+class RestartPolicy:
+    """How long to wait before restarting a program that exited
+
+    Every failed exit within `stable_after` seconds of the start doubles the
+    delay, up to `max_delay`. A clean exit or an exit after a longer run
+    resets it, and exits that say retrying won't help go straight to
+    `max_delay`. On top of that no more than `budget` restarts happen within
+    any `window` seconds.
+    """
+
+    def __init__(
+        self,
+        base_delay: float = 1,
+        max_delay: float = 5 * 60,
+        stable_after: float = 60,
+        budget: int = 30,
+        window: float = 10 * 60,
+        rng: Optional[random.Random] = None,
+    ) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+        self.budget = budget
+        self.window = window
+        self.rng = rng or random.Random()
+        self.failures = 0
+        self.last_exit: Optional[str] = None
+        self._restarts: collections.deque[float] = collections.deque()
+
+    def record_exit(self, returncode: Optional[int], uptime: float) -> str:
+        kind = classify_exit(returncode)
+        self.last_exit = kind
+        if kind == "permanent":
+            self.failures = max(self.failures + 1, self._failures_for_max_delay())
+        elif kind != "clean" and uptime < self.stable_after:
+            self.failures += 1
+        else:
+            self.failures = 0
+        return kind
+
+    def reset(self) -> None:
+        self.failures = 0
+
+    def next_restart(self, now: float) -> float:
+        """Seconds to wait before restarting, the restart is counted as done then"""
+        delay = 0.0
+        if self.failures > 0:
+            delay = jittered(
+                min(self.max_delay, self.base_delay * 2 ** min(self.failures - 1, 32)),
+                0.2,
+                self.rng,
+            )
+            delay = min(delay, self.max_delay)
+        while self._restarts and self._restarts[0] <= now - self.window:
+            self._restarts.popleft()
+        if len(self._restarts) >= self.budget:
+            delay = max(delay, self._restarts[0] + self.window - now)
+        self._restarts.append(now + delay)
+        return delay
+
+    def _failures_for_max_delay(self) -> int:
+        failures = 1
+        while self.base_delay * 2 ** (failures - 1) < self.max_delay:
+            failures += 1
+        return failures
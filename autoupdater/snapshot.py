@@ -0,0 +1,93 @@
+import fcntl
+import logging
+import os
+import pathlib
+import shutil
+from os import path
+from typing import Callable, Collection
+
+
+log = logging.getLogger(__name__)
+
+
+# ioctl(dest, FICLONE, src) from linux/fs.h, shares the data copy-on-write
+_FICLONE = 0x40049409
+
+
+def clone_venv(
+    source: pathlib.Path,
+    destination: pathlib.Path,
+    exclude: Collection[str] = (),
+) -> None:
+    """Make `destination` a venv with the same contents as `source`
+
+    Files are reflinked where the filesystem supports it and hardlinked
+    otherwise, so unchanged files take no extra space. That is safe because
+    pip removes a file before writing a new one in its place. Only the files
+    that name the venv's own path (the scripts in bin/ and pyvenv.cfg) are
+    real copies, rewritten to point at `destination`. Top level entries in
+    `exclude` are left out. `destination` appears all at once or not at all.
+    """
+    partial = destination.with_name(destination.name + ".partial")
+    if path.lexists(partial):
+        shutil.rmtree(partial)
+    old_prefix = os.fsencode(source.absolute())
+    new_prefix = os.fsencode(destination.absolute())
+    link = _linker()
+    for directory, directory_names, file_names in os.walk(source):
+        relative = path.relpath(directory, source)
+        if relative == ".":
+            directory_names[:] = [d for d in directory_names if d not in exclude]
+            file_names = [f for f in file_names if f not in exclude]
+        target_directory = path.normpath(path.join(partial, relative))
+        os.makedirs(target_directory)
+        shutil.copystat(directory, target_directory)
+        # os.walk doesn't follow symlinked directories but lists them here
+        for name in list(directory_names):
+            if path.islink(path.join(directory, name)):
+                directory_names.remove(name)
+                file_names.append(name)
+        for name in file_names:
+            source_file = path.join(directory, name)
+            target_file = path.join(target_directory, name)
+            if path.islink(source_file):
+                os.symlink(os.readlink(source_file), target_file)
+            elif relative == "bin" or (relative == "." and name == "pyvenv.cfg"):
+                _copy_replacing(source_file, target_file, old_prefix, new_prefix)
+            else:
+                link(source_file, target_file)
+    os.rename(partial, destination)
+
+
+def _linker() -> Callable[[str, str], None]:
+    """Reflink, falling back to a hardlink and then to a copy on the first failure"""
+    methods = [_reflink, os.link, shutil.copy2]
+
+    def link(source_file: str, target_file: str) -> None:
+        while True:
+            try:
+                methods[0](source_file, target_file)
+                return
+            except OSError as e:
+                if len(methods) == 1:
+                    raise
+                log.debug("%s failed (%s), trying the next way", methods[0], e)
+                methods.pop(0)
+                if path.lexists(target_file):
+                    os.remove(target_file)
+
+    return link
+
+
+def _reflink(source_file: str, target_file: str) -> None:
+    with open(source_file, "rb") as source, open(target_file, "wb") as target:
+        fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+    shutil.copystat(source_file, target_file)
+
+
+def _copy_replacing(source_file: str, target_file: str, old: bytes, new: bytes) -> None:
+    with open(source_file, "rb") as f:
+        content = f.read()
+    with open(target_file, "wb") as f:
+        f.write(content.replace(old, new))
+    shutil.copystat(source_file, target_file)
@@ -0,0 +1,149 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import pathlib
+import select
+import struct
+import time
+from typing import Optional, Union
+
+
+log = logging.getLogger(__name__)
+
+
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o4000
+_IN_MODIFY = 0x2
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_WATCH_MASK = (
+    _IN_MODIFY
+    | _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+)
+_EVENT_HEADER = struct.Struct("iIII")
+
+_DEFAULT_DEBOUNCE = 0.2
+
+
+class InotifyWatcher:
+    """Wait for changes to a file using inotify
+
+    The parent directory is watched rather than the file itself, so that files
+    replaced by a rename (as most config management tools do) are noticed too.
+    """
+
+    def __init__(
+        self, file_path: Union[str, pathlib.Path], debounce: float = _DEFAULT_DEBOUNCE
+    ) -> None:
+        self.file_path = pathlib.Path(file_path).absolute()
+        self.debounce = debounce
+        libc = _libc()
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        watch_descriptor = libc.inotify_add_watch(
+            fd, os.fsencode(self.file_path.parent), _WATCH_MASK
+        )
+        if watch_descriptor < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        self._fd = fd
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def wait(self, timeout: float) -> bool:
+        """Wait up to `timeout` seconds and return whether the file has changed"""
+        if not self._wait_for_events(timeout):
+            return False
+        # Settle: keep draining until no event has arrived for `debounce` seconds
+        while self._wait_for_events(self.debounce):
+            pass
+        return True
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def _wait_for_events(self, timeout: float) -> bool:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+        return self._read_events()
+
+    def _read_events(self) -> bool:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        relevant = False
+        offset = 0
+        file_name = os.fsencode(self.file_path.name)
+        while offset < len(data):
+            _, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if name == file_name:
+                relevant = True
+        return relevant
+
+
+class StatWatcher:
+    """Fallback for platforms without inotify: poll the file's stat"""
+
+    def __init__(
+        self,
+        file_path: Union[str, pathlib.Path],
+        poll_interval: float = 1,
+    ) -> None:
+        self.file_path = pathlib.Path(file_path)
+        self.poll_interval = poll_interval
+        self._last_stat = self._stat()
+
+    def fileno(self) -> Optional[int]:
+        return None
+
+    def wait(self, timeout: float) -> bool:
+        deadline = time.time() + timeout
+        while True:
+            stat = self._stat()
+            if stat != self._last_stat:
+                self._last_stat = stat
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+
+    def close(self) -> None:
+        pass
+
+    def _stat(self) -> Optional[tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.file_path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+FileWatcher = Union[InotifyWatcher, StatWatcher]
+
+
+def watch_file(file_path: Union[str, pathlib.Path]) -> FileWatcher:
+    try:
+        return InotifyWatcher(file_path)
+    except (OSError, AttributeError):
+        log.info("inotify is not available, polling %s for changes", file_path)
+        return StatWatcher(file_path)
+
+
+def _libc() -> ctypes.CDLL:
+    return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
@@ -0,0 +1,285 @@
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+import zipfile
+from os import path
+from typing import Optional
+
+from autoupdater import isolation, requirements
+
+
+log = logging.getLogger(__name__)
+
+
+class BadDistribution(Exception):
+    pass
+
+
+_WHEELHOUSE_DIRECTORY = "wheelhouse"
+_SDIST_EXTENSIONS = (".tar.gz", ".tar.bz2", ".tgz", ".zip")
+
+
+def root_dir(base_directory: pathlib.Path) -> pathlib.Path:
+    return base_directory / _WHEELHOUSE_DIRECTORY
+
+
+def wheelhouse_dir(base_directory: pathlib.Path, digest: bytes) -> pathlib.Path:
+    return root_dir(base_directory) / digest.hex()[:16]
+
+
+def is_complete(directory: pathlib.Path) -> bool:
+    # A wheelhouse is only ever moved into place once everything was downloaded
+    return path.isdir(directory)
+
+
+@dataclasses.dataclass(frozen=True)
+class Distribution:
+    url: str
+    sha256: Optional[str] = None
+
+    def file_name(self) -> str:
+        return urllib.parse.unquote(
+            urllib.parse.urlsplit(self.url).path.rsplit("/", maxsplit=1)[-1]
+        )
+
+    def host(self) -> str:
+        return urllib.parse.urlsplit(self.url).netloc
+
+
+def resolve(
+    pip_path: pathlib.Path,
+    requirements_file: str,
+    limits: isolation.Limits = isolation.NO_LIMITS,
+) -> Optional[list[Distribution]]:
+    """Ask pip which distributions it would download, without downloading them
+
+    Returns None if that can't be answered (e.g. pip is too old or some
+    requirements come from version control), pip has to download those itself.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report_file = path.join(tmp_dir, "report.json")
+        try:
+            subprocess.run(
+                limits.wrap(
+                    [
+                        pip_path.absolute(),
+                        "install",
+                        "--dry-run",
+                        "--quiet",
+                        "--report",
+                        report_file,
+                        "-r",
+                        requirements_file,
+                    ]
+                ),
+                check=True,
+            )
+            with open(report_file, "r") as f:
+                report = json.load(f)
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            log.info("Could not resolve the distributions, leaving it to pip")
+            return None
+
+    distributions = []
+    for item in report.get("install", []):
+        download_info = item.get("download_info", {})
+        if "archive_info" not in download_info:
+            return None
+        url = download_info["url"]
+        if urllib.parse.urlsplit(url).scheme not in ("http", "https", "file"):
+            return None
+        archive_info = download_info["archive_info"]
+        sha256 = archive_info.get("hashes", {}).get("sha256")
+        if sha256 is None and archive_info.get("hash", "").startswith("sha256="):
+            sha256 = archive_info["hash"][len("sha256=") :]
+        distributions.append(Distribution(url=url, sha256=sha256))
+    return distributions
+
+
+def download_all(
+    distributions: list[Distribution],
+    directory: pathlib.Path,
+    fetcher: requirements.Fetcher,
+) -> None:
+    """Download `distributions` concurrently through the fetcher's session
+
+    At most `fetcher.download_concurrency` downloads run at the same time and
+    at most `fetcher.downloads_per_host` of them against the same host.
+    """
+    host_limits = {
+        host: threading.BoundedSemaphore(fetcher.downloads_per_host)
+        for host in {d.host() for d in distributions}
+    }
+
+    def download(distribution: Distribution) -> None:
+        destination = directory / distribution.file_name()
+        if urllib.parse.urlsplit(distribution.url).scheme == "file":
+            source = urllib.request.url2pathname(
+                urllib.parse.urlsplit(distribution.url).path
+            )
+            shutil.copyfile(source, destination)
+            digest = file_sha256(destination)
+        else:
+            with host_limits[distribution.host()]:
+                digest = fetcher.download(distribution.url, destination)
+        if distribution.sha256 is not None and digest != distribution.sha256:
+            raise BadDistribution(f"{distribution.file_name()} has the wrong hash")
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=fetcher.download_concurrency
+    ) as executor:
+        # list() to raise the first error, if any
+        list(executor.map(download, distributions))
+
+
+def file_sha256(file_path: pathlib.Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def prefetch(
+    pip_path: pathlib.Path,
+    requirement_lines: list[str],
+    directory: pathlib.Path,
+    fetcher: Optional[requirements.Fetcher] = None,
+    limits: isolation.Limits = isolation.NO_LIMITS,
+) -> None:
+    """Download and verify all distributions for `requirement_lines` into `directory`
+
+    With a `fetcher` pip only works out what to download and the downloads
+    run in parallel, otherwise `pip download` does everything. Hashes are
+    checked either way. Source distributions are built into wheels right
+    away, building them needs their build dependencies from the index, which
+    an install from `directory` doesn't have. Nothing is left in `directory`
+    unless every download and build succeeded.
+    """
+    if is_complete(directory):
+        return
+    partial_directory = directory.with_name(directory.name + ".partial")
+    shutil.rmtree(partial_directory, ignore_errors=True)
+    os.makedirs(partial_directory)
+    try:
+        if requirement_lines:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                requirements_file = path.join(tmp_dir, "requirements.txt")
+                with open(requirements_file, "w") as f:
+                    f.write("\n".join(requirement_lines))
+                distributions = None
+                if fetcher is not None:
+                    distributions = resolve(pip_path, requirements_file, limits)
+                if distributions is not None:
+                    log.info("Downloading %s distributions...", len(distributions))
+                    download_all(distributions, partial_directory, fetcher)
+                else:
+                    _pip_download(
+                        pip_path, requirements_file, partial_directory, limits
+                    )
+            build_wheels(pip_path, requirement_lines, partial_directory, limits)
+        verify(partial_directory)
+    except Exception:
+        shutil.rmtree(partial_directory, ignore_errors=True)
+        raise
+    os.replace(partial_directory, directory)
+    log.info(
+        "Prefetched %s distributions into %s", len(os.listdir(directory)), directory
+    )
+
+
+def _pip_download(
+    pip_path: pathlib.Path,
+    requirements_file: str,
+    directory: pathlib.Path,
+    limits: isolation.Limits = isolation.NO_LIMITS,
+) -> None:
+    subprocess.run(
+        limits.wrap(
+            [
+                pip_path.absolute(),
+                "download",
+                "--dest",
+                directory,
+                "-r",
+                requirements_file,
+            ]
+        ),
+        check=True,
+    )
+
+
+def build_wheels(
+    pip_path: pathlib.Path,
+    requirement_lines: list[str],
+    directory: pathlib.Path,
+    limits: isolation.Limits = isolation.NO_LIMITS,
+) -> None:
+    """Replace the source distributions in `directory` with wheels built from them
+
+    The index options in `requirement_lines` are used to find build dependencies.
+    """
+    sdists = [
+        file_name
+        for file_name in os.listdir(directory)
+        if file_name.endswith(_SDIST_EXTENSIONS)
+    ]
+    if not sdists:
+        return
+    log.info("Building %s source distributions...", len(sdists))
+    options = [
+        line for line in requirement_lines if requirements.parse_line(line) is None
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        requirements_file = path.join(tmp_dir, "requirements.txt")
+        with open(requirements_file, "w") as f:
+            f.write(
+                "\n".join(options + [str(directory.absolute() / s) for s in sdists])
+            )
+        subprocess.run(
+            limits.wrap(
+                [
+                    pip_path.absolute(),
+                    "wheel",
+                    "--no-deps",
+                    "--wheel-dir",
+                    directory,
+                    "-r",
+                    requirements_file,
+                ]
+            ),
+            check=True,
+        )
+    for file_name in sdists:
+        os.remove(directory / file_name)
+
+
+def verify(directory: pathlib.Path) -> None:
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(".whl"):
+            continue
+        try:
+            with zipfile.ZipFile(entry.path) as wheel:
+                bad_member = wheel.testzip()
+        except zipfile.BadZipFile as e:
+            raise BadDistribution(f"{entry.name} is not a valid wheel") from e
+        if bad_member is not None:
+            raise BadDistribution(f"{entry.name} is corrupt ({bad_member})")
+
+
+def install_options(directory: pathlib.Path) -> list[str]:
+    return ["--no-index", "--find-links", str(directory.absolute())]
+
+
+def discard(directory: pathlib.Path) -> None:
+    shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,170 @@
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Iterable, NamedTuple, Optional
+
+from autoupdater import isolation, markers, requirements
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_BUDGET = 1024 * 1024 * 1024
+_STORE_DIRECTORY = "wheels"
+
+
+class WheelKey(NamedTuple):
+    name: str
+    version: str
+    python_tag: str
+    platform_tag: str
+
+
+def store_dir(base_directory: pathlib.Path) -> pathlib.Path:
+    return base_directory / _STORE_DIRECTORY
+
+
+def wheel_key(file_name: str) -> Optional[WheelKey]:
+    """What a wheel is for, from its file name"""
+    if not file_name.endswith(".whl"):
+        return None
+    # name-version(-build)?-python-abi-platform.whl
+    parts = file_name[: -len(".whl")].split("-")
+    if len(parts) not in (5, 6):
+        return None
+    return WheelKey(
+        name=requirements.canonical_name(parts[0]),
+        version=parts[1],
+        python_tag=parts[-3],
+        platform_tag=parts[-1],
+    )
+
+
+def built_wheels(pip_cache: pathlib.Path) -> set[pathlib.Path]:
+    """The wheels pip built and cached so far"""
+    return set((pip_cache / "wheels").glob("**/*.whl"))
+
+
+class WheelStore:
+    """Wheels pip built from source distributions, kept between venvs and updates
+
+    Building a package from source can take many minutes on a small device, so
+    every wheel pip builds during an install is kept here, one per name,
+    version, python tag and platform tag. Installs look here first. When the
+    store grows beyond `budget` bytes, the wheels that were least recently
+    installed are removed. pip keeps using its own cache, the new wheels in it
+    are copied over after every install. A store can be shared between threads.
+    """
+
+    def __init__(self, directory: pathlib.Path, budget: int = DEFAULT_BUDGET) -> None:
+        self.directory = directory
+        self.budget = budget
+        self._pip_cache: Optional[pathlib.Path] = None
+        self._asked_pip = False
+        self._lock = threading.Lock()
+
+    def install_options(self) -> list[str]:
+        """pip options to use the stored wheels"""
+        os.makedirs(self.directory, exist_ok=True)
+        return ["--find-links", str(self.directory)]
+
+    def pip_cache(
+        self, pip_path: pathlib.Path, limits: isolation.Limits = isolation.NO_LIMITS
+    ) -> Optional[pathlib.Path]:
+        """Where pip keeps its cache, None if pip runs without one"""
+        with self._lock:
+            return self._ask_pip_cache(pip_path, limits)
+
+    def _ask_pip_cache(
+        self, pip_path: pathlib.Path, limits: isolation.Limits
+    ) -> Optional[pathlib.Path]:
+        if not self._asked_pip:
+            self._asked_pip = True
+            result = subprocess.run(
+                limits.wrap([pip_path.absolute(), "cache", "dir"]),
+                capture_output=True,
+                text=True,
+            )
+            if result.returncode == 0 and result.stdout.strip():
+                self._pip_cache = pathlib.Path(result.stdout.strip())
+            else:
+                log.info("pip has no cache, not storing the wheels it builds")
+        return self._pip_cache
+
+    def keep_built(
+        self, pip_cache: pathlib.Path, known: Iterable[pathlib.Path] = ()
+    ) -> None:
+        """Copy the wheels pip built into `pip_cache`, except `known`, into the store"""
+        known = set(known)
+        for wheel in sorted(built_wheels(pip_cache) - known):
+            self.add(wheel)
+
+    def add(self, wheel: pathlib.Path) -> None:
+        if wheel_key(wheel.name) is None:
+            log.debug("Not storing %s, it doesn't look like a wheel", wheel.name)
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=self.directory, prefix=".", delete=False
+        ) as f:
+            partial = pathlib.Path(f.name)
+        try:
+            shutil.copyfile(wheel, partial)
+            os.replace(partial, self.directory / wheel.name)
+        finally:
+            if os.path.lexists(partial):
+                os.remove(partial)
+        log.info("Stored the wheel %s", wheel.name)
+
+    def mark_used(self, installed: Iterable[requirements.Requirement]) -> None:
+        """Count the stored wheels of the `installed` versions as just used"""
+        versions = {
+            (requirement.name, markers.version_key(requirement.version))
+            for requirement in installed
+            if requirement.name is not None and requirement.version is not None
+        }
+        now = time.time()
+        for file_path, key in self._wheels():
+            if (key.name, markers.version_key(key.version)) in versions:
+                os.utime(file_path, (now, now))
+
+    def evict(self) -> None:
+        """Remove the least recently used wheels until the store fits its budget"""
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        wheels = []
+        for file_path, _ in self._wheels():
+            try:
+                stat = file_path.stat()
+            except OSError:
+                continue
+            wheels.append((stat.st_mtime, file_path.name, stat.st_size, file_path))
+        total = sum(size for _, _, size, _ in wheels)
+        for _, _, size, file_path in sorted(wheels):
+            if total <= self.budget:
+                break
+            log.info("Removing the least recently used wheel %s", file_path.name)
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _wheels(self) -> list[tuple[pathlib.Path, WheelKey]]:
+        try:
+            file_names = os.listdir(self.directory)
+        except OSError:
+            return []
+        wheels = []
+        for file_name in file_names:
+            key = wheel_key(file_name)
+            if key is not None and not file_name.startswith("."):
+                wheels.append((self.directory / file_name, key))
+        return wheels
@@ -0,0 +1,144 @@
+import base64
+import contextlib
+import functools
+import hashlib
+import http.server
+import pathlib
+import threading
+import venv as venv_module
+import zipfile
+from typing import Iterator
+
+
+APP_MODULE = "bench_app"
+
+# Records when it was started and stopped, so downtime can be measured from outside
+APP_CODE = """
+import signal
+import sys
+import time
+
+
+def _record(event):
+    with open(sys.argv[1], "a") as f:
+        f.write(f"{event} {time.time()}\\n")
+
+
+def _stop(signum, frame):
+    _record("stop")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _stop)
+    _record("start")
+    while True:
+        time.sleep(3600)
+"""
+
+
+def _record_hash(data: bytes) -> str:
+    digest = hashlib.sha256(data).digest()
+    return "sha256=" + base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+
+def build_wheel(
+    directory: pathlib.Path, name: str, version: str, modules: dict[str, str]
+) -> pathlib.Path:
+    """Write a minimal pure python wheel containing `modules`"""
+    distribution = name.replace("-", "_")
+    dist_info = f"{distribution}-{version}.dist-info"
+    files = {f"{module}.py": code.encode("utf-8") for module, code in modules.items()}
+    files[f"{dist_info}/METADATA"] = (
+        f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n"
+    ).encode("utf-8")
+    files[f"{dist_info}/WHEEL"] = (
+        b"Wheel-Version: 1.0\nGenerator: autoupdater-benchmarks\n"
+        b"Root-Is-Purelib: true\nTag: py3-none-any\n"
+    )
+    record = "".join(
+        f"{file_name},{_record_hash(data)},{len(data)}\n"
+        for file_name, data in files.items()
+    )
+    files[f"{dist_info}/RECORD"] = (record + f"{dist_info}/RECORD,,\n").encode("utf-8")
+
+    directory.mkdir(parents=True, exist_ok=True)
+    wheel_path = directory / f"{distribution}-{version}-py3-none-any.whl"
+    with zipfile.ZipFile(wheel_path, "w") as wheel:
+        for file_name, data in files.items():
+            wheel.writestr(file_name, data)
+    return wheel_path
+
+
+def build_index(index_directory: pathlib.Path, wheels: list[pathlib.Path]) -> str:
+    """Lay out `wheels` as a PEP 503 simple index and return its file:// url"""
+    projects: dict[str, list[pathlib.Path]] = {}
+    for wheel in wheels:
+        name = wheel.name.split("-")[0].replace("_", "-").lower()
+        projects.setdefault(name, []).append(wheel)
+    simple = index_directory / "simple"
+    for name, project_wheels in projects.items():
+        (simple / name).mkdir(parents=True, exist_ok=True)
+        links = "".join(
+            f'<a href="{wheel.absolute().as_uri()}#sha256='
+            f'{hashlib.sha256(wheel.read_bytes()).hexdigest()}">{wheel.name}</a>\n'
+            for wheel in project_wheels
+        )
+        with open(simple / name / "index.html", "w") as f:
+            f.write(f"<!DOCTYPE html><html><body>\n{links}</body></html>\n")
+    return simple.absolute().as_uri()
+
+
+def build_packages(
+    directory: pathlib.Path, count: int, versions: list[str]
+) -> list[pathlib.Path]:
+    wheels = [
+        build_wheel(
+            directory / "wheels",
+            APP_MODULE.replace("_", "-"),
+            version,
+            {APP_MODULE: APP_CODE},
+        )
+        for version in versions
+    ]
+    for i in range(count):
+        for version in versions:
+            wheels.append(
+                build_wheel(
+                    directory / "wheels",
+                    f"bench-dep-{i}",
+                    version,
+                    {f"bench_dep_{i}": f"VERSION = {version!r}\n"},
+                )
+            )
+    return wheels
+
+
+def lockfile(index_url: str, count: int, version: str) -> str:
+    lines = [f"--index-url {index_url}", f"bench-app=={version}"]
+    lines += [f"bench-dep-{i}=={version}" for i in range(count)]
+    return "\n".join(lines) + "\n"
+
+
+def create_venv(venv_dir: pathlib.Path) -> None:
+    # Unlike autoupdater itself this doesn't upgrade pip, which would need the network
+    venv_module.create(venv_dir, with_pip=True)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+@contextlib.contextmanager
+def http_server(directory: pathlib.Path) -> Iterator[str]:
+    """Serve `directory` on localhost and yield its base url"""
+    handler = functools.partial(_QuietHandler, directory=str(directory))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,275 @@
+import json
+import os
+import pathlib
+import platform
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Optional
+
+import click
+
+from autoupdater import core, inventory, requirements
+from benchmarks import fixtures
+
+
+REPOSITORY = pathlib.Path(__file__).absolute().parent.parent
+
+
+def timed(fn: Callable[[], Any], repeat: int) -> dict[str, float]:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return {
+        "median": statistics.median(durations),
+        "min": min(durations),
+        "max": max(durations),
+        "runs": repeat,
+    }
+
+
+def timed_once(fn: Callable[[], Any]) -> dict[str, float]:
+    return timed(fn, 1)
+
+
+def bench_phases(workdir: pathlib.Path, packages: int, repeat: int) -> dict:
+    wheels = fixtures.build_packages(workdir, packages, ["1.0.0", "2.0.0"])
+    index_url = fixtures.build_index(workdir / "index", wheels)
+    served = workdir / "served"
+    served.mkdir()
+    with open(served / "requirements.txt", "w") as f:
+        f.write(fixtures.lockfile(index_url, packages, "1.0.0"))
+
+    results = {}
+    with fixtures.http_server(served) as base_url:
+        url = f"{base_url}/requirements.txt"
+        results["digest_from_requirements_file.cold"] = timed(
+            lambda: requirements.digest_from_requirements_file(
+                url, requirements.Fetcher()
+            ),
+            repeat,
+        )
+        fetcher = requirements.Fetcher()
+        digest = requirements.digest_from_requirements_file(url, fetcher)
+        results["digest_from_requirements_file.not_modified"] = timed(
+            lambda: requirements.digest_from_requirements_file(url, fetcher), repeat
+        )
+
+        base_directory = workdir / "phases"
+        fixtures.create_venv(base_directory / "venv")
+        venv = core.Venv(
+            spec=core.VenvSpec(requirements_file=url, base_directory=base_directory),
+            state=core.VenvState(),
+            fetcher=fetcher,
+        )
+        results["install.initial"] = timed_once(
+            lambda: core.ensure_digest_installed(venv, digest)
+        )
+
+        venv_dir = venv.spec.venv_dir()
+
+        def freeze_cold() -> None:
+            inventory._cache.clear()
+            inventory.freeze(venv_dir)
+
+        results["inventory.freeze.cold"] = timed(freeze_cold, repeat)
+        results["inventory.freeze.cached"] = timed(
+            lambda: inventory.freeze(venv_dir), repeat
+        )
+        results["pip_freeze"] = timed(
+            lambda: subprocess.run(
+                [venv.spec.pip_path(), "freeze"], check=True, capture_output=True
+            ),
+            repeat,
+        )
+
+        installed = inventory.freeze(venv_dir)
+        new_lockfile = fixtures.lockfile(index_url, packages, "2.0.0")
+        results["requirements.diff"] = timed(
+            lambda: requirements.diff(installed, new_lockfile),
+            max(repeat, 100),
+        )
+
+        with open(served / "requirements.txt", "w") as f:
+            f.write(new_lockfile)
+        new_digest = requirements.digest_from_requirements_file(url, fetcher)
+        # Don't measure the pause autoupdater makes between two quick attempts
+        venv.state.when_last_update_attempt = 0
+        results["prefetch.upgrade"] = timed_once(
+            lambda: core.prefetch_update(venv, new_digest)
+        )
+        results["install.upgrade"] = timed_once(
+            lambda: core.ensure_digest_installed(venv, new_digest)
+        )
+    return results
+
+
+def _start_supervisor(
+    workdir: pathlib.Path, requirements_file: pathlib.Path, options: list[str]
+) -> tuple[subprocess.Popen, pathlib.Path]:
+    events_file = workdir / "events.txt"
+    env = dict(os.environ, PYTHONPATH=str(REPOSITORY))
+    supervisor = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "autoupdater",
+            *options,
+            str(requirements_file),
+            fixtures.APP_MODULE,
+            str(events_file),
+        ],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return supervisor, events_file
+
+
+def _events(events_file: pathlib.Path) -> list[tuple[str, float]]:
+    try:
+        with open(events_file, "r") as f:
+            lines = f.read().split("\n")
+    except FileNotFoundError:
+        return []
+    return [(e, float(t)) for e, t in (l.split() for l in lines if l.strip())]
+
+
+def _wait_for_starts(
+    events_file: pathlib.Path, count: int, timeout: float = 300
+) -> list[tuple[str, float]]:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        events = _events(events_file)
+        if sum(1 for e, _ in events if e == "start") >= count:
+            return events
+        time.sleep(0.05)
+    raise TimeoutError(f"The program was not started {count} times")
+
+
+def _stop_supervisor(supervisor: subprocess.Popen) -> None:
+    supervisor.send_signal(signal.SIGTERM)
+    try:
+        supervisor.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        supervisor.kill()
+        supervisor.wait()
+
+
+def _prepare_supervisor_directory(
+    workdir: pathlib.Path, packages: int
+) -> tuple[pathlib.Path, str]:
+    wheels = fixtures.build_packages(workdir, packages, ["1.0.0", "2.0.0"])
+    index_url = fixtures.build_index(workdir / "index", wheels)
+    fixtures.create_venv(workdir / "venv")
+    requirements_file = workdir / "requirements.txt"
+    with open(requirements_file, "w") as f:
+        f.write(fixtures.lockfile(index_url, packages, "1.0.0"))
+    return requirements_file, index_url
+
+
+def bench_restart(workdir: pathlib.Path, packages: int) -> dict:
+    requirements_file, index_url = _prepare_supervisor_directory(workdir, packages)
+    supervisor, events_file = _start_supervisor(workdir, requirements_file, [])
+    try:
+        _wait_for_starts(events_file, 1)
+        # Don't measure the pause autoupdater makes between two quick attempts
+        time.sleep(core._MIN_TIME_BETWEEN_ATTEMPTS)
+        changed = time.time()
+        with open(requirements_file, "w") as f:
+            f.write(fixtures.lockfile(index_url, packages, "2.0.0"))
+        events = _wait_for_starts(events_file, 2)
+    finally:
+        _stop_supervisor(supervisor)
+    stopped = next(t for e, t in events if e == "stop")
+    restarted = [t for e, t in events if e == "start"][1]
+    return {
+        "detect_to_restart.seconds": restarted - changed,
+        "detect_to_stop.seconds": stopped - changed,
+        "downtime.seconds": restarted - stopped,
+    }
+
+
+def _proc_stats(pid: int) -> tuple[float, int]:
+    with open(f"/proc/{pid}/stat", "r") as f:
+        fields = f.read().rsplit(")", maxsplit=1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    context_switches = 0
+    with open(f"/proc/{pid}/status", "r") as f:
+        for line in f:
+            if line.startswith(
+                ("voluntary_ctxt_switches", "nonvoluntary_ctxt_switches")
+            ):
+                context_switches += int(line.split()[1])
+    return cpu_seconds, context_switches
+
+
+def bench_idle(workdir: pathlib.Path, seconds: float) -> Optional[dict]:
+    if not os.path.exists("/proc/self/stat"):
+        return None
+    requirements_file, _ = _prepare_supervisor_directory(workdir, 1)
+    supervisor, events_file = _start_supervisor(
+        workdir, requirements_file, ["--interval", "3600"]
+    )
+    try:
+        _wait_for_starts(events_file, 1)
+        time.sleep(1)
+        cpu_before, switches_before = _proc_stats(supervisor.pid)
+        time.sleep(seconds)
+        cpu_after, switches_after = _proc_stats(supervisor.pid)
+    finally:
+        _stop_supervisor(supervisor)
+    return {
+        "idle.cpu_seconds_per_minute": (cpu_after - cpu_before) * 60 / seconds,
+        "idle.wakeups_per_minute": (switches_after - switches_before) * 60 / seconds,
+    }
+
+
+@click.command
+@click.option("--output", type=click.Path(dir_okay=False), default=None)
+@click.option("--packages", type=int, default=20, help="Distributions per lockfile")
+@click.option("--repeat", type=int, default=10)
+@click.option("--idle-seconds", type=float, default=10)
+def main(
+    output: Optional[str], packages: int, repeat: int, idle_seconds: float
+) -> None:
+    """Benchmark autoupdater without touching the network
+
+    Results are written as JSON, durations are in seconds.
+    """
+    results: dict[str, Any] = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workdir = pathlib.Path(tmp_dir)
+        for name, bench in [
+            ("phases", lambda d: bench_phases(d, packages, repeat)),
+            ("restart", lambda d: bench_restart(d, packages)),
+            ("idle", lambda d: bench_idle(d, idle_seconds)),
+        ]:
+            directory = workdir / name
+            directory.mkdir()
+            click.echo(f"Running {name} benchmarks...", err=True)
+            results[name] = bench(directory)
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "timestamp": time.time(),
+        "packages": packages,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output is None:
+        click.echo(text)
+    else:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
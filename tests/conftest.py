@@ -1,12 +1,14 @@
 from os import path
 import pathlib
 import shutil
-from typing import Callable
+from typing import Callable, Optional
 from unittest import mock
+import selectors
+import time
 import freezegun
 import pytest
 
-from autoupdater import core
+from autoupdater import core, events, requirements
 
 
 DATA_DIR = pathlib.Path(path.dirname(__file__)) / "data"
@@ -29,6 +31,32 @@ def frozen_time(on_post_sleep: Callable[[float], None]):
         yield frozen_time
 
 
+@pytest.fixture(autouse=True)
+def fresh_default_fetcher() -> None:
+    # Backoff state must not leak from one test into the next
+    requirements._default_fetcher = None
+
+
+class FrozenClock(events.Clock):
+    """Only polls for events and lets `time.sleep` pass the time instead"""
+
+    def select(
+        self, selector: selectors.BaseSelector, timeout: Optional[float]
+    ) -> list[tuple[selectors.SelectorKey, int]]:
+        if timeout is None:
+            # Nothing to time out, only an event can end the wait
+            return selector.select()
+        ready = selector.select(0)
+        if not ready:
+            time.sleep(timeout)
+        return ready
+
+
+@pytest.fixture
+def clock() -> events.Clock:
+    return FrozenClock()
+
+
 @pytest.fixture
 def requirements_file(tmp_path: pathlib.Path) -> str:
     shutil.copy(
@@ -0,0 +1,71 @@
+import json
+import pathlib
+
+import pytest
+
+from autoupdater import config
+
+
+def _write_config(tmp_path: pathlib.Path, data: dict) -> pathlib.Path:
+    config_file = tmp_path / "services.json"
+    with open(config_file, "w") as f:
+        json.dump(data, f)
+    return config_file
+
+
+class TestLoadServices:
+    def test_happy_path(self, tmp_path: pathlib.Path) -> None:
+        config_file = _write_config(
+            tmp_path,
+            {
+                "services": [
+                    {
+                        "requirements_file": "https://www.example.com/a.txt",
+                        "module": "a",
+                        "args": ["--port", 8080],
+                        "base_directory": "a",
+                        "listen": ["http=8080"],
+                    },
+                    {
+                        "requirements_file": "b.txt",
+                        "module": "b",
+                        "base_directory": "b",
+                        "mirrors": ["https://mirror/b.txt", "b-copy.txt"],
+                    },
+                ]
+            },
+        )
+
+        services = config.load_services(config_file)
+
+        assert services == [
+            config.ServiceConfig(
+                requirements_file="https://www.example.com/a.txt",
+                module="a",
+                args=["--port", "8080"],
+                base_directory=tmp_path / "a",
+                listen=("http=8080",),
+            ),
+            config.ServiceConfig(
+                requirements_file=str(tmp_path / "b.txt"),
+                module="b",
+                args=[],
+                base_directory=tmp_path / "b",
+                mirrors=("https://mirror/b.txt", str(tmp_path / "b-copy.txt")),
+            ),
+        ]
+
+    def test_missing_key(self, tmp_path: pathlib.Path) -> None:
+        config_file = _write_config(
+            tmp_path, {"services": [{"module": "a", "base_directory": "a"}]}
+        )
+
+        with pytest.raises(config.ConfigError, match="requirements_file"):
+            config.load_services(config_file)
+
+    def test_shared_base_directory(self, tmp_path: pathlib.Path) -> None:
+        service = {"requirements_file": "a.txt", "module": "a", "base_directory": "a"}
+        config_file = _write_config(tmp_path, {"services": [service, service]})
+
+        with pytest.raises(config.ConfigError, match="base_directory"):
+            config.load_services(config_file)
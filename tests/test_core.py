@@ -1,12 +1,31 @@
+import dataclasses
 import logging
 from os import path
 import shutil
 import pathlib
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
 import time
 from typing import Any
+from unittest import mock
 
 import pytest
-from autoupdater import core
+from autoupdater import (
+    config,
+    core,
+    events,
+    handoff,
+    inventory,
+    journal,
+    requirements,
+    schedule,
+    wheelstore,
+)
+from benchmarks import fixtures
 
 
 class TestEnsureVenv:
@@ -31,6 +50,45 @@ class TestInitVenv:
         assert venv.spec.venv_dir() == base_directory / "venv"
 
 
+class TestResume:
+    @pytest.fixture
+    def recorded_venv(self, venv_spec: core.VenvSpec) -> core.Venv:
+        (venv_spec.venv_dir() / "bin").mkdir(parents=True)
+        venv_spec.pip_path().touch()
+        venv = core.Venv(
+            spec=venv_spec,
+            state=core.VenvState(installed_digest=b"digest", last_updated_timestamp=5),
+        )
+        venv.approve_venv()
+        core.record_state(venv)
+        return venv
+
+    def _template(self, venv_spec: core.VenvSpec) -> core.Venv:
+        return core.venv_template(venv_spec.requirements_file, venv_spec.base_directory)
+
+    def test_resume_approved_venv(
+        self, recorded_venv: core.Venv, venv_spec: core.VenvSpec
+    ) -> None:
+        with mock.patch.object(
+            requirements, "read_requirements_file", side_effect=AssertionError
+        ), mock.patch("subprocess.run", side_effect=AssertionError):
+            resumed = core.resume_venv(self._template(venv_spec), staged=False)
+
+        assert resumed is not None
+        assert resumed.spec == recorded_venv.spec
+        assert resumed.state == recorded_venv.state
+
+    def test_no_resume_after_approval_revoked(
+        self, recorded_venv: core.Venv, venv_spec: core.VenvSpec
+    ) -> None:
+        recorded_venv.revoke_approval()
+
+        assert core.resume_venv(self._template(venv_spec), staged=False) is None
+
+    def test_no_resume_without_journal(self, venv_spec: core.VenvSpec) -> None:
+        assert core.resume_venv(self._template(venv_spec), staged=False) is None
+
+
 class TestRunProgramUntilDeadOrUpdated:
     @pytest.fixture
     def on_post_sleep(self, requirements_file: str) -> None:
@@ -41,16 +99,661 @@ class TestRunProgramUntilDeadOrUpdated:
         return _callback
 
     def test_update_on_requirement_file_changed(
-        self, venv: core.Venv, module: str, caplog: Any
+        self, venv: core.Venv, module: str, caplog: Any, clock: events.Clock
     ) -> None:
         caplog.set_level(logging.INFO)
         start = time.time()  # this is a frozen time!
         initial_digest = venv.state.installed_digest
 
-        new_digest = core.run_program_until_dead_or_updated(venv, module, [], 0.5, 1)
+        new_digest = core.run_program_until_dead_or_updated(
+            venv, module, [], 0.5, 1, clock=clock
+        )
 
         assert "Update detected!" in [r.message for r in caplog.records]
         # This is essentially counting the calls to time.sleep because of the frozen time
         # The whole test is a little sketchy but seems to do the trick
         assert time.time() - start <= 2
         assert initial_digest != new_digest
+
+
+class TestRunProgramUntilDeadOrUpdatedEvents:
+    def test_restart_on_exit(self, venv: core.Venv, caplog: Any) -> None:
+        caplog.set_level(logging.INFO)
+
+        # Without the exit waking up the supervisor this would wait for the update check
+        new_digest = core.run_program_until_dead_or_updated(
+            venv, "module_that_does_not_exist", [], 1000, 1
+        )
+
+        assert new_digest is None
+        assert "Process completed, restarting" in [r.message for r in caplog.records]
+
+    def test_exit_is_recorded(self, venv: core.Venv) -> None:
+        restarts = schedule.RestartPolicy(stable_after=60)
+
+        core.run_program_until_dead_or_updated(
+            venv, "module_that_does_not_exist", [], 1000, 1, restarts=restarts
+        )
+
+        assert restarts.failures == 1
+        assert restarts.last_exit == "crash"
+
+    def test_restart_does_not_wait_for_check(
+        self, venv: core.Venv, caplog: Any
+    ) -> None:
+        caplog.set_level(logging.INFO)
+        unreachable = threading.Event()
+
+        with mock.patch(
+            "autoupdater.core.maybe_new_requirements_digest",
+            side_effect=lambda venv: unreachable.wait(),
+        ):
+            new_digest = core.run_program_until_dead_or_updated(
+                venv, "module_that_does_not_exist", [], 0, 1
+            )
+        unreachable.set()
+
+        assert new_digest is None
+        assert "Process completed, restarting" in [r.message for r in caplog.records]
+
+    def test_generation_marked_good_when_healthy(
+        self, venv: core.Venv, module: str, clock: events.Clock
+    ) -> None:
+        shutdown = events.ShutdownFlag()
+
+        with mock.patch(
+            "autoupdater.core.mark_generation_good",
+            side_effect=lambda venv: shutdown.set(),
+        ) as mark_generation_good, pytest.raises(events.Shutdown):
+            core.run_program_until_dead_or_updated(
+                venv,
+                module,
+                [],
+                1000,
+                1,
+                staged=True,
+                clock=clock,
+                shutdown=shutdown,
+                healthy_after=30,
+            )
+
+        mark_generation_good.assert_called_once_with(venv)
+
+    def test_shutdown_on_sigterm(self, venv: core.Venv, module: str) -> None:
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+
+        with pytest.raises(events.Shutdown):
+            core.run_program_until_dead_or_updated(venv, module, [], 1000, 1)
+
+        assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+
+
+class TestSocketHandoff:
+    @pytest.fixture
+    def socket_handoff(self, venv: core.Venv) -> Any:
+        previous = core.Program(
+            process=subprocess.Popen(
+                [sys.executable, "-c", "import time; time.sleep(60)"]
+            ),
+            venv=venv,
+            when_last_update_check=0,
+            handed_over=True,
+        )
+        socket_handoff = core.SocketHandoff(
+            handoff.listen(["127.0.0.1:0"]), ready_timeout=5, previous=previous
+        )
+        yield socket_handoff
+        previous.process.kill()
+        previous.process.wait()
+        socket_handoff.sockets.close()
+
+    def test_previous_stopped_after_ready_timeout(
+        self,
+        venv: core.Venv,
+        module: str,
+        clock: events.Clock,
+        socket_handoff: core.SocketHandoff,
+    ) -> None:
+        previous = socket_handoff.previous
+        shutdown = events.ShutdownFlag()
+        stopped = threading.Thread(
+            target=lambda: (previous.process.wait(), shutdown.set())
+        )
+        stopped.start()
+
+        with pytest.raises(events.Shutdown):
+            core.run_program_until_dead_or_updated(
+                venv,
+                module,
+                [],
+                1000,
+                1,
+                staged=True,
+                clock=clock,
+                shutdown=shutdown,
+                socket_handoff=socket_handoff,
+            )
+        stopped.join()
+
+        assert socket_handoff.previous is None
+        assert not previous.is_running()
+
+    def test_previous_keeps_serving_if_next_exits(
+        self, venv: core.Venv, socket_handoff: core.SocketHandoff
+    ) -> None:
+        new_digest = core.run_program_until_dead_or_updated(
+            venv,
+            "module_that_does_not_exist",
+            [],
+            1000,
+            1,
+            staged=True,
+            socket_handoff=socket_handoff,
+        )
+
+        assert new_digest is None
+        assert socket_handoff.previous.is_running()
+
+
+class TestUpdateChecker:
+    def test_posts_prepared_update(self, venv: core.Venv) -> None:
+        checker = core.UpdateChecker(venv, staged=False)
+
+        with mock.patch(
+            "autoupdater.core.maybe_new_requirements_digest", return_value=b"new"
+        ), mock.patch("autoupdater.core.prepare_update") as prepare_update:
+            checker.check()
+            select.select([checker.finished], [], [], 5)
+
+        assert checker.take() == b"new"
+        assert checker.take() is None
+        assert not checker.is_busy()
+        prepare_update.assert_called_once_with(venv, b"new", False)
+
+    def test_failed_preparation_posts_nothing(self, venv: core.Venv) -> None:
+        checker = core.UpdateChecker(venv, staged=False)
+
+        with mock.patch(
+            "autoupdater.core.maybe_new_requirements_digest", return_value=b"new"
+        ), mock.patch("autoupdater.core.prepare_update", side_effect=ValueError()):
+            checker.check()
+            select.select([checker.finished], [], [], 5)
+
+        assert checker.take() is None
+
+
+class TestGenerations:
+    def test_point_current_at(self, base_directory: pathlib.Path) -> None:
+        (base_directory / "venvs" / "aaaa").mkdir(parents=True)
+        (base_directory / "venvs" / "bbbb").mkdir(parents=True)
+
+        core._point_current_at(base_directory, "venvs/aaaa")
+        core._point_current_at(base_directory, "venvs/bbbb")
+
+        assert core.current_generation(base_directory) == "venvs/bbbb"
+        assert (base_directory / "current").resolve() == (
+            base_directory / "venvs" / "bbbb"
+        ).resolve()
+
+    def test_prune_generations(self, base_directory: pathlib.Path) -> None:
+        for name in ["aaaa", "bbbb", "cccc"]:
+            (base_directory / "venvs" / name).mkdir(parents=True)
+
+        core._prune_generations(base_directory, keep={"venvs/bbbb", "venvs/cccc"})
+
+        assert sorted(p.name for p in (base_directory / "venvs").iterdir()) == [
+            "bbbb",
+            "cccc",
+        ]
+
+    def test_generation_name(self) -> None:
+        assert core.generation_name(bytes(range(32))) == "venvs/0001020304050607"
+
+    def _fake_generation(self, venv_spec: core.VenvSpec, digest: bytes) -> core.Venv:
+        spec = core.VenvSpec(
+            requirements_file=venv_spec.requirements_file,
+            base_directory=venv_spec.base_directory,
+            name=core.generation_name(digest),
+        )
+        (spec.venv_dir() / "bin").mkdir(parents=True)
+        spec.pip_path().touch()
+        venv = core.Venv(spec=spec, state=core.VenvState(installed_digest=digest))
+        venv.approve_venv()
+        return venv
+
+    def test_roll_back_to_good_generation(self, venv_spec: core.VenvSpec) -> None:
+        good = self._fake_generation(venv_spec, b"good" * 8)
+        bad = self._fake_generation(venv_spec, b"bad!" * 8)
+        core.mark_generation_good(good)
+        core._point_current_at(venv_spec.base_directory, bad.spec.name)
+
+        with mock.patch("subprocess.run") as run:
+            rolled_back = core.roll_back(bad)
+
+        run.assert_not_called()
+        assert rolled_back.spec == good.spec
+        assert rolled_back.state.installed_digest == b"good" * 8
+        assert core.current_generation(venv_spec.base_directory) == good.spec.name
+        assert core.is_generation_bad(venv_spec.base_directory, b"bad!" * 8)
+        assert not core.is_generation_bad(venv_spec.base_directory, b"good" * 8)
+
+    def test_no_roll_back_without_good_generation(
+        self, venv_spec: core.VenvSpec
+    ) -> None:
+        bad = self._fake_generation(venv_spec, b"bad!" * 8)
+
+        assert core.roll_back(bad) is None
+        assert not core.is_generation_bad(venv_spec.base_directory, b"bad!" * 8)
+
+    def test_generation_shares_settings(self, venv_spec: core.VenvSpec) -> None:
+        template = core.venv_template(
+            venv_spec.requirements_file,
+            venv_spec.base_directory,
+            mirrors=["https://mirror/requirements.txt"],
+            lock_mode="off",
+            keep_generations=5,
+        )
+
+        generation = core._existing_generation(template, "generation")
+
+        assert generation.spec.name == "generation"
+        assert generation.spec.mirrors == ("https://mirror/requirements.txt",)
+        assert generation.lock_mode == "off"
+        assert generation.keep_generations == 5
+        assert generation.fetcher is template.fetcher
+
+    def test_stage_generation_clones_current(self, venv_spec: core.VenvSpec) -> None:
+        current = self._fake_generation(venv_spec, b"old!" * 8)
+        (current.spec.venv_dir() / "lib").mkdir()
+        (current.spec.venv_dir() / "lib" / "module.py").write_text("x = 1\n")
+        core._point_current_at(venv_spec.base_directory, current.spec.name)
+
+        with mock.patch.object(core, "ensure_digest_installed") as ensure_installed:
+            staged = core.stage_generation(
+                core.Venv(spec=venv_spec, state=core.VenvState()), b"new!" * 8
+            )
+
+        ensure_installed.assert_called_once_with(staged, b"new!" * 8)
+        assert staged.spec.name == core.generation_name(b"new!" * 8)
+        assert (staged.spec.venv_dir() / "lib" / "module.py").read_text() == "x = 1\n"
+        assert staged.approved_digest() is None
+
+    def test_recent_generations(self, base_directory: pathlib.Path) -> None:
+        for when, name in enumerate(["aaaa", "bbbb", "cccc", "dddd"]):
+            (base_directory / "venvs" / name).mkdir(parents=True)
+            marker = base_directory / "venvs" / name / "__activated__"
+            marker.touch()
+            os.utime(marker, (when, when))
+        (base_directory / "venvs" / "eeee").mkdir()
+
+        assert core._recent_generations(base_directory, 2) == [
+            "venvs/dddd",
+            "venvs/cccc",
+        ]
+
+
+class TestApplyPlan:
+    @pytest.fixture
+    def fake_venv(self, venv_spec: core.VenvSpec) -> core.Venv:
+        site_packages = venv_spec.venv_dir() / "lib" / "python3.9" / "site-packages"
+        for name in ["unicorn", "bad_vibes"]:
+            dist_info = site_packages / f"{name}-1.0.0.dist-info"
+            dist_info.mkdir(parents=True)
+            with open(dist_info / "METADATA", "w") as f:
+                f.write(f"Name: {name}\nVersion: 1.0.0\n")
+        venv = core.Venv(spec=venv_spec, state=core.VenvState())
+        venv.state.installed_digest = b"old"
+        venv.approve_venv()
+        return venv
+
+    def _fake_pip(self, venv: core.Venv, calls: list, fail_install: bool):
+        site_packages = venv.spec.venv_dir() / "lib" / "python3.9" / "site-packages"
+
+        def run(command: list, check: bool) -> None:
+            if command[1] == "uninstall":
+                calls.append(command[1:])
+                for name in command[3:]:
+                    shutil.rmtree(
+                        site_packages / f"{name.replace('-', '_')}-1.0.0.dist-info"
+                    )
+                os.utime(site_packages, ns=(1, 1))
+            else:
+                with open(command[-1]) as f:
+                    calls.append(command[1:-2] + [f.read()])
+                if fail_install:
+                    raise subprocess.CalledProcessError(1, command)
+
+        return run
+
+    def test_upgrade_in_place(self, fake_venv: core.Venv) -> None:
+        calls = []
+        update_plan = requirements.plan(
+            core.installed_requirements(fake_venv), "unicorn==2.0.0\n"
+        )
+
+        with mock.patch(
+            "subprocess.run", side_effect=self._fake_pip(fake_venv, calls, False)
+        ), mock.patch("autoupdater.core.marker_environment", return_value=None):
+            core.apply_plan(fake_venv, update_plan, [])
+
+        assert calls == [
+            ["install", "--no-compile", "unicorn==2.0.0"],
+            ["uninstall", "-y", "bad-vibes"],
+        ]
+        assert not fake_venv.is_venv_approved_for_digest(b"old")
+        assert not path.exists(fake_venv.spec.venv_dir() / "__rollback__")
+
+    def test_unpinned_dependency_is_kept(self, fake_venv: core.Venv) -> None:
+        calls = []
+        metadata = fake_venv.spec.venv_dir().glob(
+            "lib/*/site-packages/unicorn-*/METADATA"
+        )
+        with open(next(metadata), "a") as f:
+            f.write("Requires-Dist: bad-vibes>=1.0\n")
+        update_plan = requirements.plan(
+            core.installed_requirements(fake_venv), "unicorn==2.0.0\n"
+        )
+
+        with mock.patch(
+            "subprocess.run", side_effect=self._fake_pip(fake_venv, calls, False)
+        ), mock.patch("autoupdater.core.marker_environment", return_value=None):
+            core.apply_plan(fake_venv, update_plan, [])
+
+        assert update_plan.remove == ["bad_vibes==1.0.0"]
+        assert calls == [["install", "--no-compile", "unicorn==2.0.0"]]
+
+    def test_rollback_on_failure(self, fake_venv: core.Venv) -> None:
+        calls = []
+        update_plan = requirements.plan(
+            core.installed_requirements(fake_venv), "unicorn==2.0.0\n"
+        )
+
+        with mock.patch(
+            "subprocess.run", side_effect=self._fake_pip(fake_venv, calls, True)
+        ), pytest.raises(subprocess.CalledProcessError):
+            core.apply_plan(fake_venv, update_plan, [])
+
+        # Nothing was removed, so there is nothing to roll back
+        assert calls == [["install", "--no-compile", "unicorn==2.0.0"]]
+        assert "bad_vibes==1.0.0" in core.installed_requirements(fake_venv)
+        assert not path.exists(fake_venv.spec.venv_dir() / "__rollback__")
+        assert fake_venv.is_venv_approved_for_digest(b"old")
+
+    def test_built_wheels_are_stored(
+        self, fake_venv: core.Venv, tmp_path: pathlib.Path
+    ) -> None:
+        fake_venv.wheel_store = wheelstore.WheelStore(tmp_path / "store")
+        update_plan = requirements.plan(
+            core.installed_requirements(fake_venv),
+            "unicorn==1.0.0\nbad_vibes==1.0.0\nslow-build==1.0\n",
+        )
+        built = tmp_path / "pip-cache" / "wheels" / "ab"
+        built.mkdir(parents=True)
+        (built / "old-1.0-py3-none-any.whl").touch()
+        commands = []
+
+        def run(command: list, check: bool = False, **kwargs: Any) -> Any:
+            if command[1:] == ["cache", "dir"]:
+                return mock.Mock(returncode=0, stdout=f"{tmp_path / 'pip-cache'}\n")
+            commands.append(command)
+            (built / "slow_build-1.0-cp39-cp39-linux_armv7l.whl").touch()
+
+        with mock.patch("subprocess.run", side_effect=run):
+            core.apply_plan(fake_venv, update_plan, [])
+
+        assert "--cache-dir" not in commands[0]
+        assert commands[0][commands[0].index("--find-links") + 1] == str(
+            tmp_path / "store"
+        )
+        assert os.listdir(tmp_path / "store") == [
+            "slow_build-1.0-cp39-cp39-linux_armv7l.whl"
+        ]
+
+
+class TestCompileAndWarmUp:
+    def test_compile_bytecode(self, venv: core.Venv) -> None:
+        site_packages = pathlib.Path(
+            inventory.site_packages_dirs(venv.spec.venv_dir())[0]
+        )
+        with open(site_packages / "fresh_module.py", "w") as f:
+            f.write("VALUE = 1\n")
+
+        core.compile_bytecode(venv)
+
+        assert list((site_packages / "__pycache__").glob("fresh_module.*.pyc"))
+
+    def test_warm_up(self, venv: core.Venv, module: str) -> None:
+        core.warm_up(venv, module)
+
+    def test_warm_up_failure(self, venv: core.Venv) -> None:
+        with pytest.raises(core.BaseException):
+            core.warm_up(venv, "module_that_does_not_exist")
+
+
+class TestApplyOrKeep:
+    @pytest.fixture
+    def approved_venv(self, venv_spec: core.VenvSpec) -> core.Venv:
+        venv_spec.venv_dir().mkdir(parents=True)
+        venv = core.Venv(spec=venv_spec, state=core.VenvState(installed_digest=b"old"))
+        venv.approve_venv()
+        return venv
+
+    def test_failed_update_keeps_venv(self, approved_venv: core.Venv) -> None:
+        with mock.patch.object(
+            core, "apply_update", side_effect=core.BaseException("no such version")
+        ) as apply_update:
+            assert core._apply_or_keep(approved_venv, b"new", False) is None
+
+        assert apply_update.call_count == 1
+        entry = journal.load(approved_venv.spec.base_directory)
+        assert entry.installed_digest == b"old"
+        assert entry.failed_digest == b"new"
+
+    def test_broken_venv_is_retried(self, approved_venv: core.Venv) -> None:
+        approved_venv.revoke_approval()
+        updated = core.Venv(spec=approved_venv.spec, state=core.VenvState())
+
+        with mock.patch.object(
+            core,
+            "apply_update",
+            side_effect=[core.BaseException("pip failed"), updated],
+        ):
+            assert core._apply_or_keep(approved_venv, b"new", False) is updated
+
+
+class TestUpdates:
+    """Real venvs and pip, against a local directory of wheels"""
+
+    @pytest.mark.parametrize("staged", [False, True])
+    def test_update_and_roll_back(self, tmp_path: pathlib.Path, staged: bool) -> None:
+        wheels = tmp_path / "wheels"
+        for version in ["1.0", "2.0"]:
+            fixtures.build_wheel(
+                wheels, "unicorn", version, {"unicorn": f"VERSION = {version!r}\n"}
+            )
+        requirements_file = tmp_path / "requirements.txt"
+        base_directory = tmp_path / "base"
+
+        def pin(version: str) -> None:
+            requirements_file.write_text(
+                f"--no-index\n--find-links {wheels}\nunicorn=={version}\n"
+            )
+
+        pin("1.0")
+        venv = core.init_venv(str(requirements_file), base_directory, staged=staged)
+        assert "unicorn==1.0" in core.installed_requirements(venv).splitlines()
+
+        pin("2.0")
+        digest = core.maybe_new_requirements_digest(venv)
+        core.prepare_update(venv, digest, staged)
+        venv = core.apply_update(venv, digest, staged)
+
+        assert "unicorn==2.0" in core.installed_requirements(venv).splitlines()
+        assert venv.is_venv_approved_for_digest(digest)
+        if staged:
+            assert core.current_generation(base_directory) == venv.spec.name
+
+        # There is no such version, the update fails and the venv stays usable
+        pin("3.0")
+        failed_digest = core.maybe_new_requirements_digest(venv)
+
+        assert core._apply_or_keep(venv, failed_digest, staged) is None
+        assert "unicorn==2.0" in core.installed_requirements(venv).splitlines()
+        assert venv.is_venv_approved_for_digest(digest)
+        assert journal.load(base_directory).failed_digest == failed_digest
+        if staged:
+            assert core.current_generation(base_directory) == venv.spec.name
+
+
+class TestReadRequirementsContent:
+    URL = "https://www.example.com/requirements.txt"
+
+    def test_checked_copy_is_used(self, venv_spec: core.VenvSpec) -> None:
+        venv = core.Venv(
+            spec=dataclasses.replace(venv_spec, requirements_file=self.URL),
+            state=core.VenvState(),
+            fetcher=requirements.Fetcher(),
+        )
+        served = [b"unicorn==1.0.0\n", b"unicorn==2.0.0\n"]
+
+        def get(url: str, headers: dict, timeout: float) -> mock.Mock:
+            return mock.Mock(status_code=200, content=served.pop(0), headers={})
+
+        with mock.patch("requests.Session.get", side_effect=get) as session_get:
+            digest = venv.fetcher.digest(self.URL)
+            checked = core.read_requirements_content(venv, digest)
+            assert session_get.call_count == 1
+            changed = core.read_requirements_content(venv, b"other")
+
+        assert checked == "unicorn==1.0.0\n"
+        assert changed == "unicorn==2.0.0\n"
+
+
+class TestLockMode:
+    LOCKED = "unicorn==1.0.0 --hash=sha256:aa\n"
+
+    def test_detected(self, venv_spec: core.VenvSpec) -> None:
+        venv = core.Venv(spec=venv_spec, state=core.VenvState())
+
+        with mock.patch("autoupdater.core.marker_environment", return_value=None):
+            assert core._locked_targets(venv, self.LOCKED) is not None
+            assert core._locked_targets(venv, "unicorn==1.0.0\n") is None
+
+    def test_required(self, venv_spec: core.VenvSpec) -> None:
+        venv = core.Venv(spec=venv_spec, state=core.VenvState(), lock_mode="require")
+
+        with mock.patch(
+            "autoupdater.core.marker_environment", return_value=None
+        ), pytest.raises(core.BaseException):
+            core._locked_targets(venv, "unicorn>=1.0.0\n")
+
+    def test_off(self, venv_spec: core.VenvSpec) -> None:
+        venv = core.Venv(spec=venv_spec, state=core.VenvState(), lock_mode="off")
+
+        assert core._locked_targets(venv, self.LOCKED) is None
+
+
+class TestRun:
+    def test_roll_back_tried_once_per_crash_loop(
+        self, venv_spec: core.VenvSpec
+    ) -> None:
+        service = config.ServiceConfig(
+            "https://www.example.com/requirements.txt",
+            "module",
+            [],
+            venv_spec.base_directory,
+        )
+        shutdown = events.ShutdownFlag()
+        launches = []
+
+        def crash(venv, module, args, *_, restarts, **kwargs) -> None:
+            launches.append(module)
+            restarts.record_exit(1, 0)
+            if len(launches) == 6:
+                shutdown.set()
+            return None
+
+        with mock.patch.object(
+            core, "resume_venv", return_value=core.Venv(venv_spec, core.VenvState())
+        ), mock.patch.object(core, "record_state"), mock.patch.object(
+            core, "UpdateChecker"
+        ) as checker, mock.patch.object(
+            core, "run_program_until_dead_or_updated", side_effect=crash
+        ), mock.patch.object(
+            core, "_wait_before_restart", return_value=None
+        ), mock.patch.object(
+            core, "roll_back", return_value=None
+        ) as roll_back:
+            checker.return_value.take.return_value = None
+            core.run(
+                service,
+                core.Options(staged=True, wheel_store_budget=0),
+                shutdown=shutdown,
+            )
+
+        assert len(launches) == 6
+        assert roll_back.call_count == 1
+
+    def test_watcher_is_closed(self, venv_spec: core.VenvSpec) -> None:
+        service = config.ServiceConfig(
+            venv_spec.requirements_file, "module", [], venv_spec.base_directory
+        )
+        shutdown = events.ShutdownFlag()
+        shutdown.set()
+
+        with mock.patch.object(
+            core, "resume_venv", return_value=core.Venv(venv_spec, core.VenvState())
+        ), mock.patch.object(core, "record_state"), mock.patch.object(
+            core, "UpdateChecker"
+        ), mock.patch.object(
+            core.watcher_module, "watch_file"
+        ) as watch_file:
+            core.run(service, core.Options(wheel_store_budget=0), shutdown=shutdown)
+
+        watch_file.return_value.close.assert_called_once_with()
+
+
+class TestRunMany:
+    def test_services_share_caches(self, tmp_path: pathlib.Path) -> None:
+        services = [
+            config.ServiceConfig("requirements.txt", module, [], tmp_path / module)
+            for module in ("first", "second")
+        ]
+        calls = []
+
+        def run(service, options, fetcher, shutdown, **shared) -> None:
+            calls.append((fetcher, shared))
+            if len(calls) == len(services):
+                shutdown.set()
+
+        with mock.patch("autoupdater.core.run", run):
+            assert core.run_many(services=services, cache_directory=tmp_path / "cache")
+
+        assert len(calls) == 2
+        assert calls[0][0] is calls[1][0]
+        assert calls[0][1]["wheel_store"] is calls[1][1]["wheel_store"]
+        assert calls[0][1]["wheel_store"].directory == wheelstore.store_dir(
+            tmp_path / "cache"
+        )
+        assert calls[0][1]["hashed_cache"] == tmp_path / "cache" / "hashed"
+
+    def test_failed_service_stops_all(self, tmp_path: pathlib.Path) -> None:
+        services = [
+            config.ServiceConfig("requirements.txt", module, [], tmp_path / module)
+            for module in ("failing", "running")
+        ]
+        stopped = []
+
+        def run(service, options, fetcher, shutdown, **shared) -> None:
+            if service.module == "failing":
+                raise OSError("Address already in use")
+            select.select([shutdown], [], [])
+            stopped.append(service.module)
+
+        with mock.patch("autoupdater.core.run", run):
+            assert not core.run_many(
+                services=services, cache_directory=tmp_path / "cache"
+            )
+
+        assert stopped == ["running"]
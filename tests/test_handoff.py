@@ -0,0 +1,66 @@
+import os
+import pathlib
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from autoupdater import handoff
+
+
+CHILD = """\
+import os, socket
+listening = socket.socket(fileno=3)
+print(os.environ["LISTEN_FDS"], os.environ["LISTEN_PID"] == str(os.getpid()))
+print(os.environ.get("LISTEN_FDNAMES"), listening.getsockname()[1])
+notify = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+notify.sendto(b"STATUS=starting\\nREADY=1", os.environ["NOTIFY_SOCKET"])
+"""
+
+
+def test_sockets_are_passed_like_systemd() -> None:
+    sockets = handoff.listen(["web=127.0.0.1:0"])
+    readiness = handoff.Readiness()
+    port = sockets.sockets[0].getsockname()[1]
+    try:
+        output = subprocess.run(
+            sockets.wrap(pathlib.Path(sys.executable), [sys.executable, "-c", CHILD]),
+            env={**os.environ, **sockets.environment(), **readiness.environment()},
+            pass_fds=sockets.fds(),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+        assert output.splitlines() == ["1 True", f"web {port}"]
+        assert readiness.receive()
+    finally:
+        sockets.close()
+        readiness.close()
+
+
+def test_not_ready_without_ready_message() -> None:
+    readiness = handoff.Readiness()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify:
+            notify.sendto(b"STATUS=still starting", readiness.path)
+
+        assert not readiness.receive()
+    finally:
+        readiness.close()
+
+
+def test_unix_socket_removed_on_close(tmp_path: pathlib.Path) -> None:
+    socket_path = tmp_path / "app.sock"
+    sockets = handoff.listen([f"unix:{socket_path}"])
+
+    assert "LISTEN_FDNAMES" not in sockets.environment()
+    assert socket_path.exists()
+    sockets.close()
+    assert not socket_path.exists()
+
+
+def test_bad_address() -> None:
+    with pytest.raises(ValueError):
+        handoff.listen(["localhost:http"])
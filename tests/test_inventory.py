@@ -0,0 +1,108 @@
+import json
+import os
+import pathlib
+import subprocess
+
+import pytest
+
+from autoupdater import core, inventory
+
+
+@pytest.fixture
+def site_packages(tmp_path: pathlib.Path) -> pathlib.Path:
+    site_packages = tmp_path / "venv" / "lib" / "python3.9" / "site-packages"
+    site_packages.mkdir(parents=True)
+    return site_packages
+
+
+def _add_dist_info(
+    site_packages: pathlib.Path,
+    name: str,
+    version: str,
+    direct_url: dict = None,
+) -> None:
+    dist_info = site_packages / f"{name.replace('-', '_')}-{version}.dist-info"
+    dist_info.mkdir()
+    with open(dist_info / "METADATA", "w") as f:
+        f.write(
+            f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n\n"
+            "Name: not-the-name\n"
+        )
+    if direct_url is not None:
+        with open(dist_info / "direct_url.json", "w") as f:
+            json.dump(direct_url, f)
+
+
+class TestFreeze:
+    def test_happy_path(self, site_packages: pathlib.Path) -> None:
+        _add_dist_info(site_packages, "Love.Hearts", "1.0.0")
+        _add_dist_info(site_packages, "pip", "24.0")
+        _add_dist_info(
+            site_packages,
+            "some-package",
+            "0.1.0",
+            {
+                "url": "file:///some_package-0.1.0-py3-none-any.whl",
+                "archive_info": {"hash": "sha256=abc"},
+            },
+        )
+        (site_packages / "unicorn-1.0.0.egg-info").mkdir()
+        with open(site_packages / "unicorn-1.0.0.egg-info" / "PKG-INFO", "w") as f:
+            f.write("Metadata-Version: 1.0\nName: unicorn\nVersion: 1.0.0\n")
+
+        frozen = inventory.freeze(site_packages.parents[2])
+
+        assert frozen.split("\n") == [
+            "Love.Hearts==1.0.0",
+            "some-package @ file:///some_package-0.1.0-py3-none-any.whl#sha256=abc",
+            "unicorn==1.0.0",
+        ]
+
+    def test_cache_invalidated_on_change(self, site_packages: pathlib.Path) -> None:
+        venv_dir = site_packages.parents[2]
+        _add_dist_info(site_packages, "pink", "1.0.0")
+        assert inventory.freeze(venv_dir) == "pink==1.0.0"
+
+        _add_dist_info(site_packages, "sparkle", "1.0.0")
+        os.utime(site_packages, ns=(0, 0))  # make sure the mtime changes
+
+        assert inventory.freeze(venv_dir) == "pink==1.0.0\nsparkle==1.0.0"
+
+    def test_restored_snapshot_is_used(
+        self, site_packages: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        venv_dir = site_packages.parents[2]
+        _add_dist_info(site_packages, "pink", "1.0.0")
+        inventory.freeze(venv_dir)
+        snapshot = inventory.snapshot(venv_dir)
+        monkeypatch.setattr(inventory, "_cache", {})
+        monkeypatch.setattr(inventory, "_scan", None)
+
+        inventory.restore(venv_dir, snapshot)
+
+        assert inventory.freeze(venv_dir) == "pink==1.0.0"
+
+    def test_no_site_packages(self, tmp_path: pathlib.Path) -> None:
+        assert inventory.freeze(tmp_path) is None
+
+    def test_same_as_pip_freeze(self, venv: core.Venv) -> None:
+        pip_freeze = subprocess.run(
+            [venv.spec.pip_path(), "freeze"], check=True, capture_output=True, text=True
+        )
+
+        assert inventory.freeze(venv.spec.venv_dir()) == pip_freeze.stdout.strip()
+
+
+def test_requires_dist(site_packages: pathlib.Path) -> None:
+    _add_dist_info(site_packages, "bar", "2.0.0")
+    _add_dist_info(site_packages, "foo", "1.0.0")
+    with open(site_packages / "bar-2.0.0.dist-info" / "METADATA", "w") as f:
+        f.write(
+            "Metadata-Version: 2.1\nName: bar\nVersion: 2.0.0\n"
+            "Requires-Dist: foo>=1.0\nRequires-Dist: baz; extra == 'more'\n"
+        )
+
+    assert inventory.requires_dist(site_packages.parents[2]) == {
+        "bar": ["foo>=1.0", "baz; extra == 'more'"],
+        "foo": [],
+    }
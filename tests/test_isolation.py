@@ -0,0 +1,84 @@
+import os
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+from autoupdater import isolation
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(isolation, "_cgroups", {})
+    monkeypatch.setattr(isolation, "_missing_tools", set())
+
+
+def test_no_limits() -> None:
+    assert isolation.NO_LIMITS.wrap(["pip", "install"]) == ["pip", "install"]
+
+
+def test_tools(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("shutil.which", lambda tool: f"/usr/bin/{tool}")
+    limits = isolation.Limits(nice=10, io_class="idle", cpus=(2, 3))
+
+    assert limits.wrap(["pip"]) == [
+        "taskset",
+        "--cpu-list",
+        "2,3",
+        "ionice",
+        "-c",
+        "3",
+        "nice",
+        "-n",
+        "10",
+        "pip",
+    ]
+
+
+def test_missing_tool_is_skipped(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("shutil.which", lambda tool: None)
+
+    assert isolation.Limits(nice=10).wrap(["pip"]) == ["pip"]
+
+
+@pytest.mark.skipif(not os.path.exists("/usr/bin/nice"), reason="needs nice")
+def test_nice_applies() -> None:
+    command = isolation.Limits(nice=3).wrap(
+        [sys.executable, "-c", "import os; print(os.nice(0))"]
+    )
+
+    result = subprocess.run(command, check=True, capture_output=True, text=True)
+
+    assert int(result.stdout) == os.nice(0) + 3
+
+
+class TestCgroup:
+    @pytest.fixture
+    def own_cgroup(
+        self, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+    ) -> pathlib.Path:
+        own = tmp_path / "system.slice" / "autoupdater.service"
+        own.mkdir(parents=True)
+        (own / "cgroup.controllers").write_text("cpu memory\n")
+        monkeypatch.setattr(isolation, "_own_cgroup", lambda: own)
+        return own
+
+    def test_set_up(self, own_cgroup: pathlib.Path) -> None:
+        limits = isolation.Limits(cpu_quota=0.5, memory_max=1024, cgroup="updates")
+
+        command = limits.wrap(["pip"])
+
+        assert command[:2] == ["sh", "-c"]
+        assert command[3:] == [str(own_cgroup / "updates" / "cgroup.procs"), "pip"]
+        assert (own_cgroup / "supervisor" / "cgroup.procs").read_text() == str(
+            os.getpid()
+        )
+        assert (own_cgroup / "cgroup.subtree_control").read_text() == "+cpu +memory"
+        assert (own_cgroup / "updates" / "cpu.max").read_text() == "50000 100000"
+        assert (own_cgroup / "updates" / "memory.max").read_text() == "1024"
+
+    def test_not_a_cgroup(self, own_cgroup: pathlib.Path) -> None:
+        (own_cgroup / "cgroup.controllers").unlink()
+
+        assert isolation.Limits(memory_max=1024).wrap(["pip"]) == ["pip"]
@@ -0,0 +1,27 @@
+import pathlib
+
+from autoupdater import journal
+
+
+def test_round_trip(tmp_path: pathlib.Path) -> None:
+    entry = journal.Entry(
+        venv_name="venvs/0011223344556677",
+        installed_digest=bytes(range(32)),
+        last_updated_timestamp=10.5,
+        when_last_update_attempt=9,
+        inventory={"key": [["lib/site-packages", 1]], "lines": ["a==1.0"]},
+        failed_digest=bytes(range(1, 33)),
+    )
+
+    journal.save(tmp_path, entry)
+
+    assert journal.load(tmp_path) == entry
+    assert [p.name for p in tmp_path.iterdir()] == ["state.json"]
+
+
+def test_missing_or_broken(tmp_path: pathlib.Path) -> None:
+    assert journal.load(tmp_path) is None
+
+    journal.journal_file(tmp_path).write_text('{"venv_name": "venv"')
+
+    assert journal.load(tmp_path) is None
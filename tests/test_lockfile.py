@@ -0,0 +1,151 @@
+import hashlib
+import os
+import pathlib
+import shutil
+import time
+import zipfile
+from unittest import mock
+
+import pytest
+
+from autoupdater import lockfile, requirements
+
+
+from tests.conftest import DATA_DIR
+
+
+WHEEL = DATA_DIR / "some_package" / "dist" / "some_package-0.1.0-py3-none-any.whl"
+WHEEL_SHA256 = hashlib.sha256(WHEEL.read_bytes()).hexdigest()
+LOCKED_LINE = f"some-package==0.1.0 --hash=sha256:{WHEEL_SHA256}"
+
+
+def _targets(content: str) -> list[requirements.Requirement]:
+    targets, _ = requirements.parse_requirements(content)
+    return targets
+
+
+def _wheel(tmp_path: pathlib.Path, requires_dist: list[str]) -> pathlib.Path:
+    wheel = tmp_path / "app-1.0-py3-none-any.whl"
+    with zipfile.ZipFile(wheel, "w") as archive:
+        archive.writestr(
+            "app-1.0.dist-info/METADATA",
+            "Metadata-Version: 2.1\nName: app\nVersion: 1.0\n"
+            + "".join(f"Requires-Dist: {line}\n" for line in requires_dist),
+        )
+    return wheel
+
+
+class TestIsLocked:
+    def test_locked(self) -> None:
+        assert lockfile.is_locked(
+            _targets("a==1.0 --hash=sha256:aa\nb==2.0 \\\n    --hash=sha256:bb\n")
+        )
+
+    @pytest.mark.parametrize(
+        "content",
+        ["", "a==1.0\n", "a>=1.0 --hash=sha256:aa\n", "-e ./a --hash=sha256:aa\n"],
+    )
+    def test_not_locked(self, content: str) -> None:
+        assert not lockfile.is_locked(_targets(content))
+
+
+class TestFetch:
+    def test_downloads_once(self, tmp_path: pathlib.Path) -> None:
+        cache = lockfile.cache_dir(tmp_path)
+        targets = _targets(LOCKED_LINE)
+
+        def fake_download(command: list, check: bool) -> None:
+            destination = command[command.index("--dest") + 1]
+            os.makedirs(destination)
+            shutil.copy(WHEEL, destination)
+
+        with mock.patch("subprocess.run", side_effect=fake_download) as run:
+            first = lockfile.fetch(pathlib.Path("pip"), targets, [], cache)
+            second = lockfile.fetch(pathlib.Path("pip"), targets, [], cache)
+
+        assert run.call_count == 1
+        assert "--require-hashes" in run.call_args.args[0]
+        assert first == second == [cache / WHEEL_SHA256 / WHEEL.name]
+        assert os.path.getmtime(first[0]) == time.time()
+
+    def test_nothing_matches(self, tmp_path: pathlib.Path) -> None:
+        targets = _targets("some-package==0.1.0 --hash=sha256:" + "0" * 64)
+
+        def fake_download(command: list, check: bool) -> None:
+            destination = command[command.index("--dest") + 1]
+            os.makedirs(destination)
+            shutil.copy(WHEEL, destination)
+
+        with mock.patch("subprocess.run", side_effect=fake_download), pytest.raises(
+            lockfile.IncompleteLock
+        ):
+            lockfile.fetch(
+                pathlib.Path("pip"), targets, [], lockfile.cache_dir(tmp_path)
+            )
+
+
+def test_evicts_least_recently_used(tmp_path: pathlib.Path) -> None:
+    for when, digest in enumerate(["aa", "bb", "cc"]):
+        (tmp_path / digest).mkdir()
+        stored = tmp_path / digest / f"{digest}-1.0-py3-none-any.whl"
+        stored.write_bytes(b"x" * 10)
+        os.utime(stored, (when, when))
+    (tmp_path / "aa" / ".partial").write_bytes(b"")
+
+    lockfile.evict(tmp_path, budget=15)
+
+    assert sorted(os.listdir(tmp_path)) == ["aa", "cc"]
+    assert os.listdir(tmp_path / "aa") == [".partial"]
+
+
+class TestCheckComplete:
+    REQUIRES_DIST = [
+        "dep (>=1.0)",
+        "extra-dep ; extra == 'fancy'",
+        "windows-dep ; sys_platform == 'win32'",
+        "setuptools",
+    ]
+    ENVIRONMENT = {"sys_platform": "linux"}
+
+    def test_complete(self, tmp_path: pathlib.Path) -> None:
+        wheel = _wheel(tmp_path, self.REQUIRES_DIST)
+
+        lockfile.check_complete(
+            [wheel], _targets("app==1.0\ndep==1.2\n"), self.ENVIRONMENT
+        )
+
+    def test_missing_dependency(self, tmp_path: pathlib.Path) -> None:
+        wheel = _wheel(tmp_path, self.REQUIRES_DIST)
+
+        with pytest.raises(lockfile.IncompleteLock, match="dep"):
+            lockfile.check_complete([wheel], _targets("app==1.0\n"), self.ENVIRONMENT)
+
+    def test_pinned_version_does_not_match(self, tmp_path: pathlib.Path) -> None:
+        wheel = _wheel(tmp_path, self.REQUIRES_DIST)
+
+        with pytest.raises(lockfile.IncompleteLock, match="0.5 is pinned"):
+            lockfile.check_complete(
+                [wheel], _targets("app==1.0\ndep==0.5\n"), self.ENVIRONMENT
+            )
+
+
+def test_link_files(tmp_path: pathlib.Path) -> None:
+    links = tmp_path / "links"
+
+    lockfile.link_files([WHEEL], links)
+
+    assert (links / WHEEL.name).resolve() == WHEEL.resolve()
+    assert lockfile.install_options(links)[:3] == [
+        "--no-deps",
+        "--require-hashes",
+        "--no-index",
+    ]
+
+
+def test_sdists_are_built_with_the_index(tmp_path: pathlib.Path) -> None:
+    sdist = DATA_DIR / "some_package" / "dist" / "some_package-0.1.0.tar.gz"
+
+    options = lockfile.install_options(tmp_path, [WHEEL, sdist])
+
+    assert "--no-index" not in options
+    assert options[:2] == ["--no-deps", "--require-hashes"]
@@ -0,0 +1,61 @@
+import pytest
+
+from autoupdater import markers
+
+
+ENVIRONMENT = {
+    "python_version": "3.9",
+    "python_full_version": "3.9.18",
+    "sys_platform": "linux",
+    "platform_machine": "armv7l",
+}
+
+
+class TestEvaluate:
+    @pytest.mark.parametrize(
+        "marker, expected",
+        [
+            ('python_version >= "3.11"', False),
+            ('python_version < "3.10"', True),
+            ('"3.8" < python_version', True),
+            ('python_full_version >= "3.9.2"', True),
+            ('sys_platform == "linux" and platform_machine == "x86_64"', False),
+            (
+                'sys_platform == "win32" or (python_version > "3.8" and extra == "")',
+                True,
+            ),
+            ('"arm" in platform_machine', True),
+            ('"arm" not in platform_machine', False),
+        ],
+    )
+    def test_evaluate(self, marker: str, expected: bool) -> None:
+        assert markers.evaluate(marker, ENVIRONMENT) == expected
+
+    @pytest.mark.parametrize(
+        "marker",
+        ['python_version >= "3.11" and', 'unknown_variable == "a"', "(sys_platform"],
+    )
+    def test_invalid(self, marker: str) -> None:
+        with pytest.raises(markers.InvalidMarker):
+            markers.evaluate(marker, ENVIRONMENT)
+
+
+class TestVersionMatches:
+    @pytest.mark.parametrize(
+        "version, specifiers, expected",
+        [
+            ("1.0", "==1.0.0", True),
+            ("1.4.2", "~=1.4", True),
+            ("2.0", "~=1.4", False),
+            ("1.2.3", "==1.2.*", True),
+            ("1.3", "!=1.2.*", True),
+            ("1.0rc1", "<1.0", True),
+            ("1.0.dev1", "<1.0a1", True),
+            ("1.0.post1", ">1.0", True),
+            ("1.5", ">=1.0,<2", True),
+            ("2.5", ">=1.0,<2", False),
+            ("not-a-version", ">=1.0", None),
+        ],
+    )
+    def test_version_matches(self, version: str, specifiers: str, expected) -> None:
+        assert markers.version_matches(version, specifiers) == expected
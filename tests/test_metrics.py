@@ -0,0 +1,136 @@
+import json
+import logging
+import pathlib
+from typing import Any
+
+import pytest
+import requests
+
+from autoupdater import metrics
+
+
+class TestMetrics:
+    def test_span_records_phase(self) -> None:
+        recorded = metrics.Metrics()
+
+        with recorded.span("install"):
+            pass
+        with pytest.raises(ValueError):
+            with recorded.span("install"):
+                raise ValueError()
+
+        phase = recorded.snapshot()["phases"]["install"]
+        assert phase["count"] == 2
+        assert phase["failures"] == 1
+
+    def test_routine_span_logs_at_debug(self, caplog: Any) -> None:
+        caplog.set_level(logging.DEBUG)
+        recorded = metrics.Metrics()
+
+        with recorded.span("check", logging.DEBUG):
+            pass
+        with recorded.span("install"):
+            pass
+
+        assert [(r.levelno, r.message.split()[1]) for r in caplog.records] == [
+            (logging.DEBUG, "check"),
+            (logging.INFO, "install"),
+        ]
+
+    def test_counters_add_up(self) -> None:
+        recorded = metrics.Metrics()
+
+        recorded.increment("restarts")
+        recorded.increment("restarts")
+        recorded.increment("downloaded_bytes", 100)
+
+        assert recorded.snapshot()["counters"] == {
+            "restarts": 2,
+            "downloaded_bytes": 100,
+        }
+
+    def test_status_file_written(self, tmp_path: pathlib.Path) -> None:
+        status_file = tmp_path / "status.json"
+        recorded = metrics.Metrics(labels={"module": "app"}, status_file=status_file)
+
+        recorded.set_gauge("program_up", 1)
+        recorded.set_info("installed_digest", "abcd")
+        recorded.flush()
+
+        with open(status_file) as f:
+            status = json.load(f)
+        assert status["labels"] == {"module": "app"}
+        assert status["gauges"] == {"program_up": 1}
+        assert status["info"] == {"installed_digest": "abcd"}
+        assert list(tmp_path.iterdir()) == [status_file]
+
+    def test_status_file_throttled(
+        self, tmp_path: pathlib.Path, frozen_time: Any
+    ) -> None:
+        status_file = tmp_path / "status.json"
+        recorded = metrics.Metrics(status_file=status_file, status_interval=10)
+
+        def counters() -> dict:
+            with open(status_file) as f:
+                return json.load(f)["counters"]
+
+        recorded.increment("restarts")
+        recorded.increment("restarts")
+        assert counters() == {"restarts": 1}
+
+        frozen_time.tick(10)
+        recorded.increment("restarts")
+        recorded.increment("crashes")
+        assert counters() == {"restarts": 3}
+
+        recorded.flush()
+        assert counters() == {"restarts": 3, "crashes": 1}
+
+
+class TestPrometheusText:
+    def test_format(self) -> None:
+        recorded = metrics.Metrics(labels={"module": "app"})
+        recorded.increment("crashes")
+        recorded.set_gauge("program_up", 0)
+        with recorded.span("launch"):
+            pass
+
+        text = metrics.prometheus_text([recorded])
+
+        assert "# TYPE autoupdater_crashes_total counter\n" in text
+        assert 'autoupdater_crashes_total{module="app"} 1\n' in text
+        assert 'autoupdater_program_up{module="app"} 0\n' in text
+        assert 'autoupdater_phase_runs_total{module="app",phase="launch"} 1\n' in text
+
+    def test_metrics_grouped_by_name(self) -> None:
+        first = metrics.Metrics(labels={"module": "a"})
+        second = metrics.Metrics(labels={"module": "b"})
+        first.increment("restarts")
+        second.increment("restarts")
+
+        text = metrics.prometheus_text([first, second])
+
+        assert text == (
+            "# TYPE autoupdater_restarts_total counter\n"
+            'autoupdater_restarts_total{module="a"} 1\n'
+            'autoupdater_restarts_total{module="b"} 1\n'
+        )
+
+
+def test_serve(monkeypatch: pytest.MonkeyPatch) -> None:
+    recorded = metrics.Metrics(labels={"module": "app"})
+    recorded.increment("restarts")
+    monkeypatch.setattr(metrics, "_registry", [recorded])
+
+    server = metrics.serve(0)
+    try:
+        port = server.server_address[1]
+        response = requests.get(f"http://127.0.0.1:{port}/metrics", timeout=5)
+        missing = requests.get(f"http://127.0.0.1:{port}/other", timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert response.status_code == 200
+    assert 'autoupdater_restarts_total{module="app"} 1' in response.text
+    assert missing.status_code == 404
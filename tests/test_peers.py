@@ -0,0 +1,114 @@
+import hashlib
+import pathlib
+import shutil
+from typing import Iterator, Optional
+
+import pytest
+import requests
+
+from autoupdater import lockfile, peers
+
+
+from tests.conftest import DATA_DIR
+
+
+WHEEL = DATA_DIR / "some_package" / "dist" / "some_package-0.1.0-py3-none-any.whl"
+WHEEL_SHA256 = hashlib.sha256(WHEEL.read_bytes()).hexdigest()
+
+
+def _with_wheel(base_directory: pathlib.Path) -> pathlib.Path:
+    stored = lockfile.cache_dir(base_directory) / WHEEL_SHA256
+    stored.mkdir(parents=True)
+    shutil.copy(WHEEL, stored)
+    return base_directory
+
+
+@pytest.fixture
+def serve() -> Iterator:
+    servers = []
+
+    def serve(base_directory: pathlib.Path, upstream: Optional[str] = None) -> str:
+        server = peers.serve(peers.PeerCache(base_directory, upstream), 0, "127.0.0.1")
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+class TestServe:
+    def test_local_files(self, tmp_path: pathlib.Path, serve) -> None:
+        url = serve(_with_wheel(tmp_path))
+
+        root = requests.get(f"{url}/simple/", timeout=5)
+        page = requests.get(f"{url}/simple/Some_Package", timeout=5)
+        file_url = f"/files/{WHEEL_SHA256}/{WHEEL.name}"
+        downloaded = requests.get(f"{url}{file_url}", timeout=5)
+
+        assert '<a href="/simple/some-package/">some-package</a>' in root.text
+        assert page.url == f"{url}/simple/some-package/"
+        assert f'<a href="{file_url}#sha256={WHEEL_SHA256}">' in page.text
+        assert downloaded.content == WHEEL.read_bytes()
+
+    def test_shared_files(self, tmp_path: pathlib.Path, serve) -> None:
+        _with_wheel(tmp_path / "cache")
+        url = serve(tmp_path)
+
+        page = requests.get(f"{url}/simple/some-package/", timeout=5)
+
+        assert f"/files/{WHEEL_SHA256}/{WHEEL.name}" in page.text
+
+    def test_unknown(self, tmp_path: pathlib.Path, serve) -> None:
+        url = serve(_with_wheel(tmp_path))
+
+        assert requests.get(f"{url}/simple/other/", timeout=5).status_code == 404
+        assert (
+            requests.get(f"{url}/files/{'0' * 64}/{WHEEL.name}", timeout=5).status_code
+            == 404
+        )
+
+    def test_files_from_upstream_are_cached(
+        self, tmp_path: pathlib.Path, serve
+    ) -> None:
+        upstream = serve(_with_wheel(tmp_path / "upstream"))
+        peer_directory = tmp_path / "peer"
+        url = serve(peer_directory, f"{upstream}/simple/")
+
+        page = requests.get(f"{url}/simple/some-package/", timeout=5)
+        downloaded = requests.get(f"{url}/files/{WHEEL_SHA256}/{WHEEL.name}", timeout=5)
+
+        assert WHEEL.name in page.text
+        assert downloaded.content == WHEEL.read_bytes()
+        assert [
+            file_path.name
+            for file_path in (
+                lockfile.cache_dir(peer_directory) / WHEEL_SHA256
+            ).iterdir()
+        ] == [WHEEL.name]
+
+
+class TestIndexOptions:
+    def test_peer_first(self) -> None:
+        assert peers.index_options(["--pre"], "http://peer:8765/simple/") == [
+            "--index-url http://peer:8765/simple/",
+            f"--extra-index-url {peers.DEFAULT_UPSTREAM}",
+            "--trusted-host peer:8765",
+            "--pre",
+        ]
+
+    def test_index_from_requirements_becomes_upstream(self) -> None:
+        assert peers.index_options(
+            ["--index-url=https://mirror/simple"], "https://peer/simple/"
+        ) == [
+            "--index-url https://peer/simple/",
+            "--extra-index-url https://mirror/simple",
+        ]
+
+
+def test_unreachable_peer(tmp_path: pathlib.Path, serve) -> None:
+    url = serve(tmp_path)
+
+    assert peers.is_reachable(requests.Session(), f"{url}/simple/")
+    assert not peers.is_reachable(requests.Session(), "http://127.0.0.1:1/simple/")
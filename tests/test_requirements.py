@@ -1,12 +1,18 @@
 from autoupdater import core, requirements
+from typing import Optional
 
 
 import pytest
 
 
 import hashlib
+import pathlib
+import threading
+import time
 from unittest import mock
 
+import requests
+
 
 class TestDigestFromRequirementsFile:
     def test_with_local_file(self, venv_spec: core.VenvSpec) -> None:
@@ -24,9 +30,9 @@ class TestDigestFromRequirementsFile:
     )
     def test_with_remote_file(self, venv_spec: core.VenvSpec) -> None:
         with mock.patch(
-            "requests.get",
+            "requests.Session.get",
             return_value=mock.Mock(
-                status_code=200, content=b"some-requirement==1.0.0\n"
+                status_code=200, content=b"some-requirement==1.0.0\n", headers={}
             ),
         ):
             digest = requirements.digest_from_requirements_file(
@@ -40,13 +46,17 @@ class TestDigestFromRequirementsFile:
     )
     def test_with_remote_file_error_9_times(self, venv_spec: core.VenvSpec) -> None:
         with mock.patch(
-            "requests.get",
+            "requests.Session.get",
             side_effect=[
                 mock.Mock(status_code=500, content=b"some-requirement==1.0.0\n"),
             ]
             * 9
             + [
-                mock.Mock(status_code=200, content=b"some-requirement==1.0.0\n"),
+                mock.Mock(
+                    status_code=200,
+                    content=b"some-requirement==1.0.0\n",
+                    headers={},
+                ),
             ],
         ):
             digest = requirements.digest_from_requirements_file(
@@ -60,7 +70,7 @@ class TestDigestFromRequirementsFile:
     )
     def test_with_remote_file_error(self, venv_spec: core.VenvSpec) -> None:
         with mock.patch(
-            "requests.get",
+            "requests.Session.get",
             return_value=mock.Mock(
                 status_code=500, content=b"some-requirement==1.0.0\n"
             ),
@@ -72,6 +82,160 @@ class TestDigestFromRequirementsFile:
         assert digest is None
 
 
+class TestFetcher:
+    URL = "https://www.example.com/requirements.txt"
+
+    def test_not_modified_uses_cached_digest(self, tmp_path: pathlib.Path) -> None:
+        fetcher = requirements.Fetcher(cache_directory=tmp_path)
+        with mock.patch(
+            "requests.Session.get",
+            side_effect=[
+                mock.Mock(
+                    status_code=200,
+                    content=b"some-requirement==1.0.0\n",
+                    headers={"ETag": '"abc"'},
+                ),
+                mock.Mock(status_code=304, content=b"", headers={}),
+            ],
+        ) as get:
+            first_digest = fetcher.digest(self.URL)
+            second_digest = fetcher.digest(self.URL)
+
+        assert first_digest == second_digest
+        assert get.call_args.kwargs["headers"] == {"If-None-Match": '"abc"'}
+
+    def test_cache_persists_across_fetchers(self, tmp_path: pathlib.Path) -> None:
+        with mock.patch(
+            "requests.Session.get",
+            return_value=mock.Mock(
+                status_code=200,
+                content=b"some-requirement==1.0.0\n",
+                headers={"Last-Modified": "Tue, 01 Jan 2019 10:00:00 GMT"},
+            ),
+        ):
+            requirements.Fetcher(cache_directory=tmp_path).digest(self.URL)
+
+        with mock.patch(
+            "requests.Session.get",
+            return_value=mock.Mock(status_code=304, content=b"", headers={}),
+        ) as get:
+            fetcher = requirements.Fetcher(cache_directory=tmp_path)
+            digest = fetcher.digest(self.URL)
+            content = fetcher.read(self.URL)
+
+        assert get.call_args.kwargs["headers"] == {
+            "If-Modified-Since": "Tue, 01 Jan 2019 10:00:00 GMT"
+        }
+        assert digest == hashlib.sha256(b"some-requirement==1.0.0").digest()
+        assert content == b"some-requirement==1.0.0\n"
+
+    def test_cached_requirements_file(self, tmp_path: pathlib.Path) -> None:
+        fetcher = requirements.Fetcher(cache_directory=tmp_path)
+        with mock.patch(
+            "requests.Session.get",
+            return_value=mock.Mock(
+                status_code=200, content=b"some-requirement==1.0.0\n", headers={}
+            ),
+        ):
+            digest = fetcher.digest(self.URL)
+
+        with mock.patch("requests.Session.get") as get:
+            content = requirements.cached_requirements_file(self.URL, digest, fetcher)
+            other = requirements.cached_requirements_file(self.URL, b"other", fetcher)
+
+        get.assert_not_called()
+        assert content == b"some-requirement==1.0.0\n"
+        assert other is None
+
+    def test_concurrent_fetches_are_shared(self) -> None:
+        fetcher = requirements.Fetcher()
+        release = threading.Event()
+
+        def slow_get(url: str, headers: dict, timeout: float) -> mock.Mock:
+            release.wait()
+            return mock.Mock(
+                status_code=200, content=b"some-requirement==1.0.0\n", headers={}
+            )
+
+        with mock.patch("requests.Session.get", side_effect=slow_get) as get:
+            threads = [
+                threading.Thread(target=fetcher.digest, args=(self.URL,))
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            threading.Timer(0.2, release.set).start()
+            for thread in threads:
+                thread.join()
+
+        assert get.call_count == 1
+
+    def test_max_age_skips_requests(self) -> None:
+        fetcher = requirements.Fetcher()
+        with mock.patch(
+            "requests.Session.get",
+            return_value=mock.Mock(
+                status_code=200,
+                content=b"some-requirement==1.0.0\n",
+                headers={"Cache-Control": "public, max-age=600"},
+            ),
+        ) as get:
+            fetcher.digest(self.URL)
+            time.sleep(599)
+            fetcher.digest(self.URL)
+            assert get.call_count == 1
+            time.sleep(2)
+            fetcher.digest(self.URL)
+            assert get.call_count == 2
+
+    def test_retry_after_is_honored(self) -> None:
+        fetcher = requirements.Fetcher()
+        sleeps = []
+        with mock.patch(
+            "requests.Session.get",
+            side_effect=[
+                mock.Mock(status_code=503, headers={"Retry-After": "45"}),
+                mock.Mock(
+                    status_code=200,
+                    content=b"some-requirement==1.0.0\n",
+                    headers={},
+                ),
+            ],
+        ), mock.patch("time.sleep", side_effect=sleeps.append):
+            digest = fetcher.digest(self.URL)
+
+        assert digest == hashlib.sha256(b"some-requirement==1.0.0").digest()
+        assert sleeps == [45]
+
+    def test_long_retry_after_leaves_url_alone(self) -> None:
+        fetcher = requirements.Fetcher()
+        with mock.patch(
+            "requests.Session.get",
+            return_value=mock.Mock(status_code=429, headers={"Retry-After": "3600"}),
+        ) as get:
+            assert fetcher.digest(self.URL) is None
+            time.sleep(3599)
+            assert fetcher.digest(self.URL) is None
+            assert get.call_count == 1
+            time.sleep(2)
+            fetcher.digest(self.URL)
+            assert get.call_count == 2
+
+    def test_failures_back_off(self) -> None:
+        fetcher = requirements.Fetcher()
+        sleeps = []
+        with mock.patch(
+            "requests.Session.get",
+            side_effect=requests.ConnectionError(),
+        ) as get, mock.patch("time.sleep", side_effect=sleeps.append):
+            assert fetcher.digest(self.URL) is None
+            assert fetcher.digest(self.URL) is None
+
+        assert get.call_count == 10
+        assert len(sleeps) == 9
+        assert all(0 <= delay <= 2 * 2**attempt for attempt, delay in enumerate(sleeps))
+
+
 class TestDiff:
     def test_no_new_requirements(self) -> None:
         requirements_content = (
@@ -125,3 +289,213 @@ class TestDiff:
 
         assert remove == []
         assert install == ['flair==1.0.0 ; python_version >= "3.11"']
+
+
+class TestParseLine:
+    @pytest.mark.parametrize(
+        "line, expected",
+        [
+            ("", None),
+            ("# just a comment", None),
+            ("--index-url https://example.com/simple", None),
+            (
+                "Love.Hearts==1.0.0 # some comment",
+                requirements.Requirement(
+                    line="Love.Hearts==1.0.0",
+                    name="love-hearts",
+                    specifier="==1.0.0",
+                    version="1.0.0",
+                ),
+            ),
+            (
+                'unicorn[sparkle,glitter]===1.0.0 ; python_version >= "3.11"',
+                requirements.Requirement(
+                    line='unicorn[sparkle,glitter]===1.0.0 ; python_version >= "3.11"',
+                    name="unicorn",
+                    specifier="===1.0.0",
+                    version="1.0.0",
+                    marker='python_version >= "3.11"',
+                ),
+            ),
+            (
+                "pink>=1.0,<2 --hash=sha256:abc",
+                requirements.Requirement(
+                    line="pink>=1.0,<2 --hash=sha256:abc",
+                    name="pink",
+                    specifier=">=1.0,<2",
+                    hashes=("sha256:abc",),
+                ),
+            ),
+            (
+                "some-package @ file:///some_package-0.1.0-py3-none-any.whl#sha256=abc",
+                requirements.Requirement(
+                    line="some-package @ file:///some_package-0.1.0-py3-none-any.whl#sha256=abc",
+                    name="some-package",
+                    url="file:///some_package-0.1.0-py3-none-any.whl#sha256=abc",
+                    version="0.1.0",
+                ),
+            ),
+            (
+                "tests/data/some_package/dist/some_package-0.1.0-py3-none-any.whl",
+                requirements.Requirement(
+                    line="tests/data/some_package/dist/some_package-0.1.0-py3-none-any.whl",
+                    name="some-package",
+                    url="tests/data/some_package/dist/some_package-0.1.0-py3-none-any.whl",
+                    version="0.1.0",
+                ),
+            ),
+            (
+                "-e git+https://example.com/flair.git#egg=flair",
+                requirements.Requirement(
+                    line="-e git+https://example.com/flair.git#egg=flair",
+                    name="flair",
+                    url="git+https://example.com/flair.git#egg=flair",
+                    editable=True,
+                ),
+            ),
+        ],
+    )
+    def test_parse_line(
+        self, line: str, expected: Optional[requirements.Requirement]
+    ) -> None:
+        assert requirements.parse_line(line) == expected
+
+
+class TestPlan:
+    ENVIRONMENT = {"python_version": "3.9", "sys_platform": "linux"}
+
+    def test_upgrade_in_place(self) -> None:
+        update_plan = requirements.plan(
+            "unicorn==1.0.0\nsparkle==1.0.0\n", "unicorn==2.0.0\nsparkle==1.0.0\n"
+        )
+
+        assert update_plan == requirements.Plan(
+            upgrade=["unicorn==2.0.0"], replaced=["unicorn==1.0.0"]
+        )
+
+    def test_markers_are_evaluated(self) -> None:
+        update_plan = requirements.plan(
+            "unicorn==1.0.0\n",
+            'unicorn==1.0.0 ; python_version >= "3.11"\n'
+            'sparkle==1.0.0 ; python_version < "3.11"\n',
+            self.ENVIRONMENT,
+        )
+
+        assert update_plan.install == ['sparkle==1.0.0 ; python_version < "3.11"']
+        assert update_plan.remove == ["unicorn==1.0.0"]
+
+    def test_local_wheel_already_installed(self) -> None:
+        update_plan = requirements.plan(
+            "some-package @ file:///root/some_package-0.1.0-py3-none-any.whl#sha256=abc",
+            "tests/data/some_package/dist/some_package-0.1.0-py3-none-any.whl\n",
+        )
+
+        assert update_plan.is_empty()
+
+    def test_ranges_and_options(self) -> None:
+        update_plan = requirements.plan(
+            "pink==1.4.2\nhearts==0.9\n",
+            "--index-url https://example.com/simple\n" "pink~=1.4\n" "hearts>=1.0\n",
+        )
+
+        assert update_plan.upgrade == ["hearts>=1.0"]
+        assert update_plan.options == ["--index-url https://example.com/simple"]
+
+    def test_continuation_lines(self) -> None:
+        update_plan = requirements.plan(
+            "", "pink==1.0.0 \\\n    --hash=sha256:abc\nhearts==1.0.0\n"
+        )
+
+        assert update_plan.install == [
+            "pink==1.0.0      --hash=sha256:abc",
+            "hearts==1.0.0",
+        ]
+
+    def test_large_lockfile(self) -> None:
+        lockfile = "".join(f"package-{i}=={i}.0.0\n" for i in range(1000))
+        installed = "".join(f"Package_{i}=={i}.0.0\n" for i in range(1000))
+
+        assert requirements.plan(installed, lockfile).is_empty()
+
+
+class TestRace:
+    PRIMARY = "https://primary.example.com/requirements.txt"
+    MIRROR = "https://mirror.example.com/requirements.txt"
+    OTHER_MIRROR = "https://other.example.com/requirements.txt"
+
+    @staticmethod
+    def _serve(contents: dict[str, Optional[bytes]]):
+        def get(url: str, headers: dict, timeout: float) -> mock.Mock:
+            content = contents[url]
+            if content is None:
+                return mock.Mock(status_code=500, headers={})
+            return mock.Mock(status_code=200, content=content, headers={})
+
+        return mock.patch("requests.Session.get", side_effect=get)
+
+    def test_first_valid_answer_wins(self) -> None:
+        fetcher = requirements.Fetcher()
+        with self._serve({self.PRIMARY: None, self.MIRROR: b"a==1.0.0\n"}):
+            content = requirements.read_requirements_file(
+                self.PRIMARY, fetcher, mirrors=[self.MIRROR]
+            )
+
+        assert content == b"a==1.0.0\n"
+
+    def test_local_mirror(self, tmp_path: pathlib.Path) -> None:
+        local_copy = tmp_path / "requirements.txt"
+        local_copy.write_bytes(b"a==1.0.0\n")
+        with self._serve({self.PRIMARY: None}):
+            digest = requirements.digest_from_requirements_file(
+                self.PRIMARY, requirements.Fetcher(), mirrors=[str(local_copy)]
+            )
+
+        assert digest == hashlib.sha256(b"a==1.0.0").digest()
+
+    def test_slow_source_is_hedged(self) -> None:
+        fetcher = requirements.Fetcher()
+        fetcher.record_latency(self.PRIMARY, 0.01)
+        fetcher.record_latency(self.MIRROR, 0.02)
+        release = threading.Event()
+
+        def get(url: str, headers: dict, timeout: float) -> mock.Mock:
+            if url == self.PRIMARY:
+                release.wait()
+            return mock.Mock(status_code=200, content=url.encode(), headers={})
+
+        with mock.patch("requests.Session.get", side_effect=get):
+            content = fetcher.race([self.MIRROR, self.PRIMARY])
+            release.set()
+
+        assert content == self.MIRROR.encode()
+
+    def test_quorum(self) -> None:
+        fetcher = requirements.Fetcher()
+        sources = [self.PRIMARY, self.MIRROR, self.OTHER_MIRROR]
+        with self._serve(
+            {
+                self.PRIMARY: b"a==2.0.0\n",
+                self.MIRROR: b"a==1.0.0\n",
+                self.OTHER_MIRROR: b"a==1.0.0  # same\n",
+            }
+        ):
+            content = fetcher.race(sources, quorum=2)
+
+        assert content in (b"a==1.0.0\n", b"a==1.0.0  # same\n")
+
+    def test_no_quorum(self) -> None:
+        fetcher = requirements.Fetcher()
+        with self._serve({self.PRIMARY: b"a==2.0.0\n", self.MIRROR: b"a==1.0.0\n"}):
+            assert fetcher.race([self.PRIMARY, self.MIRROR], quorum=2) is None
+
+    def test_latencies_are_remembered(self, tmp_path: pathlib.Path) -> None:
+        fetcher = requirements.Fetcher(cache_directory=tmp_path)
+        fetcher.record_latency(self.PRIMARY, 2)
+        fetcher.record_latency(self.MIRROR, 0.5)
+        fetcher.record_latency(self.MIRROR, 3)
+
+        sources = requirements.Fetcher(cache_directory=tmp_path).fastest_first(
+            [self.PRIMARY, self.MIRROR, self.OTHER_MIRROR]
+        )
+
+        assert sources == [self.OTHER_MIRROR, self.MIRROR, self.PRIMARY]
@@ -0,0 +1,105 @@
+import random
+
+import pytest
+
+from autoupdater import schedule
+
+
+def test_backoff_is_capped() -> None:
+    backoff = schedule.Backoff(base=2, cap=60, rng=random.Random(0))
+
+    delays = [backoff.delay(attempt) for attempt in range(100)]
+
+    assert all(0 <= delay <= 60 for delay in delays)
+    assert max(delays[:3]) <= 8
+
+
+def test_jittered_stays_in_range() -> None:
+    rng = random.Random(0)
+
+    intervals = [schedule.jittered(100, 0.1, rng) for _ in range(100)]
+
+    assert all(90 <= interval <= 110 for interval in intervals)
+    assert len(set(intervals)) > 1
+    assert schedule.jittered(100, 0) == 100
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({}, None),
+        ({"Retry-After": "120"}, 120),
+        ({"Retry-After": "Tue, 01 Jan 2019 10:02:00 GMT"}, 60),
+        ({"Retry-After": "Tue, 01 Jan 2019 09:00:00 GMT"}, 0),
+        ({"Retry-After": "soon"}, None),
+    ],
+)
+def test_retry_after(headers: dict, expected: float) -> None:
+    now = 1546336860  # 2019-01-01 10:01:00 UTC
+
+    assert schedule.retry_after(headers, now) == expected
+
+
+@pytest.mark.parametrize(
+    "cache_control, expected",
+    [
+        (None, None),
+        ("max-age=300", 300),
+        ("public, max-age=60, must-revalidate", 60),
+        ("no-cache, max-age=60", None),
+        ("max-age=soon", None),
+    ],
+)
+def test_max_age(cache_control: str, expected: float) -> None:
+    headers = {} if cache_control is None else {"Cache-Control": cache_control}
+
+    assert schedule.max_age(headers) == expected
+
+
+@pytest.mark.parametrize(
+    "returncode, expected",
+    [(None, "error"), (0, "clean"), (-9, "signal"), (78, "permanent"), (1, "crash")],
+)
+def test_classify_exit(returncode: int, expected: str) -> None:
+    assert schedule.classify_exit(returncode) == expected
+
+
+class TestRestartPolicy:
+    def test_backoff_grows_and_resets(self) -> None:
+        policy = schedule.RestartPolicy(base_delay=1, max_delay=8, stable_after=60)
+
+        delays = []
+        for now in range(6):
+            policy.record_exit(1, uptime=1)
+            delays.append(policy.next_restart(now * 100))
+        policy.record_exit(1, uptime=120)
+
+        assert delays[0] <= 1.2
+        assert 3.2 <= delays[3] <= 8
+        assert delays[5] == pytest.approx(8, abs=1.6)
+        assert policy.next_restart(600) == 0
+
+    def test_clean_exit_is_not_a_failure(self) -> None:
+        policy = schedule.RestartPolicy(base_delay=1, max_delay=8, stable_after=60)
+        policy.record_exit(1, uptime=1)
+
+        assert policy.record_exit(0, uptime=1) == "clean"
+        assert policy.failures == 0
+        assert policy.next_restart(0) == 0
+
+    def test_permanent_exit_waits_longest(self) -> None:
+        policy = schedule.RestartPolicy(base_delay=1, max_delay=300)
+
+        policy.record_exit(78, uptime=0)
+
+        assert 240 <= policy.next_restart(0) <= 300
+
+    def test_budget(self) -> None:
+        policy = schedule.RestartPolicy(budget=3, window=600, stable_after=0)
+
+        for now in range(3):
+            policy.record_exit(0, uptime=10)
+            assert policy.next_restart(now) == 0
+        policy.record_exit(0, uptime=10)
+
+        assert policy.next_restart(3) == 597
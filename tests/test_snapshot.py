@@ -0,0 +1,65 @@
+import os
+import pathlib
+
+import pytest
+
+from autoupdater import snapshot
+
+
+@pytest.fixture
+def source(tmp_path: pathlib.Path) -> pathlib.Path:
+    venv_dir = tmp_path / "venvs" / "aaaa"
+    (venv_dir / "bin").mkdir(parents=True)
+    (venv_dir / "lib" / "site-packages").mkdir(parents=True)
+    (venv_dir / "pyvenv.cfg").write_text("home = /usr/bin\n")
+    (venv_dir / "bin" / "tool").write_text(
+        f"#!{venv_dir.absolute()}/bin/python\nimport tool\n"
+    )
+    (venv_dir / "bin" / "tool").chmod(0o755)
+    os.symlink("/usr/bin/python3", venv_dir / "bin" / "python")
+    (venv_dir / "lib" / "site-packages" / "tool.py").write_text("x = 1\n")
+    (venv_dir / "__confirmed_state__").write_text("digest")
+    return venv_dir
+
+
+def test_clone_venv(source: pathlib.Path) -> None:
+    destination = source.parent / "bbbb"
+
+    snapshot.clone_venv(source, destination, exclude=["__confirmed_state__"])
+
+    assert (destination / "bin" / "tool").read_text() == (
+        f"#!{destination.absolute()}/bin/python\nimport tool\n"
+    )
+    assert os.access(destination / "bin" / "tool", os.X_OK)
+    assert os.readlink(destination / "bin" / "python") == "/usr/bin/python3"
+    assert (destination / "lib" / "site-packages" / "tool.py").read_text() == "x = 1\n"
+    assert (destination / "pyvenv.cfg").read_text() == "home = /usr/bin\n"
+    assert not (destination / "__confirmed_state__").exists()
+    assert sorted(p.name for p in source.parent.iterdir()) == ["aaaa", "bbbb"]
+
+
+def test_unchanged_files_share_storage(
+    source: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def no_reflink(source_file: str, target_file: str) -> None:
+        raise OSError("not supported")
+
+    monkeypatch.setattr(snapshot, "_reflink", no_reflink)
+    destination = source.parent / "bbbb"
+
+    snapshot.clone_venv(source, destination)
+
+    assert os.path.samefile(
+        source / "lib" / "site-packages" / "tool.py",
+        destination / "lib" / "site-packages" / "tool.py",
+    )
+    assert not os.path.samefile(source / "bin" / "tool", destination / "bin" / "tool")
+
+
+def test_interrupted_clone_is_replaced(source: pathlib.Path) -> None:
+    (source.parent / "bbbb.partial" / "leftover").mkdir(parents=True)
+
+    snapshot.clone_venv(source, source.parent / "bbbb")
+
+    assert not (source.parent / "bbbb" / "leftover").exists()
+    assert not (source.parent / "bbbb.partial").exists()
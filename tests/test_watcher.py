@@ -0,0 +1,44 @@
+import os
+import pathlib
+
+import pytest
+
+from autoupdater import watcher
+
+
+@pytest.fixture(params=[watcher.InotifyWatcher, watcher.StatWatcher])
+def file_watcher(request, requirements_file: str) -> watcher.FileWatcher:
+    file_watcher = request.param(requirements_file)
+    yield file_watcher
+    file_watcher.close()
+
+
+class TestFileWatcher:
+    def test_no_change(self, file_watcher: watcher.FileWatcher) -> None:
+        assert not file_watcher.wait(0.01)
+
+    def test_file_modified(
+        self, file_watcher: watcher.FileWatcher, requirements_file: str
+    ) -> None:
+        with open(requirements_file, "a") as file_:
+            file_.write("# autoupdater-enforce-digest")
+
+        assert file_watcher.wait(0.01)
+        assert not file_watcher.wait(0.01)
+
+    def test_file_replaced(
+        self, file_watcher: watcher.FileWatcher, requirements_file: str
+    ) -> None:
+        with open(requirements_file + ".new", "w") as file_:
+            file_.write("something-else==1.0.0\n")
+        os.replace(requirements_file + ".new", requirements_file)
+
+        assert file_watcher.wait(0.01)
+
+    def test_other_file_ignored(
+        self, file_watcher: watcher.FileWatcher, tmp_path: pathlib.Path
+    ) -> None:
+        with open(tmp_path / "unrelated.txt", "w") as file_:
+            file_.write("hello")
+
+        assert not file_watcher.wait(0.01)
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import pathlib
+import shutil
+import subprocess
+import tarfile
+import threading
+from unittest import mock
+
+import pytest
+
+from autoupdater import core, wheelhouse
+
+
+from tests.conftest import DATA_DIR
+
+
+WHEEL = DATA_DIR / "some_package" / "dist" / "some_package-0.1.0-py3-none-any.whl"
+
+
+class TestPrefetch:
+    def test_happy_path(self, tmp_path: pathlib.Path) -> None:
+        directory = wheelhouse.wheelhouse_dir(tmp_path, b"\x01" * 32)
+
+        def fake_download(command: list, check: bool) -> None:
+            shutil.copy(WHEEL, command[command.index("--dest") + 1])
+
+        with mock.patch("subprocess.run", side_effect=fake_download):
+            wheelhouse.prefetch(pathlib.Path("pip"), [str(WHEEL)], directory)
+
+        assert wheelhouse.is_complete(directory)
+        assert [p.name for p in directory.iterdir()] == [WHEEL.name]
+
+    def test_failed_download_leaves_nothing(self, tmp_path: pathlib.Path) -> None:
+        directory = wheelhouse.wheelhouse_dir(tmp_path, b"\x01" * 32)
+
+        with mock.patch(
+            "subprocess.run", side_effect=subprocess.CalledProcessError(1, "pip")
+        ), pytest.raises(subprocess.CalledProcessError):
+            wheelhouse.prefetch(pathlib.Path("pip"), [str(WHEEL)], directory)
+
+        assert not wheelhouse.is_complete(directory)
+        assert list(directory.parent.iterdir()) == []
+
+    def test_corrupt_wheel(self, tmp_path: pathlib.Path) -> None:
+        directory = wheelhouse.wheelhouse_dir(tmp_path, b"\x01" * 32)
+
+        def fake_download(command: list, check: bool) -> None:
+            with open(
+                pathlib.Path(command[command.index("--dest") + 1]) / WHEEL.name, "wb"
+            ) as f:
+                f.write(b"not a zip file")
+
+        with mock.patch("subprocess.run", side_effect=fake_download), pytest.raises(
+            wheelhouse.BadDistribution
+        ):
+            wheelhouse.prefetch(pathlib.Path("pip"), [str(WHEEL)], directory)
+
+        assert not wheelhouse.is_complete(directory)
+
+
+# A build backend that only works with its build dependency installed
+BACKEND = """\
+import os, zipfile
+import some_package
+
+def build_wheel(wheel_directory, config_settings=None, metadata_directory=None):
+    name = "needs_build-1.0-py3-none-any.whl"
+    info = "needs_build-1.0.dist-info/"
+    with zipfile.ZipFile(os.path.join(wheel_directory, name), "w") as wheel:
+        wheel.writestr("needs_build.py", "")
+        wheel.writestr(info + "METADATA", "Metadata-Version: 2.1\\nName: needs-build\\nVersion: 1.0\\n")
+        wheel.writestr(info + "WHEEL", "Wheel-Version: 1.0\\nRoot-Is-Purelib: true\\nTag: py3-none-any\\n")
+        wheel.writestr(info + "RECORD", "")
+    return name
+"""
+
+
+def _sdist(directory: pathlib.Path) -> pathlib.Path:
+    source = directory / "needs_build-1.0"
+    source.mkdir(parents=True)
+    (source / "backend.py").write_text(BACKEND)
+    (source / "pyproject.toml").write_text(
+        '[build-system]\nrequires = ["some-package"]\n'
+        'build-backend = "backend"\nbackend-path = ["."]\n'
+    )
+    (source / "PKG-INFO").write_text(
+        "Metadata-Version: 2.1\nName: needs-build\nVersion: 1.0\n"
+    )
+    sdist = directory / "needs_build-1.0.tar.gz"
+    with tarfile.open(sdist, "w:gz") as archive:
+        archive.add(source, arcname=source.name)
+    shutil.rmtree(source)
+    return sdist
+
+
+def test_sdists_are_built(venv: core.Venv, tmp_path: pathlib.Path) -> None:
+    sdist = _sdist(tmp_path / "index")
+    directory = wheelhouse.wheelhouse_dir(tmp_path, b"\x01" * 32)
+
+    wheelhouse.prefetch(
+        venv.spec.pip_path(),
+        [
+            "--no-index",
+            f"--find-links {sdist.parent}",
+            f"--find-links {WHEEL.parent}",
+            "needs-build==1.0",
+        ],
+        directory,
+    )
+
+    assert [p.name for p in directory.iterdir()] == ["needs_build-1.0-py3-none-any.whl"]
+    # Offline, without the build dependency
+    subprocess.run(
+        [
+            venv.spec.pip_path(),
+            "install",
+            *wheelhouse.install_options(directory),
+            "needs-build==1.0",
+        ],
+        check=True,
+    )
+
+
+class FakeFetcher:
+    def __init__(self, downloads_per_host: int) -> None:
+        self.download_concurrency = 8
+        self.downloads_per_host = downloads_per_host
+        self.lock = threading.Lock()
+        self.running: dict[str, int] = {}
+        self.most_running: dict[str, int] = {}
+
+    def download(self, url: str, destination: pathlib.Path) -> str:
+        host = url.split("/")[2]
+        with self.lock:
+            self.running[host] = self.running.get(host, 0) + 1
+            self.most_running[host] = max(
+                self.most_running.get(host, 0), self.running[host]
+            )
+        threading.Event().wait(0.01)
+        with open(destination, "wb") as f:
+            f.write(url.encode("utf-8"))
+        with self.lock:
+            self.running[host] -= 1
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+class TestDownloadAll:
+    def test_per_host_limit(self, tmp_path: pathlib.Path) -> None:
+        fetcher = FakeFetcher(downloads_per_host=2)
+        distributions = [
+            wheelhouse.Distribution(url=f"https://{host}/{host}-package-{i}.tar.gz")
+            for host in ["a.example.com", "b.example.com"]
+            for i in range(8)
+        ]
+
+        wheelhouse.download_all(distributions, tmp_path, fetcher)
+
+        assert len(list(tmp_path.iterdir())) == 16
+        assert fetcher.most_running == {"a.example.com": 2, "b.example.com": 2}
+
+    def test_hash_checked(self, tmp_path: pathlib.Path) -> None:
+        url = "https://a.example.com/package-1.tar.gz"
+
+        with pytest.raises(wheelhouse.BadDistribution):
+            wheelhouse.download_all(
+                [wheelhouse.Distribution(url=url, sha256="0" * 64)],
+                tmp_path,
+                FakeFetcher(downloads_per_host=2),
+            )
+
+    def test_local_file(self, tmp_path: pathlib.Path) -> None:
+        wheelhouse.download_all(
+            [wheelhouse.Distribution(url=WHEEL.as_uri())],
+            tmp_path,
+            FakeFetcher(downloads_per_host=2),
+        )
+
+        assert [p.name for p in tmp_path.iterdir()] == [WHEEL.name]
+
+
+class TestResolve:
+    def _fake_report(self, report: dict):
+        def run(command: list, check: bool) -> None:
+            with open(command[command.index("--report") + 1], "w") as f:
+                json.dump(report, f)
+
+        return run
+
+    def test_happy_path(self) -> None:
+        report = {
+            "install": [
+                {
+                    "download_info": {
+                        "url": "https://files.example.com/six-1.16.0-py2.py3-none-any.whl",
+                        "archive_info": {"hashes": {"sha256": "abc"}},
+                    }
+                },
+                {
+                    "download_info": {
+                        "url": "https://files.example.com/pink-1.0.tar.gz",
+                        "archive_info": {"hash": "sha256=def"},
+                    }
+                },
+            ]
+        }
+
+        with mock.patch("subprocess.run", side_effect=self._fake_report(report)):
+            distributions = wheelhouse.resolve(pathlib.Path("pip"), "requirements.txt")
+
+        assert distributions == [
+            wheelhouse.Distribution(
+                url="https://files.example.com/six-1.16.0-py2.py3-none-any.whl",
+                sha256="abc",
+            ),
+            wheelhouse.Distribution(
+                url="https://files.example.com/pink-1.0.tar.gz", sha256="def"
+            ),
+        ]
+
+    def test_vcs_requirement(self) -> None:
+        report = {
+            "install": [
+                {
+                    "download_info": {
+                        "url": "https://example.com/flair.git",
+                        "vcs_info": {"vcs": "git", "commit_id": "abc"},
+                    }
+                }
+            ]
+        }
+
+        with mock.patch("subprocess.run", side_effect=self._fake_report(report)):
+            assert wheelhouse.resolve(pathlib.Path("pip"), "requirements.txt") is None
+
+    def test_old_pip(self) -> None:
+        with mock.patch(
+            "subprocess.run", side_effect=subprocess.CalledProcessError(2, "pip")
+        ):
+            assert wheelhouse.resolve(pathlib.Path("pip"), "requirements.txt") is None
@@ -0,0 +1,64 @@
+import os
+import pathlib
+
+import pytest
+
+from autoupdater import requirements, wheelstore
+
+
+def _write_wheel(directory: pathlib.Path, file_name: str, size: int) -> pathlib.Path:
+    directory.mkdir(parents=True, exist_ok=True)
+    wheel = directory / file_name
+    wheel.write_bytes(b"x" * size)
+    return wheel
+
+
+@pytest.mark.parametrize(
+    "file_name, key",
+    [
+        (
+            "Foo_Bar-1.0-cp39-cp39-linux_armv7l.whl",
+            wheelstore.WheelKey("foo-bar", "1.0", "cp39", "linux_armv7l"),
+        ),
+        (
+            "foo-1.0-1build-py3-none-any.whl",
+            wheelstore.WheelKey("foo", "1.0", "py3", "any"),
+        ),
+        ("foo-1.0.tar.gz", None),
+        ("foo-1.0-py3.whl", None),
+    ],
+)
+def test_wheel_key(file_name: str, key: wheelstore.WheelKey) -> None:
+    assert wheelstore.wheel_key(file_name) == key
+
+
+class TestWheelStore:
+    def test_keep_built(self, tmp_path: pathlib.Path) -> None:
+        store = wheelstore.WheelStore(tmp_path / "store")
+        pip_cache = tmp_path / "cache"
+        known = _write_wheel(
+            pip_cache / "wheels" / "ef", "b-1.0-cp39-cp39-linux_armv7l.whl", 10
+        )
+        _write_wheel(
+            pip_cache / "wheels" / "ab" / "cd", "a-1.0-cp39-cp39-linux_armv7l.whl", 10
+        )
+        _write_wheel(pip_cache / "http", "not-a-wheel", 10)
+
+        store.keep_built(pip_cache, {known})
+
+        assert os.listdir(tmp_path / "store") == ["a-1.0-cp39-cp39-linux_armv7l.whl"]
+        assert store.install_options() == ["--find-links", str(tmp_path / "store")]
+
+    def test_evicts_least_recently_used(self, tmp_path: pathlib.Path) -> None:
+        store = wheelstore.WheelStore(tmp_path, budget=25)
+        for when, name in enumerate(["a", "b", "c"]):
+            wheel = _write_wheel(tmp_path, f"{name}-1.0-py3-none-any.whl", 10)
+            os.utime(wheel, (when, when))
+
+        store.mark_used([requirements.parse_line("a==1.0")])
+        store.evict()
+
+        assert sorted(os.listdir(tmp_path)) == [
+            "a-1.0-py3-none-any.whl",
+            "c-1.0-py3-none-any.whl",
+        ]